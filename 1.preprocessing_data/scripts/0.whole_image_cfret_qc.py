@@ -16,6 +16,8 @@ import sys
 
 sys.path.append("../utils")
 import cp_parallel
+import image_index
+import qc_utils
 
 
 # ## Set paths and variables
@@ -71,12 +73,36 @@ plate_info_dictionary = {
 pprint.pprint(plate_info_dictionary, indent=4)
 
 
-# ## Run QC pipeline in CellProfiler
+# ## Check the images for each plate before running CellProfiler
 
 # In[ ]:
 
 
-cp_parallel.run_cellprofiler_parallel(
-    plate_info_dictionary=plate_info_dictionary, run_name=run_name
+# scan the images for each plate once and save an index, which stops the run if any image sets are missing channels or have corrupt images
+image_indexes = image_index.build_plate_indexes(
+    plate_dirs={name: info["path_to_images"] for name, info in plate_info_dictionary.items()},
+    index_dir=pathlib.Path("./image_index"),
 )
 
+
+# ## Calculate whole image QC metrics
+
+# In[ ]:
+
+
+# blur and saturation metrics are calculated with NumPy across all CPUs (same calculations as MeasureImageQuality)
+# set to True to run the full QC pipeline in CellProfiler instead (e.g., to get the other image quality metrics)
+use_cellprofiler = False
+
+if use_cellprofiler:
+    cp_parallel.run_cellprofiler_parallel(
+        plate_info_dictionary=plate_info_dictionary, run_name=run_name
+    )
+else:
+    for plate, info in plate_info_dictionary.items():
+        num_image_sets = qc_utils.measure_plate_quality(
+            plate_index=image_indexes[plate],
+            output_path=pathlib.Path(f"{info['path_to_output']}/Image.csv"),
+        )
+        print(f"{plate}: QC metrics were calculated for {num_image_sets} image sets")
+
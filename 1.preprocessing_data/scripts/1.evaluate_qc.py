@@ -17,12 +17,15 @@
 
 
 import pathlib
+import sys
 import pandas as pd
 
-from scipy.stats import zscore
 import matplotlib.pyplot as plt
 import seaborn as sns
 
+sys.path.append("../utils")
+import qc_utils
+
 
 # ## Set paths and load in data frame
 
@@ -32,6 +35,11 @@ import seaborn as sns
 # Set the threshold for identifying outliers with z-scoring for all metrics (# of standard deviations away from mean)
 threshold_z = 2
 
+# Set the rules for blur (PowerLogLogSlope) and saturation (PercentMaximal) outliers, which are only flagged in the DNA and PM channels
+qc_rules = [
+    {**rule, "threshold_z": threshold_z} for rule in qc_utils.DEFAULT_QC_RULES
+]
+
 # Directory for figures to be outputted
 figure_dir = pathlib.Path("./qc_figures")
 figure_dir.mkdir(exist_ok=True)
@@ -39,59 +47,30 @@ figure_dir.mkdir(exist_ok=True)
 # Focus on Plate 4
 plate = "localhost231120090001"
 
-# Read in CSV with all image quality metrics per image
-qc_df = pd.read_csv(pathlib.Path(f"./qc_results/{plate}/Image.csv"))
-
-# Adding 'Metadata_Well' and 'Metadata_Site' columns using filename from FileName_OrigActin (same for all channels)
-qc_df['Metadata_Well'] = qc_df['FileName_OrigActin'].str.extract(r'_(\w{3})\w*\.TIF')
-qc_df['Metadata_Site'] = qc_df['FileName_OrigActin'].str.extract(r'_\w{3}(\w{3})\w*\.TIF')
+# Read in CSV with all image quality metrics per image, adding the plate, well, and site (from FileName_OrigActin) as metadata
+qc_df = qc_utils.load_qc_results(pathlib.Path("./qc_results"), plates=[plate])
 
 print(qc_df.shape)
 qc_df.head()
 
 
-# ## Create concat dataframe combining blur and saturation metrics from all channels
+# ## Reshape blur and saturation metrics from all channels and flag outliers
 
 # In[3]:
 
 
-# List of channels
-channels = ["Actin", "DNA", "ER", "PM", "Mito"]
-
-# Create DataFrames for each channel with all Metadata columns (excluding Series and Frame which are artifacts of CellProfiler)
-Actin_df = qc_df.filter(like="Metadata_").drop(columns=["Metadata_Series", "Metadata_Frame"]).copy()
-DNA_df = Actin_df.copy()
-ER_df = Actin_df.copy()
-PM_df = Actin_df.copy()
-Mito_df = Actin_df.copy()
-
-# Iterate through each channel and add the specified columns
-for channel in channels:
-    # Add PowerLogLogSlope column
-    globals()[f"{channel}_df"][f"ImageQuality_PowerLogLogSlope_Orig{channel}"] = qc_df[
-        f"ImageQuality_PowerLogLogSlope_Orig{channel}"
-    ]
-
-    # Add PercentMaximal column
-    globals()[f"{channel}_df"][f"ImageQuality_PercentMaximal_Orig{channel}"] = qc_df[
-        f"ImageQuality_PercentMaximal_Orig{channel}"
-    ]
-
-    # Rename columns for each channel to concat
-    globals()[f"{channel}_df"] = globals()[f"{channel}_df"].rename(
-        columns={
-            f"ImageQuality_PowerLogLogSlope_Orig{channel}": "ImageQuality_PowerLogLogSlope",
-            f"ImageQuality_PercentMaximal_Orig{channel}": f"ImageQuality_PercentMaximal"
-        }
-    )
-
-    # Add "Channel" column
-    globals()[f"{channel}_df"]["Channel"] = channel
+# Reshape the blur and saturation metrics from all channels (Actin, DNA, ER, PM, and Mito) into one row per image and channel for plotting
+df = qc_utils.melt_image_quality(
+    qc_df, metrics=["PowerLogLogSlope", "PercentMaximal"]
+)
 
-# Concat the channel data frames together for plotting
-df = pd.concat([Actin_df, DNA_df, ER_df, PM_df, Mito_df], ignore_index=True)
+# Flag outliers for each rule, where z-scores are calculated across all channels of the plate (the thresholds in the IC pipeline are based on these)
+passed_qc, flags_df = qc_utils.evaluate_whole_image_qc(
+    qc_df, rules=qc_rules, group_by=("Metadata_Plate",)
+)
 
 print(df.shape)
+print(f"{passed_qc.sum()} out of {len(passed_qc)} image sets passed QC")
 df.head()
 
 
@@ -126,14 +105,8 @@ print(summary_statistics)
 # In[6]:
 
 
-# Calculate Z-scores for the column
-z_scores = zscore(df['ImageQuality_PowerLogLogSlope'])
-
-# Identify outlier rows based on Z-scores above and below the mean since we are using absolute values of the z-scores
-blur_outliers = df[abs(z_scores) > threshold_z]
-
-# Remove any blur outliers detected in for all channels (currently we have concluded DNA and PM channels are best able to detect blurry images)
-blur_outliers = blur_outliers[(blur_outliers['Channel'] == 'DNA') | (blur_outliers['Channel'] == 'PM')]
+# Blur outliers are above or below the mean in the DNA and PM channels (currently we have concluded DNA and PM channels are best able to detect blurry images)
+blur_outliers = qc_utils.get_outliers(qc_df, flags_df, flag_column="Flag_PowerLogLogSlope")
 
 print(blur_outliers.shape)
 print(blur_outliers['Channel'].value_counts())
@@ -192,17 +165,11 @@ print(summary_statistics)
 # In[10]:
 
 
-# Calculate Z-scores for the column
-z_scores = zscore(df['ImageQuality_PercentMaximal'])
-
-# Identify outlier rows based on Z-scores greater than as to identify whole images with abnormally high saturated pixels
-sat_outliers = df[abs(z_scores) > threshold_z]
-
-# Remove any outliers detected in other channels (currently we have concluded that those other channels don't detect artifacts)
-sat_outliers = sat_outliers[(sat_outliers['Channel'] == 'DNA') | (sat_outliers['Channel'] == 'PM')]
+# Saturation outliers have abnormally high saturated pixels in the DNA and PM channels (currently we have concluded that those other channels don't detect artifacts)
+sat_outliers = qc_utils.get_outliers(qc_df, flags_df, flag_column="Flag_PercentMaximal")
 
-# Append saturation outliers to blur outliers, drop any duplicate FOVs and save outliers for QC report
-outliers = pd.concat([sat_outliers, blur_outliers], ignore_index=True).drop_duplicates()
+# Combine the saturation and blur outliers (one row per flagged image and channel) and save outliers for QC report
+outliers = qc_utils.get_outliers(qc_df, flags_df)
 
 # Save outliers data frame to view in report
 outliers.to_csv("./qc_results/qc_outliers.csv")
@@ -15,6 +15,8 @@ import sys
 
 sys.path.append("../utils")
 import cp_parallel
+import image_index
+import qc_exclusion
 
 
 # ## Set paths and variables
@@ -67,6 +69,32 @@ plate_info_dictionary = {
 pprint.pprint(plate_info_dictionary, indent=4)
 
 
+# ## Check the images for each plate before running CellProfiler
+
+# In[ ]:
+
+
+# scan the images for each plate once and save an index, which stops the run if any image sets are missing channels or have corrupt images
+image_indexes = image_index.build_plate_indexes(
+    plate_dirs={name: info["path_to_images"] for name, info in plate_info_dictionary.items()},
+    index_dir=pathlib.Path("./image_index"),
+)
+
+
+# ## Skip image sets flagged by whole image QC
+
+# In[ ]:
+
+
+# write a file list per plate without the blur and saturation outliers so CellProfiler never processes those image sets
+qc_exclusion.write_qc_file_lists(
+    plate_info_dictionary=plate_info_dictionary,
+    image_indexes=image_indexes,
+    outliers_path=pathlib.Path("./qc_results/qc_outliers.csv"),
+    file_list_dir=pathlib.Path("./file_lists"),
+)
+
+
 # ## Perform IC on all plates
 # 
 # Note: This code cell was not ran as we prefer to perform CellProfiler processing tasks via `sh` file (bash script) which is more stable.
@@ -13,7 +13,9 @@ import pprint
 import sys
 
 sys.path.append("../utils/")
-import cp_parallel as cp
+import cp_scheduler
+import image_index
+import qc_exclusion
 
 
 # ## Set paths and variables
@@ -24,6 +26,9 @@ import cp_parallel as cp
 # set the run type for the parallelization
 run_name = "analysis"
 
+# set the number of image sets per CellProfiler process (batches from all plates share the same pool of workers)
+batch_size = 25
+
 # path to analysis pipeline
 path_to_pipeline = pathlib.Path("./pipeline/CFReT_project_CL.cppipe").resolve(strict=True)
 
@@ -68,14 +73,42 @@ plate_info_dictionary = {
 pprint.pprint(plate_info_dictionary, indent=4)
 
 
+# ## Check the images for each plate before running CellProfiler
+
+# In[ ]:
+
+
+# scan the images for each plate once and save an index, which stops the run if any image sets are missing channels or have corrupt images
+image_indexes = image_index.build_plate_indexes(
+    plate_dirs={name: info["path_to_images"] for name, info in plate_info_dictionary.items()},
+    index_dir=pathlib.Path("./image_index"),
+)
+
+
+# ## Skip image sets flagged by whole image QC
+
+# In[ ]:
+
+
+# write a file list per plate without the blur and saturation outliers so CellProfiler never processes those image sets
+qc_exclusion.write_qc_file_lists(
+    plate_info_dictionary=plate_info_dictionary,
+    image_indexes=image_indexes,
+    outliers_path=pathlib.Path("../1.preprocessing_data/qc_results/qc_outliers.csv"),
+    file_list_dir=pathlib.Path("./file_lists"),
+)
+
+
 # ## Run CellProfiler analysis on all plates
 # 
-# **Note:** This code cell will not be run in this notebook due to the instability of jupyter notebooks compared to running as a python script. All CellProfiler SQLite outputs will have the same name but outputted into their respective plate folder (due to parallelization).
+# **Note:** This code cell will not be run in this notebook due to the instability of jupyter notebooks compared to running as a python script. Each plate is split into batches of image sets that are run in parallel, and the SQLite outputs from each batch are merged into one SQLite file in their respective plate folder.
 
 # In[ ]:
 
 
-cp.run_cellprofiler_parallel(
-    plate_info_dictionary=plate_info_dictionary, run_name=run_name
+cp_scheduler.run_cellprofiler_batched(
+    plate_info_dictionary=plate_info_dictionary,
+    run_name=run_name,
+    batch_size=batch_size,
 )
 
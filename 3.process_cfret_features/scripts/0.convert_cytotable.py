@@ -9,8 +9,14 @@
 
 
 import pathlib
+import sys
+
 import pandas as pd
 
+sys.path.append("../utils")
+import convert_utils
+import parquet_utils
+
 # cytotable will merge objects from SQLite file into single cells and save as parquet file
 from cytotable import convert, presets
 
@@ -25,6 +31,12 @@ logging.getLogger().setLevel(logging.ERROR)
 # In[2]:
 
 
+# join the compartments in one pass with SQLite (set to True to convert with cytotable instead)
+use_cytotable = False
+
+# GB of memory for each worker converting a plate (plates are converted at the same time if the memory is available)
+memory_limit_gb = 8
+
 # preset configurations based on typical CellProfiler outputs
 preset = "cellprofiler_sqlite_pycytominer"
 
@@ -60,66 +72,74 @@ for name in plate_names:
 # In[3]:
 
 
-for file_path in sqlite_dir.iterdir():
-    output_path = pathlib.Path(
-        f"{output_dir}/converted_profiles/{file_path.stem}_converted.parquet"
-    )
-    print("Starting conversion with cytotable for plate:", file_path.stem)
-    # Merge single cells and output as parquet file
-    convert(
-        source_path=str(file_path),
-        dest_path=str(output_path),
-        dest_datatype=dest_datatype,
-        preset=preset,
-        joins=joins,
-        chunk_size=5000,
+if use_cytotable:
+    for file_path in sqlite_dir.iterdir():
+        output_path = pathlib.Path(
+            f"{output_dir}/converted_profiles/{file_path.stem}_converted.parquet"
+        )
+        print("Starting conversion with cytotable for plate:", file_path.stem)
+        # Merge single cells and output as parquet file
+        convert(
+            source_path=str(file_path),
+            dest_path=str(output_path),
+            dest_datatype=dest_datatype,
+            preset=preset,
+            joins=joins,
+            chunk_size=5000,
+        )
+else:
+    # join the compartments into single cells for all plates at the same time, dropping rows without an image and
+    # adding the metadata columns (the chunk size for each plate is set by the memory limit per worker)
+    convert_utils.convert_plates(
+        sqlite_files={file_path.stem: file_path for file_path in sqlite_dir.iterdir()},
+        output_dir=pathlib.Path(f"{output_dir}/converted_profiles"),
+        memory_limit_gb=memory_limit_gb,
     )
 
-print("All plates have been converted with cytotable!")
+print("All plates have been converted!")
 
 
-# # Load in converted profiles to update
+# # Load in converted profiles to update (cytotable only)
 
 # In[4]:
 
 
-# Directory with converted profiles
-converted_dir = pathlib.Path(f"{output_dir}/converted_profiles")
-
-for file_path in converted_dir.iterdir():
-    # Load the DataFrame from the Parquet file
-    df = pd.read_parquet(file_path)
-
-    # If any, drop rows where "Metadata_ImageNumber" is NaN (artifact of cytotable)
-    df = df.dropna(subset=["Metadata_ImageNumber"])
-    
-    # Rearrange columns and add "Metadata" prefix in one line
-    df = df[
-        [
-            "Nuclei_Location_Center_X",
-            "Nuclei_Location_Center_Y",
-            "Cells_Location_Center_X",
-            "Cells_Location_Center_Y",
-            "Image_Count_Cells",
-        ]
-        + [col for col in df.columns if col not in [
-            "Nuclei_Location_Center_X",
-            "Nuclei_Location_Center_Y",
-            "Cells_Location_Center_X",
-            "Cells_Location_Center_Y",
-            "Image_Count_Cells"]]
-    ].rename(
-        columns=lambda col: "Metadata_" + col if col in [
-            "Nuclei_Location_Center_X",
-            "Nuclei_Location_Center_Y",
-            "Cells_Location_Center_X",
-            "Cells_Location_Center_Y",
-            "Image_Count_Cells"
-        ] else col
-    )
+# the converted profiles from cytotable are updated here, the SQLite join already does this while writing
+if use_cytotable:
+    # Directory with converted profiles
+    converted_dir = pathlib.Path(f"{output_dir}/converted_profiles")
+
+    for file_path in converted_dir.iterdir():
+        # Drop rows where "Metadata_ImageNumber" is NaN (artifact of cytotable), move the location and cell count
+        # columns to the front with a "Metadata" prefix, and save to the same path one batch of rows at a time
+        parquet_utils.transform_parquet(
+            input_path=file_path,
+            rename={
+                column: f"Metadata_{column}"
+                for column in convert_utils.METADATA_COLUMNS
+            },
+            first_columns=[
+                f"Metadata_{column}" for column in convert_utils.METADATA_COLUMNS
+            ],
+            row_filter=parquet_utils.not_null_filter("Metadata_ImageNumber"),
+        )
+
+
+# ## Add plate name for plate 4
+# 
+# The plate name is missing from the CellProfiler output for plate 4 due to an error, so it is added to the converted profile.
+
+# In[ ]:
 
-    # Save the processed DataFrame as Parquet in the same path
-    df.to_parquet(file_path, index=False)
+
+plate_4 = "localhost231120090001"
+plate_4_path = pathlib.Path(f"{output_dir}/converted_profiles/{plate_4}_converted.parquet")
+
+# replace the missing plate name one batch of rows at a time
+if plate_4_path.exists():
+    parquet_utils.transform_parquet(
+        input_path=plate_4_path, constant_columns={"Image_Metadata_Plate": plate_4}
+    )
 
 
 # ## Check output to confirm process worked
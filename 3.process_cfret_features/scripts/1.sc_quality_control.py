@@ -29,9 +29,12 @@
 import pathlib
 import pandas as pd
 import matplotlib.pyplot as plt
-import seaborn as sns
 
-from cosmicqc import find_outliers
+import sys
+
+sys.path.append("../utils")
+import sc_qc_plot_utils
+import sc_qc_utils
 
 
 # ## Set paths and variables
@@ -50,6 +53,10 @@ cleaned_dir.mkdir(exist_ok=True)
 qc_fig_dir = pathlib.Path("./qc_figures")
 qc_fig_dir.mkdir(exist_ok=True)
 
+# config with the z-score thresholds for each QC condition (and any thresholds that are different for a plate)
+qc_config_path = pathlib.Path("./sc_qc_config.yaml")
+qc_config = sc_qc_utils.load_qc_config(qc_config_path)
+
 # Create an empty dictionary to store data frames for each plate
 all_qc_data_frames = {}
 
@@ -71,12 +78,16 @@ metadata_columns = [
 # Set plate as variable to load in
 plate = "localhost220513100001_KK22-05-198_FactinAdjusted"
 
-# Load in converted plate data
-plate_df = pd.read_parquet(f"{data_dir}/{plate}_converted.parquet")
+# Find the QC thresholds for this plate
+plate_conditions = sc_qc_utils.get_plate_conditions(qc_config, plate)
 
-# Add plate values if plate_4 is loaded in as it is absent due to error
-if plate == 'localhost231120090001':
-    plate_df['Image_Metadata_Plate'] = 'localhost231120090001'
+# Load in only the metadata and QC feature columns from the converted plate data
+plate_df = pd.read_parquet(
+    f"{data_dir}/{plate}_converted.parquet",
+    columns=sc_qc_utils.get_qc_columns(
+        conditions=plate_conditions, metadata_columns=metadata_columns
+    ),
+)
 
 print(plate_df.shape)
 plate_df.head()
@@ -87,21 +98,26 @@ plate_df.head()
 # In[4]:
 
 
-# Set outlier threshold that maximizes removing most technical outliers and minimizes good cells
-outlier_threshold = 2
-
-# find large nuclei and high intensity
-feature_thresholds = {
-    "Nuclei_AreaShape_Area": outlier_threshold,
-    "Nuclei_Intensity_IntegratedIntensity_Hoechst": outlier_threshold,
-}
+# find the outliers for all QC conditions in one pass (z-scores are computed once for all QC features)
+plate_outliers = sc_qc_utils.find_plate_outliers(
+    plate_df=plate_df,
+    conditions=plate_conditions,
+    metadata_columns=metadata_columns
+)
 
-large_nuclei_high_int_outliers = find_outliers(
-    df=plate_df,
-    metadata_columns=metadata_columns,
-    feature_thresholds=feature_thresholds
+# find the feature values of the thresholds to draw on the plots
+threshold_values = sc_qc_utils.get_threshold_values(
+    plate_df=plate_df, conditions=plate_conditions
 )
 
+# find large nuclei and high intensity (thresholds maximize removing most technical outliers and minimize removing good cells)
+feature_thresholds = plate_conditions["large_nuclei_high_intensity"]
+
+large_nuclei_high_int_outliers = plate_outliers.loc[
+    plate_outliers["Outlier_large_nuclei_high_intensity"],
+    list(feature_thresholds) + metadata_columns
+]
+
 print(large_nuclei_high_int_outliers.shape)
 large_nuclei_high_int_outliers.head()
 
@@ -111,35 +127,14 @@ large_nuclei_high_int_outliers.head()
 # In[5]:
 
 
-# Set the default value to 'inlier'
-plate_df['Outlier_Status'] = 'Single-cell passed QC'
-
-# Update the 'Outlier_Status' column based on the outliers DataFrame using index
-plate_df.loc[plate_df.index.isin(large_nuclei_high_int_outliers.index), 'Outlier_Status'] = 'Single-cell failed QC'
-
-# Create scatter plot
+# Create density plot (2-D histograms drawn as images instead of a point per single cell) with the threshold lines
 plt.figure(figsize=(10, 6))
-plot = sns.scatterplot(
-    data=plate_df,
+sc_qc_plot_utils.plot_outlier_density(
+    plate_df=plate_df,
     x="Nuclei_AreaShape_Area",
     y="Nuclei_Intensity_IntegratedIntensity_Hoechst",
-    hue="Outlier_Status",
-    palette={'Single-cell passed QC': '#006400', 'Single-cell failed QC': '#990090'},  # Specify colors
-    alpha=0.6
-)
-
-# Add threshold lines
-plt.axvline(
-    x=large_nuclei_high_int_outliers['Nuclei_AreaShape_Area'].min(),
-    color="r",
-    linestyle="--",
-    label='Min. threshold for Nuclei Area'
-)
-plt.axhline(
-    y=large_nuclei_high_int_outliers['Nuclei_Intensity_IntegratedIntensity_Hoechst'].min(),
-    color="b",
-    linestyle="--",
-    label='Min. threshold for Nuclei Intensity'
+    is_outlier=plate_df.index.isin(large_nuclei_high_int_outliers.index),
+    threshold_values=threshold_values["large_nuclei_high_intensity"],
 )
 
 plt.title(f"Nuclei Area vs. Nuclei Integrated Intensity for {plate}")
@@ -147,9 +142,6 @@ plt.xlabel("Nuclei Area")
 plt.ylabel("Nuclei Integrated Intensity (Hoechst)")
 plt.tight_layout()
 
-# Show the legend
-plt.legend(loc='lower right', bbox_to_anchor=(1.0, 0), prop={'size': 10})
-
 # Save figure
 plt.savefig(pathlib.Path(f"{qc_fig_dir}/{plate}_nuclei_outliers.png"), dpi=500)
 
@@ -161,24 +153,13 @@ plt.show()
 # In[6]:
 
 
-# find large nuclei and high intensity
-if plate == "localhost230405150001": # for plate 3
-    # Set threshold more strict as it is not enough to remove most outliers
-    feature_thresholds = {
-        "Cells_AreaShape_Area": -0.9,
-    }
-else:
-    # This threshold can work for plate 4 and the pilot plates which removes most outliers
-    feature_thresholds = {
-        "Cells_AreaShape_Area": -1,
-    }
-
+# find small cells (plate 3 has a more strict threshold in the config as the default is not enough to remove most outliers)
+feature_thresholds = plate_conditions["small_cells"]
 
-small_cells_outliers = find_outliers(
-    df=plate_df,
-    metadata_columns=metadata_columns,
-    feature_thresholds=feature_thresholds
-)
+small_cells_outliers = plate_outliers.loc[
+    plate_outliers["Outlier_small_cells"],
+    list(feature_thresholds) + metadata_columns
+]
 
 print(small_cells_outliers.shape)
 small_cells_outliers.sort_values(by="Cells_AreaShape_Area", ascending=False).head()
@@ -187,23 +168,19 @@ small_cells_outliers.sort_values(by="Cells_AreaShape_Area", ascending=False).hea
 # In[7]:
 
 
-# Create a density plot
+# Create a density plot from a sample of single cells from every well with the threshold line
 plt.figure(figsize=(10, 6))
-sns.kdeplot(x='Cells_AreaShape_Area', data=plate_df, fill=True)
-
-# Add threshold line
-plt.axvline(
-    x=small_cells_outliers["Cells_AreaShape_Area"].max(),
-    color="r",
-    linestyle="--",
-    label=f'Threshold for Outliers: < {small_cells_outliers["Cells_AreaShape_Area"].max()}',
+sc_qc_plot_utils.plot_feature_kde(
+    plate_df=plate_df,
+    feature="Cells_AreaShape_Area",
+    threshold_values=threshold_values["small_cells"],
+    strata=["Image_Metadata_Well"],
 )
 
 # Set labels and title
 plt.ylabel('Count')
 plt.xlabel('Cells Area')
 plt.title(f'Distribution of cells area for {plate}')
-plt.legend()
 plt.tight_layout()
 
 # save figure
@@ -213,22 +190,23 @@ plt.savefig(pathlib.Path(f"{qc_fig_dir}/{plate}_cells_outliers.png"), dpi=500)
 plt.show()
 
 
-# ## Remove all outliers and save cleaned data frame
+# ## Remove all outliers and save cleaned data frames for all plates
 
 # In[8]:
 
 
-# Assuming nuclei_outliers_df and cells_outliers_df have the same index
-outlier_indices = pd.concat([large_nuclei_high_int_outliers, small_cells_outliers]).index
-
-# Remove rows with outlier indices from plate_4_df
-plate_df_cleaned = plate_df.drop(outlier_indices)
-
-# Save cleaned data for this plate
-plate_name = plate_df['Image_Metadata_Plate'].iloc[0]
-plate_df_cleaned.to_parquet(f"{cleaned_dir}/{plate_name}_cleaned.parquet")
+# Find and remove the outliers for every converted plate at the same time (using the thresholds for each plate from the
+# config), then save the cleaned data for each plate and one table with the outliers from all plates
+outliers_df = sc_qc_utils.run_sc_qc(
+    converted_dir=data_dir,
+    cleaned_dir=cleaned_dir,
+    config_path=qc_config_path,
+    outliers_path=pathlib.Path("./data/sc_qc_outliers.parquet"),
+)
 
 # Verify the result
-print(plate_df_cleaned.shape)
-plate_df_cleaned.head()
+print(outliers_df.shape)
+outliers_df.groupby("Metadata_Plate")[
+    [column for column in outliers_df.columns if column.startswith("Outlier_")]
+].sum()
 
@@ -10,10 +10,12 @@
 
 import pathlib
 import pprint
+import sys
 
 import pandas as pd
 
-from pycytominer import annotate, normalize, feature_select
+sys.path.append("../utils")
+import sc_processing_utils
 
 
 # ## Set paths and variables
@@ -74,73 +76,33 @@ pprint.pprint(plate_info_dictionary, indent=4)
 # In[4]:
 
 
-for plate, info in plate_info_dictionary.items():
-    print(f"Performing pycytominer pipeline for {plate}")
-    output_annotated_file = str(pathlib.Path(f"{output_dir}/{plate}_sc_annotated.parquet"))
-    output_normalized_file = str(pathlib.Path(f"{output_dir}/{plate}_sc_normalized.parquet"))
-    output_feature_select_file = str(pathlib.Path(f"{output_dir}/{plate}_sc_feature_selected.parquet"))
-
-    profile_df = pd.read_parquet(info["profile_path"])
-    platemap_df = pd.read_csv(info["platemap_path"])
-
-    print("Performing annotation for", plate, "...")
-    # Step 1: Annotation
-    annotate(
-        profiles=profile_df,
-        platemap=platemap_df,
-        join_on=["Metadata_well_position", "Image_Metadata_Well"],
-        output_file=output_annotated_file,
-        output_type="parquet",
-    )
-
-    # Load the annotated parquet file to fix metadata columns names
-    annotated_df = pd.read_parquet(output_annotated_file)
+# set the samples to use as the reference for normalization for each plate (default is all samples)
+# Only for Plate 4, we want to normalize to the DMSO treatments
+normalize_samples = {
+    "localhost231120090001": "Metadata_heart_number == 7 and Metadata_treatment == 'DMSO'",
+}
 
-    # Rename columns using the rename() function
-    column_name_mapping = {
-        "Image_Metadata_Site": "Metadata_Site",
-    }
+# keep each plate in memory from annotation to feature selection (the default); set to True for plates that do not
+# fit in memory, which normalizes the annotated parquet file one batch of rows at a time but writes and reads the
+# annotated and normalized profiles on disk again (about one extra write and three extra reads of the plate)
+stream_normalize = False
 
-    annotated_df.rename(columns=column_name_mapping, inplace=True)
-
-    # Save the modified DataFrame back to the same location
-    annotated_df.to_parquet(output_annotated_file, index=False)
-    
-    # set default for samples to use in normalization
-    samples = "all"
-     
-    # Only for Plate 4, we want to normalize to the DMSO treatments
-    if plate == "localhost231120090001":
-        samples = "Metadata_heart_number == 7 and Metadata_treatment == 'DMSO'"
-
-    print(f"Performing normalization for", plate, "using this samples parameter:", samples)
-
-    # Step 2: Normalization
-    normalized_df = normalize(
-        profiles=output_annotated_file,
-        method="standardize",
-        output_file=output_normalized_file,
-        output_type="parquet",
-        samples=samples,
-    )
-    
-    print("Performing feature selection for", plate, "...")
-    # Step 3: Feature selection
-    feature_select(
-        output_normalized_file,
-        operation=feature_select_ops,
-        na_cutoff=0,
-        output_file=output_feature_select_file,
-        output_type="parquet"
-    )
-    print(f"Annotation, normalization, and feature selection have been performed for {plate}")
+# Annotate, rename metadata, normalize, and feature select each plate in memory (only the outputs are saved),
+# processing the plates at the same time
+output_files = sc_processing_utils.process_plates(
+    plate_info_dictionary=plate_info_dictionary,
+    output_dir=output_dir,
+    samples=normalize_samples,
+    feature_select_ops=feature_select_ops,
+    stream_normalize=stream_normalize,
+)
 
 
 # In[5]:
 
 
 # Check output file
-test_df = pd.read_parquet(output_feature_select_file)
+test_df = pd.read_parquet(output_files[plate_names[-1]]["feature_selected"])
 
 print(test_df.shape)
 test_df.head(2)
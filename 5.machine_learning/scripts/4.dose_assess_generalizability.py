@@ -24,6 +24,7 @@ from sklearn.metrics import precision_recall_curve
 sys.path.append("../utils")
 from eval_utils import generate_confusion_matrix_df, generate_f1_score_df
 from training_utils import get_X_y_data
+import transform_utils
 
 
 # ## Set paths and variables
@@ -54,23 +55,39 @@ shuffled_model = load(
 )
 
 
-# ## Load in Plate 4 fs data to extract column names to filter from the other plates
+# ## Load in the Plate 4 transform (or feature selected data) to get the feature columns used with the model
 
 # In[3]:
 
 
-# Load in Plate 4 normalized feature selected data metadata (used with model) to get the feature columns to filter the plate data
-parquet_metadata = pq.read_metadata(
-    pathlib.Path(f"{data_dir}/localhost231120090001_sc_feature_selected.parquet")
-)
-
-# Get the column names from the metadata
-all_column_names = parquet_metadata.schema.names
+# Load in the Plate 4 transform (center and scale of each feature and the features kept by feature selection, saved
+# during single-cell processing) to get the feature columns used with the model
+plate_4_transform_path = pathlib.Path(f"{data_dir}/localhost231120090001_sc_transform.json")
+plate_4_transform = None
+if plate_4_transform_path.exists():
+    plate_4_transform = transform_utils.load_transform(plate_4_transform_path)
+    model_column_names = plate_4_transform["kept_features"]
+else:
+    # Use the feature columns from the Plate 4 normalized feature selected data if the transform has not been saved
+    parquet_metadata = pq.read_metadata(pathlib.Path(f"{data_dir}/localhost231120090001_sc_feature_selected.parquet"))
+    model_column_names = [col for col in parquet_metadata.schema.names if not col.startswith("Metadata_")]
+
+# Check that the feature columns are the features the model was trained with (they change if feature selection is run
+# again with different settings), using the number of features if the model was trained without feature names
+if hasattr(final_model, "feature_names_in_"):
+    features_match = list(model_column_names) == list(final_model.feature_names_in_)
+else:
+    features_match = len(model_column_names) == final_model.n_features_in_
+if not features_match:
+    raise ValueError(
+        "The Plate 4 feature columns do not match the features the model was trained with, please retrain the model."
+    )
 
-# Filter out the column names that start with "Metadata_"
-model_column_names = [
-    col for col in all_column_names if not col.startswith("Metadata_")
-]
+# Set to True to normalize the annotated plates with the Plate 4 center and scale (the same as the data used to train
+# the model) in one pass, instead of loading the plates that were normalized on their own
+use_plate_4_transform = False
+if use_plate_4_transform and plate_4_transform is None:
+    raise FileNotFoundError(f"The Plate 4 transform {plate_4_transform_path} does not exist, please run single-cell processing.")
 
 print(len(model_column_names))
 print(model_column_names)
@@ -81,15 +98,23 @@ print(model_column_names)
 # In[4]:
 
 
-# Load in Plate 1 and 2 data -> concat
-plate_1_df = pd.read_parquet(
-    pathlib.Path(f"{data_dir}/localhost220512140003_KK22-05-198_sc_normalized.parquet")
-)
-plate_2_df = pd.read_parquet(
-    pathlib.Path(
-        f"{data_dir}/localhost220513100001_KK22-05-198_FactinAdjusted_sc_normalized.parquet"
-    )
-)
+# Load in Plate 1 and 2 data (projected through the Plate 4 transform if set) -> concat
+plate_dfs = []
+for plate in [
+    "localhost220512140003_KK22-05-198",
+    "localhost220513100001_KK22-05-198_FactinAdjusted",
+]:
+    if use_plate_4_transform:
+        plate_path = pathlib.Path(f"{data_dir}/{plate}_sc_plate_4_transformed.parquet")
+        transform_utils.apply_transform_parquet(
+            input_path=pathlib.Path(f"{data_dir}/{plate}_sc_annotated.parquet"),
+            output_path=plate_path,
+            transform=plate_4_transform,
+        )
+    else:
+        plate_path = pathlib.Path(f"{data_dir}/{plate}_sc_normalized.parquet")
+    plate_dfs.append(pd.read_parquet(plate_path))
+plate_1_df, plate_2_df = plate_dfs
 
 # Concat separate parts of the same plate together
 concatenated_df = pd.concat([plate_1_df, plate_2_df], axis=0)
@@ -36,10 +36,15 @@
 import pathlib
 from pprint import pprint
 
+import sys
+
 import cv2
 import pandas as pd
 from typing import List
 
+sys.path.append("../utils")
+from image_index import ImageIndex
+
 
 # ## Define functions for notebook
 
@@ -77,7 +82,7 @@ def create_sc_dict(dfs: List[pd.DataFrame], names: List[str]) -> dict:
 # Function for generating and saving single-cell crops per channel as PNGs
 def generate_sc_crops(
     sc_dict: dict,
-    images_dir: pathlib.Path,
+    plate_index: ImageIndex,
     output_img_dir: pathlib.Path,
     crop_size: int,
 ) -> None:
@@ -86,7 +91,7 @@ def generate_sc_crops(
 
     Args:
         sc_dict (dict): Dictionary containing info relevant for finding single-cell crops.
-        images_dir (pathlib.Path): Directory where illumination corrected images are found.
+        plate_index (ImageIndex): Image index for the plate with the paths to the illumination corrected images.
         output_img_dir (pathlib.Path): Main directory to save each image set single-cell crops
         crop_size (int): Size of the box in pixels (example: setting crop_size as 250 will make a 250x250 pixel crop around the single-cell center coordinates)
     """
@@ -96,7 +101,7 @@ def generate_sc_crops(
 
         # Create file paths with well, site, and channel
         for i in range(5):  # Update the range to start from 0 and end at 4
-            filename = f"{images_dir}/{info['plate']}_{info['well']}{info['site']}d{i}_illumcorrect.tiff"
+            filename = str(plate_index.path(info['well'], info['site'], f"d{i}"))
             file_paths.append(filename)
 
             # Read the image
@@ -144,6 +149,14 @@ images_dir = pathlib.Path(
     "../1.preprocessing_data/Corrected_Images/localhost231120090001/"
 ).resolve(strict=True)
 
+# Index of the images for plate 4 (only images that changed since the index was saved are read again)
+plate_index = ImageIndex.build(
+    plate_dir=images_dir,
+    index_path=pathlib.Path(
+        "../2.cellprofiler_processing/image_index/localhost231120090001_image_index.csv"
+    ),
+)
+
 # Output dir for cropped images
 output_img_dir = pathlib.Path("./sc_crops")
 output_img_dir.mkdir(exist_ok=True)
@@ -505,5 +518,5 @@ pprint(list(sc_dict.items())[:2], indent=4)
 # In[18]:
 
 
-generate_sc_crops(sc_dict=sc_dict, images_dir=images_dir, output_img_dir=output_img_dir, crop_size=crop_size)
+generate_sc_crops(sc_dict=sc_dict, plate_index=plate_index, output_img_dir=output_img_dir, crop_size=crop_size)
 
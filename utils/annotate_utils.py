@@ -0,0 +1,200 @@
+"""
+This collection of functions annotates single-cell profiles with the platemap without a pandas merge, giving the same
+result as `pycytominer.annotate`. The wells of the single cells are read from the parquet file as dictionary-encoded
+integer codes (one code for each distinct well), so each well is looked up in the platemap once, and the platemap row
+for every single cell is found by indexing a lookup array with the codes. The well column is read once, and the well
+strings of the annotated profiles are taken from the codes, so a string is not read for every single cell.
+"""
+
+import pathlib
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+# columns that are renamed after annotation (the same as `pycytominer.cyto_utils.cp_clean`, other metadata columns
+# such as the site are renamed by the caller)
+CP_CLEAN_MAPPING = {
+    "Image_Metadata_Plate": "Metadata_Plate",
+    "Image_Metadata_Well": "Metadata_Well",
+}
+
+
+def load_platemap(platemap_path: pathlib.Path) -> pd.DataFrame:
+    """Load a platemap with the `Metadata_` prefix added to each column (the same as
+    `pycytominer.cyto_utils.load_platemap`).
+
+    Args:
+        platemap_path (pathlib.Path): path to the platemap CSV file
+
+    Returns:
+        pd.DataFrame: platemap
+    """
+    platemap = pd.read_csv(platemap_path)
+    platemap.columns = [
+        column if column.startswith("Metadata_") else f"Metadata_{column}"
+        for column in platemap.columns
+    ]
+
+    return platemap
+
+
+def get_well_codes(wells: pa.ChunkedArray) -> Tuple[np.ndarray, pd.Index]:
+    """Find the well of each single cell as integer codes, using the dictionary encoding of the column (from
+    `pq.read_table` with `read_dictionary`) instead of a string for every single cell.
+
+    Args:
+        wells (pa.ChunkedArray): column with the well of each single cell (e.g., "Image_Metadata_Well")
+
+    Returns:
+        Tuple[np.ndarray, pd.Index]: code of each single cell (-1 if the well is missing) and the well for each code
+    """
+    # only string columns are read with their dictionary
+    if not pa.types.is_dictionary(wells.type):
+        wells = wells.dictionary_encode()
+    wells = wells.unify_dictionaries()
+    if wells.num_chunks == 0:
+        return np.empty(0, dtype=np.int64), pd.Index([])
+
+    codes = np.concatenate(
+        [
+            pc.fill_null(chunk.indices, -1).to_numpy(zero_copy_only=False)
+            for chunk in wells.chunks
+        ]
+    ).astype(np.int64)
+
+    return codes, pd.Index(wells.chunks[0].dictionary.to_pylist())
+
+
+def read_profiles(
+    profile_path: pathlib.Path, well_column: str
+) -> Tuple[pd.DataFrame, Tuple[np.ndarray, pd.Index]]:
+    """Read the single-cell profiles from a parquet file with the well column read as dictionary codes. The well
+    column of the data frame is taken from the codes, so each row points to one string for each well.
+
+    Args:
+        profile_path (pathlib.Path): path to the parquet file with the single-cell profiles
+        well_column (str): column with the well of each single cell (e.g., "Image_Metadata_Well")
+
+    Returns:
+        Tuple[pd.DataFrame, Tuple[np.ndarray, pd.Index]]: single-cell profiles, and the code of the well for each single
+        cell and the well for each code (see `get_well_codes`)
+    """
+    table = pq.read_table(profile_path, read_dictionary=[well_column])
+    position = table.schema.get_field_index(well_column)
+    codes, wells = get_well_codes(table.column(position))
+
+    profiles = table.remove_column(position).to_pandas()
+    del table
+    # code -1 (missing well) takes the None at the end
+    profiles.insert(
+        position, well_column, np.append(wells.to_numpy(dtype=object), None)[codes]
+    )
+
+    return profiles, (codes, wells)
+
+
+def annotate_profiles(
+    profiles: pd.DataFrame,
+    platemap: pd.DataFrame,
+    join_on: List[str] = ["Metadata_well_position", "Metadata_Well"],
+    well_codes: Optional[Tuple[np.ndarray, pd.Index]] = None,
+) -> pd.DataFrame:
+    """Add the platemap metadata to the single-cell profiles (the same as `pycytominer.annotate`). Single cells in
+    wells that are not in the platemap are dropped, and the single cells are in the order of the platemap wells (the
+    order of a pandas merge with the platemap on the left).
+
+    Args:
+        profiles (pd.DataFrame): single-cell profiles
+        platemap (pd.DataFrame): platemap with the `Metadata_` prefix (from `load_platemap`)
+        join_on (List[str], optional): well column in the platemap and in the profiles. Defaults to
+        ["Metadata_well_position", "Metadata_Well"].
+        well_codes (Optional[Tuple[np.ndarray, pd.Index]], optional): code of the well for each single cell and the
+        well for each code (from `get_well_codes`). Defaults to None (found from the profiles).
+
+    Raises:
+        ValueError: if a well is in the platemap more than once
+
+    Returns:
+        pd.DataFrame: annotated profiles with the metadata columns first
+    """
+    platemap_well, profile_well = join_on
+    platemap_wells = pd.Index(platemap[platemap_well])
+    if platemap_wells.has_duplicates:
+        duplicated_wells = platemap_wells[platemap_wells.duplicated()].unique()
+        raise ValueError(
+            f"The wells {duplicated_wells.tolist()} are in the platemap more than once."
+        )
+
+    if well_codes is None:
+        codes, wells = pd.factorize(profiles[profile_well])
+        wells = pd.Index(wells)
+    else:
+        codes, wells = well_codes
+
+    # platemap row for each well code, with -1 at the end for missing wells and wells that are not in the platemap
+    lookup = np.append(platemap_wells.get_indexer(wells), -1)
+    platemap_rows = lookup[codes]
+
+    # keep the single cells in a platemap well, sorted by the platemap row without changing the order within a well
+    profile_rows = np.flatnonzero(platemap_rows >= 0)
+    profile_rows = profile_rows[np.argsort(platemap_rows[profile_rows], kind="stable")]
+    platemap_rows = platemap_rows[profile_rows]
+
+    if np.array_equal(profile_rows, np.arange(profiles.shape[0])):
+        profiles = profiles.reset_index(drop=True)
+    else:
+        profiles = profiles.take(profile_rows).reset_index(drop=True)
+
+    # platemap columns that are also in the profiles get a suffix (the same as the pycytominer merge)
+    platemap = platemap.drop(columns=platemap_well).rename(
+        columns={
+            column: f"{column}_platemap"
+            for column in platemap.columns
+            if column in profiles.columns
+        }
+    )
+    annotated = pd.concat(
+        [platemap.take(platemap_rows).reset_index(drop=True), profiles], axis=1
+    ).rename(columns=CP_CLEAN_MAPPING)
+
+    meta_features = [
+        column for column in annotated.columns if column.startswith("Metadata_")
+    ]
+    other_features = [
+        column for column in annotated.columns if not column.startswith("Metadata_")
+    ]
+
+    return annotated[meta_features + other_features]
+
+
+def annotate_parquet(
+    profile_path: pathlib.Path,
+    platemap_path: pathlib.Path,
+    join_on: List[str] = ["Metadata_well_position", "Metadata_Well"],
+) -> pd.DataFrame:
+    """Load the single-cell profiles from a parquet file and add the platemap metadata (see `annotate_profiles`), with
+    the wells read once as dictionary codes (see `read_profiles`).
+
+    Args:
+        profile_path (pathlib.Path): path to the parquet file with the single-cell profiles
+        platemap_path (pathlib.Path): path to the platemap CSV file
+        join_on (List[str], optional): well column in the platemap and in the profiles. Defaults to
+        ["Metadata_well_position", "Metadata_Well"].
+
+    Returns:
+        pd.DataFrame: annotated profiles with the metadata columns first
+    """
+    profiles, well_codes = read_profiles(
+        profile_path=profile_path, well_column=join_on[1]
+    )
+
+    return annotate_profiles(
+        profiles=profiles,
+        platemap=load_platemap(platemap_path),
+        join_on=join_on,
+        well_codes=well_codes,
+    )
@@ -0,0 +1,348 @@
+"""
+This collection of functions converts the CellProfiler SQLite outputs into single-cell parquet files without cytotable.
+The Per_Image, Per_Cytoplasm, Per_Cells, and Per_Nuclei tables are joined in SQLite in chunks of image numbers. The
+columns and joins follow the `cellprofiler_sqlite_pycytominer` preset from cytotable with the site and cell count
+columns that 0.convert_cytotable adds to it, where a cytoplasm is only kept if its parent cell and nucleus are found.
+The preset keeps single cells without an image (with empty image columns), which 0.convert_cytotable then removes, so
+here they are removed during the join. The location and cell count columns are moved to the front as metadata, so
+each plate is written as row groups in a single pass. Plates can be converted at the same time in a process pool,
+where the chunk size for each plate is adapted to a memory limit per worker.
+"""
+
+import os
+import pathlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Optional, Tuple
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from cp_memory import BYTES_PER_GB, read_available_memory, read_process_rss
+from extraction_utils import get_sqlite_engine
+
+# compartments joined to the cytoplasm (table name and the cytoplasm column with the parent object number)
+COMPARTMENT_JOINS = {"cells": "Parent_Cells", "nuclei": "Parent_Nuclei"}
+
+# columns that are used as IDs, which are renamed with a "Metadata_" prefix (same as the cytotable preset)
+IDENTIFYING_COLUMNS = (
+    "ImageNumber",
+    "Metadata_Well",
+    "Parent_Cells",
+    "Parent_Nuclei",
+    "Cytoplasm_Parent_Cells",
+    "Cytoplasm_Parent_Nuclei",
+    "Cells_Number_Object_Number",
+    "Nuclei_Number_Object_Number",
+)
+
+# image columns to add to each single cell
+IMAGE_COLUMNS = (
+    "Image_Metadata_Well",
+    "Image_Metadata_Site",
+    "Image_Count_Cells",
+    "Image_Metadata_Plate",
+)
+
+# estimated bytes held in memory for each value (besides the Arrow array) while a chunk is joined, which are the
+# Python objects read from SQLite and the lists of columns
+PYTHON_BYTES_PER_VALUE = 64
+
+# smallest and largest number of single cells in a chunk when the chunk size is adapted to a memory limit
+MIN_CHUNK_SIZE = 500
+MAX_CHUNK_SIZE = 100000
+
+# columns moved to the front of the single cells with a "Metadata_" prefix
+METADATA_COLUMNS = (
+    "Nuclei_Location_Center_X",
+    "Nuclei_Location_Center_Y",
+    "Cells_Location_Center_X",
+    "Cells_Location_Center_Y",
+    "Image_Count_Cells",
+)
+
+
+def rename_column(compartment: str, column: str) -> str:
+    """Rename a column from a table in the same way as the cytotable preset. ID columns are given a "Metadata_"
+    prefix and any other column is given the compartment prefix if it does not have it already.
+
+    Args:
+        compartment (str): name of the compartment or metadata table (e.g., "cells" or "image")
+        column (str): name of the column in the SQLite table
+
+    Returns:
+        str: name of the column in the parquet file
+    """
+    prefix = compartment.capitalize()
+    if column not in IDENTIFYING_COLUMNS:
+        return column if column.startswith(prefix) else f"{prefix}_{column}"
+    if column.startswith(prefix):
+        return f"Metadata_{column}"
+    if column.startswith("Metadata_"):
+        return column
+    # image IDs (e.g., ImageNumber) are shared by all compartments, so they are not given the compartment prefix
+    if "Image" in column or "ObjectNumber" in column or "TableNumber" in column:
+        return f"Metadata_{column}"
+    return f"Metadata_{prefix}_{column}"
+
+
+def arrow_type(declared_type: str) -> pa.DataType:
+    """Find the Arrow type for a column from the type declared in the SQLite table.
+
+    Args:
+        declared_type (str): type of the column in the SQLite table (e.g., "INTEGER", "FLOAT", or "TEXT")
+
+    Returns:
+        pa.DataType: Arrow type for the column
+    """
+    declared_type = declared_type.upper()
+    if "INT" in declared_type:
+        return pa.int64()
+    if any(text_type in declared_type for text_type in ("CHAR", "TEXT", "CLOB")):
+        return pa.string()
+    return pa.float64()
+
+
+def next_image_chunk(
+    image_counts: List[Tuple[int, int]], start: int, chunk_size: int
+) -> int:
+    """Find the end of the next chunk of images in order so the chunk has about `chunk_size` single cells. All single
+    cells from an image are always in the same chunk.
+
+    Args:
+        image_counts (List[Tuple[int, int]]): image numbers with the number of single cells, sorted by image number
+        start (int): index of the first image in the chunk
+        chunk_size (int): number of single cells in each chunk
+
+    Returns:
+        int: index after the last image in the chunk
+    """
+    num_rows = 0
+    for end in range(start, len(image_counts)):
+        num_rows += image_counts[end][1]
+        if num_rows >= chunk_size:
+            return end + 1
+
+    return len(image_counts)
+
+
+def adaptive_chunk_size(bytes_per_row: float, memory_budget: int) -> int:
+    """Find the number of single cells in a chunk that fits in the memory budget.
+
+    Args:
+        bytes_per_row (float): estimated bytes in memory for one single cell while it is joined and written
+        memory_budget (int): bytes available for a chunk
+
+    Returns:
+        int: number of single cells in a chunk (between MIN_CHUNK_SIZE and MAX_CHUNK_SIZE)
+    """
+    return int(min(max(memory_budget // bytes_per_row, MIN_CHUNK_SIZE), MAX_CHUNK_SIZE))
+
+
+def convert_sqlite_to_parquet(
+    sqlite_file: pathlib.Path,
+    output_path: pathlib.Path,
+    chunk_size: int = 5000,
+    memory_limit_gb: Optional[float] = None,
+    image_columns: Tuple[str, ...] = IMAGE_COLUMNS,
+    metadata_columns: Tuple[str, ...] = METADATA_COLUMNS,
+    include_file_names: bool = False,
+) -> int:
+    """Join the compartments from a CellProfiler SQLite file into single cells and write them to a parquet file,
+    with one row group for each chunk of images. The file is written to a temporary path first and moved to the
+    output path once all chunks are written.
+
+    Args:
+        sqlite_file (pathlib.Path): path to the SQLite file for a plate
+        output_path (pathlib.Path): path to the parquet file
+        chunk_size (int, optional): number of single cells to join and write at a time. Defaults to 5000.
+        memory_limit_gb (Optional[float], optional): GB of memory for the process, where the chunk size is adapted
+        to fit the memory left after the first chunk (chunk_size is only used for the first chunk). Defaults to None
+        (the chunk size does not change).
+        image_columns (Tuple[str, ...], optional): columns from Per_Image to add to each single cell, in this order.
+        Defaults to IMAGE_COLUMNS.
+        metadata_columns (Tuple[str, ...], optional): columns to move to the front with a "Metadata_" prefix.
+        Defaults to METADATA_COLUMNS.
+        include_file_names (bool, optional): also add the `Image_FileName_*` columns from Per_Image (newer versions
+        of the cytotable preset add them). Defaults to False.
+
+    Returns:
+        int: number of single cells written
+    """
+    engine = get_sqlite_engine(sqlite_file)
+
+    with engine.connect() as conn:
+        # find the columns (and types) for each table
+        table_columns: Dict[str, List[Tuple[str, str]]] = {}
+        for table in ["image", "cytoplasm"] + list(COMPARTMENT_JOINS):
+            table_columns[table] = [
+                (row[1], row[2])
+                for row in conn.exec_driver_sql(
+                    f'PRAGMA table_info("Per_{table.capitalize()}")'
+                ).fetchall()
+            ]
+
+        # select the columns in the same order as cytotable (image, cytoplasm, cells, then nuclei)
+        image_table_columns = [column for column, _ in table_columns["image"]]
+        selected = [("image", "ImageNumber")] + [
+            ("image", column)
+            for column in image_columns
+            if column in image_table_columns
+        ]
+        if include_file_names:
+            selected += [
+                ("image", column)
+                for column in image_table_columns
+                if column.startswith("Image_FileName_")
+            ]
+        for table in ["cytoplasm"] + list(COMPARTMENT_JOINS):
+            selected += [
+                (table, column)
+                for column, _ in table_columns[table]
+                if column != "ImageNumber"
+            ]
+        declared_types = {
+            (table, column): declared_type
+            for table, columns in table_columns.items()
+            for column, declared_type in columns
+        }
+        names = [rename_column(table, column) for table, column in selected]
+        fields = {
+            name: pa.field(name, arrow_type(declared_types[key]))
+            for name, key in zip(names, selected)
+        }
+
+        # move the metadata columns to the front of the single cells with a "Metadata_" prefix
+        renamed = {column: f"Metadata_{column}" for column in metadata_columns}
+        front = [column for column in metadata_columns if column in fields]
+        order = front + [name for name in names if name not in front]
+        schema = pa.schema(
+            [fields[name].with_name(renamed.get(name, name)) for name in order]
+        )
+        name_positions = {name: position for position, name in enumerate(names)}
+        positions = [name_positions[name] for name in order]
+
+        # the cytoplasm is joined to its parent cells and nuclei (the same rows as the WHERE clause in the preset), and
+        # single cells without an image are removed
+        select_columns = ", ".join(f'{table}."{column}"' for table, column in selected)
+        compartment_joins = " ".join(
+            f'JOIN "Per_{table.capitalize()}" AS {table} ON {table}."ImageNumber" = cytoplasm."ImageNumber" '
+            f'AND {table}."{table.capitalize()}_Number_Object_Number" = cytoplasm."Cytoplasm_{parent}"'
+            for table, parent in COMPARTMENT_JOINS.items()
+        )
+        join_query = (
+            f"SELECT {select_columns} "
+            f'FROM "Per_Cytoplasm" AS cytoplasm {compartment_joins} '
+            f'JOIN "Per_Image" AS image ON image."ImageNumber" = cytoplasm."ImageNumber" '
+            f'WHERE cytoplasm."ImageNumber" BETWEEN ? AND ? '
+            f'ORDER BY cytoplasm."ImageNumber", cytoplasm."Cytoplasm_Number_Object_Number"'
+        )
+
+        image_counts = conn.exec_driver_sql(
+            'SELECT "ImageNumber", COUNT(*) FROM "Per_Cytoplasm" '
+            'WHERE "ImageNumber" IS NOT NULL GROUP BY "ImageNumber" ORDER BY "ImageNumber"'
+        ).fetchall()
+
+        output_path = pathlib.Path(output_path)
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = output_path.with_suffix(".parquet.tmp")
+        if memory_limit_gb is not None:
+            # the memory for a chunk is what is left after the memory already used by the process
+            memory_budget = int(memory_limit_gb * BYTES_PER_GB) - read_process_rss(
+                os.getpid()
+            )
+            chunk_size = adaptive_chunk_size(
+                bytes_per_row=len(schema) * (8 + PYTHON_BYTES_PER_VALUE),
+                memory_budget=memory_budget,
+            )
+
+        # remove the partial file if the conversion fails or is stopped so it is not left next to the outputs
+        try:
+            num_rows = 0
+            start = 0
+            with pq.ParquetWriter(temp_path, schema) as writer:
+                while start < len(image_counts):
+                    end = next_image_chunk(image_counts, start, chunk_size)
+                    rows = conn.exec_driver_sql(
+                        join_query, (image_counts[start][0], image_counts[end - 1][0])
+                    ).fetchall()
+                    start = end
+                    if not rows:
+                        continue
+                    columns = list(zip(*rows))
+                    chunk_table = pa.Table.from_arrays(
+                        [
+                            pa.array(columns[position], type=field.type)
+                            for position, field in zip(positions, schema)
+                        ],
+                        schema=schema,
+                    )
+                    writer.write_table(chunk_table)
+                    num_rows += len(rows)
+
+                    if memory_limit_gb is not None:
+                        # update the chunk size with the size of the single cells that were read (e.g., long file names)
+                        chunk_size = adaptive_chunk_size(
+                            bytes_per_row=chunk_table.nbytes / chunk_table.num_rows
+                            + len(schema) * PYTHON_BYTES_PER_VALUE,
+                            memory_budget=memory_budget,
+                        )
+                    del rows, columns, chunk_table
+            os.replace(temp_path, output_path)
+        except BaseException:
+            temp_path.unlink(missing_ok=True)
+            raise
+
+    return num_rows
+
+
+def convert_plates(
+    sqlite_files: Dict[str, pathlib.Path],
+    output_dir: pathlib.Path,
+    num_workers: Optional[int] = None,
+    memory_limit_gb: float = 4,
+) -> Dict[str, int]:
+    """Convert the SQLite file for each plate to a parquet file at the same time in a process pool. The largest plates
+    are started first, so the total time is close to the time for the largest plate when there are enough workers.
+
+    Args:
+        sqlite_files (Dict[str, pathlib.Path]): dictionary with plate names as keys and paths to the SQLite files as values
+        output_dir (pathlib.Path): directory to save the parquet files as `{plate}_converted.parquet`
+        num_workers (Optional[int], optional): number of worker processes. Defaults to None (one per plate, limited by
+        the number of CPUs and how many memory limits fit in the available memory).
+        memory_limit_gb (float, optional): GB of memory for each worker, which sets the chunk size. Defaults to 4.
+
+    Returns:
+        Dict[str, int]: dictionary with plate names as keys and the number of single cells written as values
+    """
+    if num_workers is None:
+        num_workers = min(
+            len(sqlite_files),
+            os.cpu_count(),
+            read_available_memory() // int(memory_limit_gb * BYTES_PER_GB),
+        )
+    num_workers = max(1, num_workers)
+    print(
+        f"Converting {len(sqlite_files)} plates with {num_workers} workers ({memory_limit_gb} GB each)"
+    )
+
+    plates = sorted(
+        sqlite_files,
+        key=lambda plate: os.path.getsize(sqlite_files[plate]),
+        reverse=True,
+    )
+    num_single_cells = {}
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = {
+            executor.submit(
+                convert_sqlite_to_parquet,
+                sqlite_file=sqlite_files[plate],
+                output_path=pathlib.Path(f"{output_dir}/{plate}_converted.parquet"),
+                memory_limit_gb=memory_limit_gb,
+            ): plate
+            for plate in plates
+        }
+        for future in as_completed(futures):
+            plate = futures[future]
+            num_single_cells[plate] = future.result()
+            print(f"{plate}: {num_single_cells[plate]} single cells were written")
+
+    return num_single_cells
@@ -0,0 +1,187 @@
+"""
+This class records which ranges of image sets have been completed and merged into the output for a plate, so that a
+CellProfiler run that is stopped partway through can be resumed by only processing the missing image sets. The
+manifest also holds the number of image sets and a hash of the images, since the image set numbers only point to the
+same images if neither changed.
+"""
+
+import json
+import os
+import pathlib
+import time
+from typing import List, Optional, Tuple
+
+# name of the manifest file that is saved in the output directory for each plate
+MANIFEST_NAME = "checkpoint_manifest.json"
+
+
+class CheckpointManifest:
+    """
+    Checkpoint manifest for a plate that holds the number of image sets, a hash of the images in the image sets, and
+    the completed (1-indexed and inclusive) ranges of image sets that are already merged into the output for the plate.
+    """
+
+    def __init__(
+        self,
+        path_to_output: pathlib.Path,
+        num_image_sets: int,
+        completed_ranges: Optional[List[Tuple[int, int]]] = None,
+        image_set_hash: Optional[str] = None,
+    ):
+        """
+        Args:
+            path_to_output (pathlib.Path): output directory for the plate where the manifest is saved
+            num_image_sets (int): number of image sets in the plate
+            completed_ranges (Optional[List[Tuple[int, int]]], optional): ranges of image sets that are completed. Defaults to None.
+            image_set_hash (Optional[str], optional): hash of the images in the image sets. Defaults to None.
+        """
+        self.manifest_path = pathlib.Path(f"{path_to_output}/{MANIFEST_NAME}")
+        self.num_image_sets = num_image_sets
+        self.image_set_hash = image_set_hash
+        self.completed_ranges = []
+        for first, last in completed_ranges or []:
+            self._add_range(first, last)
+
+    @classmethod
+    def load(
+        cls,
+        path_to_output: pathlib.Path,
+        num_image_sets: int,
+        image_set_hash: Optional[str] = None,
+    ) -> "CheckpointManifest":
+        """Load the manifest for a plate if it exists, otherwise create a new manifest with no completed image sets. If
+        the number of image sets or the hash of the images changed, the outputs that were already merged are moved to
+        a stale directory next to the output directory (see `move_stale_outputs`) and a new manifest is created.
+
+        Args:
+            path_to_output (pathlib.Path): output directory for the plate
+            num_image_sets (int): number of image sets in the plate
+            image_set_hash (Optional[str], optional): hash of the images in the image sets (see
+            `cp_scheduler.hash_image_sets`). Defaults to None (only the number of image sets is checked).
+
+        Returns:
+            CheckpointManifest: manifest for the plate
+        """
+        manifest_path = pathlib.Path(f"{path_to_output}/{MANIFEST_NAME}")
+        if not manifest_path.exists():
+            return cls(
+                path_to_output=path_to_output,
+                num_image_sets=num_image_sets,
+                image_set_hash=image_set_hash,
+            )
+
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+
+        # the image set numbers do not point to the same images if the image sets changed (e.g., a file list now skips
+        # QC outliers), so the merged outputs would mix rows from the old and new image sets
+        saved_hash = manifest.get("image_set_hash")
+        if manifest["num_image_sets"] != num_image_sets or (
+            image_set_hash is not None
+            and saved_hash is not None
+            and saved_hash != image_set_hash
+        ):
+            stale_dir = move_stale_outputs(path_to_output)
+            print(
+                f"The image sets in {path_to_output} changed ({manifest['num_image_sets']} to {num_image_sets} image sets), so the merged outputs were moved to {stale_dir} and all image sets will be processed again."
+            )
+            return cls(
+                path_to_output=path_to_output,
+                num_image_sets=num_image_sets,
+                image_set_hash=image_set_hash,
+            )
+
+        return cls(
+            path_to_output=path_to_output,
+            num_image_sets=num_image_sets,
+            completed_ranges=manifest["completed_ranges"],
+            image_set_hash=image_set_hash or saved_hash,
+        )
+
+    def _add_range(self, first: int, last: int) -> None:
+        """Add a range of image sets to the completed ranges, combining any ranges that overlap or touch.
+
+        Args:
+            first (int): first image set in the range
+            last (int): last image set in the range
+        """
+        ranges = sorted(self.completed_ranges + [(first, last)])
+        combined_ranges = [ranges[0]]
+        for range_first, range_last in ranges[1:]:
+            previous_first, previous_last = combined_ranges[-1]
+            if range_first <= previous_last + 1:
+                combined_ranges[-1] = (previous_first, max(previous_last, range_last))
+            else:
+                combined_ranges.append((range_first, range_last))
+        self.completed_ranges = combined_ranges
+
+    def add_completed(self, first: int, last: int) -> None:
+        """Record a range of image sets as completed and save the manifest.
+
+        Args:
+            first (int): first image set in the range
+            last (int): last image set in the range
+        """
+        self._add_range(first, last)
+        self.save()
+
+    def missing_ranges(self) -> List[Tuple[int, int]]:
+        """Find the ranges of image sets that have not been completed.
+
+        Returns:
+            List[Tuple[int, int]]: ranges of image sets that still need to be processed
+        """
+        missing = []
+        next_image_set = 1
+        for first, last in self.completed_ranges:
+            if first > next_image_set:
+                missing.append((next_image_set, first - 1))
+            next_image_set = max(next_image_set, last + 1)
+        if next_image_set <= self.num_image_sets:
+            missing.append((next_image_set, self.num_image_sets))
+
+        return missing
+
+    def is_complete(self) -> bool:
+        """Check if all image sets for the plate are completed.
+
+        Returns:
+            bool: True if there are no missing image sets
+        """
+        return not self.missing_ranges()
+
+    def save(self) -> None:
+        """Save the manifest as a JSON file, writing to a temporary file first so the manifest is never left half written."""
+        self.manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.manifest_path.with_suffix(".json.tmp")
+        with open(temp_path, "w") as manifest_file:
+            json.dump(
+                {
+                    "num_image_sets": self.num_image_sets,
+                    "image_set_hash": self.image_set_hash,
+                    "completed_ranges": [list(r) for r in self.completed_ranges],
+                },
+                manifest_file,
+                indent=4,
+            )
+        os.replace(temp_path, self.manifest_path)
+
+
+def move_stale_outputs(path_to_output: pathlib.Path) -> pathlib.Path:
+    """Move the output directory for a plate (merged outputs, batches, and manifest) to a stale directory next to it
+    and create an empty output directory, so outputs from image sets that changed are not merged with the new outputs.
+
+    Args:
+        path_to_output (pathlib.Path): output directory for the plate
+
+    Returns:
+        pathlib.Path: path to the stale directory (e.g., `{path_to_output}_stale_20240101-120000`)
+    """
+    path_to_output = pathlib.Path(path_to_output)
+    stale_dir = path_to_output.with_name(
+        f"{path_to_output.name}_stale_{time.strftime('%Y%m%d-%H%M%S')}"
+    )
+    os.replace(path_to_output, stale_dir)
+    path_to_output.mkdir(parents=True)
+
+    return stale_dir
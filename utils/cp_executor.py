@@ -0,0 +1,394 @@
+"""
+This collection of classes are the executor backends that run CellProfiler jobs for `run_cellprofiler_parallel`.
+The local executor runs the CellProfiler processes on this machine with the asyncio supervisor, and the queue executor
+puts the jobs in a queue directory on a shared filesystem where worker daemons (see `cp_worker.py`) on one or more
+hosts claim and run them.
+"""
+
+import json
+import multiprocessing
+import os
+import pathlib
+import subprocess
+import time
+import uuid
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Tuple
+
+from cp_memory import BYTES_PER_GB, MemoryAdmissionController
+from cp_progress import ImageSetTracker, PlateProgress, print_progress
+from cp_supervisor import run_supervised
+from errors.exceptions import MaxWorkerError
+
+# folders in the queue directory that a job moves through (pending -> claimed/<worker> -> done), where a worker that
+# stops puts its jobs back in pending and leaves a marker in "requeued" so the coordinator reads their logs again. A
+# claimed job file is named `<job ID>.<claim token>.json`, and the file is the lease for the claim: only the worker
+# that still holds the file can finish the job.
+QUEUE_FOLDERS = [
+    "pending",
+    "claimed",
+    "done",
+    "cancelled",
+    "requeued",
+    "workers",
+    "tmp",
+]
+
+# line written to the log file before each retry, which means the image sets from the failed attempt are processed again
+RETRY_HEADER = "[Retry "
+
+
+def write_json_atomic(path: pathlib.Path, data: dict, temp_dir: pathlib.Path) -> None:
+    """Write a JSON file to a temporary file first and then move it into place, so a worker or coordinator reading
+    the queue never sees a half written file.
+
+    Args:
+        path (pathlib.Path): path to the JSON file
+        data (dict): data to write
+        temp_dir (pathlib.Path): directory for the temporary file (must be on the same filesystem as the path)
+    """
+    temp_path = pathlib.Path(f"{temp_dir}/{path.name}.{uuid.uuid4().hex}.tmp")
+    with open(temp_path, "w") as json_file:
+        json.dump(data, json_file, indent=4)
+    os.replace(temp_path, path)
+
+
+def parse_claimed_name(claimed_path: pathlib.Path) -> Tuple[str, str]:
+    """Find the job ID and claim token from the name of a claimed job file (`<job ID>.<claim token>.json`).
+
+    Args:
+        claimed_path (pathlib.Path): path to the claimed job file
+
+    Returns:
+        Tuple[str, str]: job ID and claim token
+    """
+    job_id, claim_token = claimed_path.stem.rsplit(".", 1)
+
+    return job_id, claim_token
+
+
+def make_queue_dirs(queue_dir: pathlib.Path) -> None:
+    """Create the folders for the queue directory if they do not already exist.
+
+    Args:
+        queue_dir (pathlib.Path): path to the queue directory on the shared filesystem
+    """
+    for folder in QUEUE_FOLDERS:
+        pathlib.Path(f"{queue_dir}/{folder}").mkdir(parents=True, exist_ok=True)
+
+
+class CellProfilerExecutor(ABC):
+    """
+    Base class for the executor backends. An executor runs a list of jobs, where each job is a dictionary with the
+    "name" (plate), CellProfiler "command", and "log_file_path", and returns the completed processes in the same order.
+    """
+
+    @abstractmethod
+    def run(
+        self,
+        jobs: List[dict],
+        timeout: Optional[float] = None,
+        max_retries: int = 0,
+        retry_backoff: float = 30,
+        progress_dictionary: Optional[Dict[str, PlateProgress]] = None,
+        report_interval: float = 60,
+    ) -> List[subprocess.CompletedProcess]:
+        """Run all jobs and wait for them to finish.
+
+        Args:
+            jobs (List[dict]): jobs with the "name", CellProfiler "command", and "log_file_path"
+            timeout (Optional[float], optional): number of seconds before a job is stopped. Defaults to None (no timeout).
+            max_retries (int, optional): number of times to retry a job that failed. Defaults to 0.
+            retry_backoff (float, optional): number of seconds to wait before the first retry. Defaults to 30.
+            progress_dictionary (Optional[Dict[str, PlateProgress]], optional): progress per plate. Defaults to None.
+            report_interval (float, optional): number of seconds between each progress report. Defaults to 60.
+
+        Returns:
+            List[subprocess.CompletedProcess]: the completed processes in the same order as the jobs
+        """
+
+
+class LocalExecutor(CellProfilerExecutor):
+    """
+    Runs the CellProfiler processes on this machine with the asyncio supervisor.
+    """
+
+    def __init__(
+        self,
+        max_concurrent: Optional[int] = None,
+        memory_budget_gb: Optional[float] = None,
+        default_job_memory_gb: float = 4,
+        profile_path: Optional[pathlib.Path] = None,
+    ):
+        """
+        Args:
+            max_concurrent (Optional[int], optional): maximum number of CellProfiler processes to run at once.
+            Defaults to None, which uses the number of jobs (up to the number of CPUs on the machine).
+            memory_budget_gb (Optional[float], optional): maximum GB of memory that all running CellProfiler processes
+            can use together. Defaults to None (processes are only limited by max_concurrent).
+            default_job_memory_gb (float, optional): estimated GB for a process when a plate has no peak memory in the
+            memory profile. Defaults to 4.
+            profile_path (Optional[pathlib.Path], optional): path to the memory profile JSON file. Defaults to None.
+        """
+        self.max_concurrent = max_concurrent
+        self.memory_budget_gb = memory_budget_gb
+        self.default_job_memory_gb = default_job_memory_gb
+        self.profile_path = profile_path
+
+    def run(
+        self,
+        jobs: List[dict],
+        timeout: Optional[float] = None,
+        max_retries: int = 0,
+        retry_backoff: float = 30,
+        progress_dictionary: Optional[Dict[str, PlateProgress]] = None,
+        report_interval: float = 60,
+    ) -> List[subprocess.CompletedProcess]:
+        """Run all jobs on this machine (see `CellProfilerExecutor.run`).
+
+        Raises:
+            MaxWorkerError: if the maximum number of concurrent processes exceeds the number of CPUs on the machine
+        """
+        # set the number of processes to run at once as the number of jobs (up to the number of CPUs) if not set
+        max_concurrent = self.max_concurrent
+        if max_concurrent is None:
+            max_concurrent = min(len(jobs), multiprocessing.cpu_count())
+
+        # make sure that the number of workers does not exceed the maximum number of workers for the machine
+        if max_concurrent > multiprocessing.cpu_count():
+            raise MaxWorkerError(
+                "Exception occurred: The number of concurrent processes exceeds the number of CPUs/workers. Please reduce max_concurrent."
+            )
+
+        # only start new processes while the projected memory is under the budget
+        admission = None
+        if self.memory_budget_gb is not None:
+            admission = MemoryAdmissionController(
+                memory_budget=int(self.memory_budget_gb * BYTES_PER_GB),
+                default_job_memory=int(self.default_job_memory_gb * BYTES_PER_GB),
+                profile_path=self.profile_path,
+            )
+
+        return run_supervised(
+            jobs,
+            max_concurrent=max_concurrent,
+            timeout=timeout,
+            max_retries=max_retries,
+            retry_backoff=retry_backoff,
+            progress_dictionary=progress_dictionary,
+            report_interval=report_interval,
+            admission=admission,
+        )
+
+
+class QueueExecutor(CellProfilerExecutor):
+    """
+    Puts the jobs in a queue directory on a shared filesystem and waits for worker daemons to run them. Each worker
+    claims a job by moving its file from "pending" into its own "claimed" folder with a new claim token in the name (a
+    rename is atomic, so only one worker can claim a job) and writes the return code to "done" when the job is
+    finished. Jobs claimed by a worker that stops sending heartbeats are moved back to "pending" so another worker can
+    run them. Moving the claimed file back revokes the claim, so a slow worker that is still running the job stops it
+    and cannot report it as done (see `cp_worker.finish_job`).
+
+    The paths in the plate dictionary, the log files, and the working directory must be on the shared filesystem at
+    the same location for all hosts.
+    """
+
+    def __init__(
+        self,
+        queue_dir: pathlib.Path,
+        poll_interval: float = 5,
+        stale_timeout: float = 120,
+    ):
+        """
+        Args:
+            queue_dir (pathlib.Path): path to the queue directory on the shared filesystem
+            poll_interval (float, optional): number of seconds between each check of the queue. Defaults to 5.
+            stale_timeout (float, optional): number of seconds without a heartbeat before a worker is treated as
+            stopped and its jobs are put back in the queue. Defaults to 120.
+        """
+        self.queue_dir = pathlib.Path(queue_dir).resolve()
+        self.poll_interval = poll_interval
+        self.stale_timeout = stale_timeout
+
+    def _queue_path(self, folder: str, job_id: str) -> pathlib.Path:
+        return pathlib.Path(f"{self.queue_dir}/{folder}/{job_id}.json")
+
+    def _requeue_stale_jobs(self, job_ids: List[str]) -> List[str]:
+        """Move the jobs claimed by workers without a recent heartbeat back to pending.
+
+        Args:
+            job_ids (List[str]): IDs of the jobs from this run that are not done
+
+        Returns:
+            List[str]: IDs of the jobs that were put back in the queue
+        """
+        requeued = []
+        for worker_dir in pathlib.Path(f"{self.queue_dir}/claimed").iterdir():
+            heartbeat = pathlib.Path(f"{self.queue_dir}/workers/{worker_dir.name}")
+            if (
+                heartbeat.exists()
+                and time.time() - heartbeat.stat().st_mtime < self.stale_timeout
+            ):
+                continue
+            for claimed_path in worker_dir.glob("*.json"):
+                job_id = parse_claimed_name(claimed_path)[0]
+                if job_id not in job_ids:
+                    continue
+                try:
+                    # the worker finishes a job by moving the same file, so only one of the two moves succeeds
+                    os.rename(claimed_path, self._queue_path("pending", job_id))
+                except FileNotFoundError:
+                    continue
+                print(
+                    f"Worker {worker_dir.name} stopped sending heartbeats, so {job_id} was put back in the queue."
+                )
+                requeued.append(job_id)
+
+        return requeued
+
+    def _cancel(self, job_ids: List[str]) -> None:
+        """Remove the jobs that are still pending and ask the workers to stop the jobs that are running.
+
+        Args:
+            job_ids (List[str]): IDs of the jobs from this run that are not done
+        """
+        for job_id in job_ids:
+            self._queue_path("pending", job_id).unlink(missing_ok=True)
+            pathlib.Path(f"{self.queue_dir}/cancelled/{job_id}").touch()
+
+    def run(
+        self,
+        jobs: List[dict],
+        timeout: Optional[float] = None,
+        max_retries: int = 0,
+        retry_backoff: float = 30,
+        progress_dictionary: Optional[Dict[str, PlateProgress]] = None,
+        report_interval: float = 60,
+    ) -> List[subprocess.CompletedProcess]:
+        """Put all jobs in the queue and wait for the workers to finish them (see `CellProfilerExecutor.run`). The
+        timeout and retries are applied by the worker that runs each job.
+        """
+        make_queue_dirs(self.queue_dir)
+        progress_dictionary = progress_dictionary or {}
+        temp_dir = pathlib.Path(f"{self.queue_dir}/tmp")
+        run_id = uuid.uuid4().hex[:8]
+
+        # the job ID is unique for the run and ordered so workers claim the jobs in the order they were given
+        job_ids = [
+            f"{run_id}_{index:03d}_{job['name']}" for index, job in enumerate(jobs)
+        ]
+        jobs_by_id = dict(zip(job_ids, jobs))
+        # the log file for each job is read as the worker writes it to track the image sets completed for the plate
+        log_offsets = {}
+        trackers = {}
+
+        for job_id, job in zip(job_ids, jobs):
+            log_file_path = pathlib.Path(job["log_file_path"]).resolve()
+            log_file_path.parent.mkdir(parents=True, exist_ok=True)
+            # remove the log from a previous run so it is not counted in the progress for this run
+            log_file_path.unlink(missing_ok=True)
+            log_offsets[job_id] = 0
+            trackers[job_id] = ImageSetTracker(
+                progress=progress_dictionary.get(job["name"])
+            )
+            write_json_atomic(
+                self._queue_path("pending", job_id),
+                {
+                    "name": job["name"],
+                    "command": [str(argument) for argument in job["command"]],
+                    "log_file_path": str(log_file_path),
+                    # relative paths in the command are from the directory the run was started in
+                    "cwd": str(pathlib.Path.cwd()),
+                    "timeout": timeout,
+                    "max_retries": max_retries,
+                    "retry_backoff": retry_backoff,
+                },
+                temp_dir=temp_dir,
+            )
+        print(f"{len(jobs)} jobs were put in the queue at {self.queue_dir}.")
+
+        results = {}
+        last_report = time.monotonic()
+        try:
+            while len(results) < len(jobs):
+                time.sleep(self.poll_interval)
+                remaining = [job_id for job_id in job_ids if job_id not in results]
+
+                for job_id in remaining:
+                    # a worker that stopped put the job back in the queue, so the next worker writes the log again
+                    requeued_path = pathlib.Path(f"{self.queue_dir}/requeued/{job_id}")
+                    if requeued_path.exists():
+                        requeued_path.unlink()
+                        trackers[job_id].reset()
+                        log_offsets[job_id] = 0
+                    self._read_log(job_id, jobs_by_id[job_id], log_offsets, trackers)
+                    done_path = self._queue_path("done", job_id)
+                    if not done_path.exists():
+                        continue
+                    with open(done_path) as done_file:
+                        done = json.load(done_file)
+                    done_path.unlink()
+                    trackers[job_id].finish(done["returncode"])
+                    results[job_id] = subprocess.CompletedProcess(
+                        args=done["command"], returncode=done["returncode"]
+                    )
+                    print(
+                        f"{done['name']} finished on worker {done['worker']} with a return code of {done['returncode']}."
+                    )
+
+                for job_id in self._requeue_stale_jobs(remaining):
+                    # the next worker will write the log file again from the start
+                    trackers[job_id].reset()
+                    log_offsets[job_id] = 0
+
+                if (
+                    progress_dictionary
+                    and time.monotonic() - last_report >= report_interval
+                ):
+                    print_progress(progress_dictionary)
+                    last_report = time.monotonic()
+        except KeyboardInterrupt:
+            self._cancel([job_id for job_id in job_ids if job_id not in results])
+            print(
+                "The run was cancelled and the workers were asked to stop the CellProfiler processes for this run."
+            )
+            raise
+
+        if progress_dictionary:
+            print_progress(progress_dictionary)
+
+        return [results[job_id] for job_id in job_ids]
+
+    def _read_log(
+        self,
+        job_id: str,
+        job: dict,
+        log_offsets: Dict[str, int],
+        trackers: Dict[str, ImageSetTracker],
+    ) -> None:
+        """Read the new lines in the log file for a job to update the progress for the plate.
+
+        Args:
+            job_id (str): ID of the job
+            job (dict): job with the "log_file_path"
+            log_offsets (Dict[str, int]): number of bytes already read from each log file
+            trackers (Dict[str, ImageSetTracker]): tracker for the image sets completed by each job
+        """
+        log_file_path = pathlib.Path(job["log_file_path"])
+        if not log_file_path.exists():
+            return
+        with open(log_file_path, "rb") as log_file:
+            # a log that is shorter than what was read was written again from the start (the job was requeued)
+            if log_file.seek(0, os.SEEK_END) < log_offsets[job_id]:
+                trackers[job_id].reset()
+                log_offsets[job_id] = 0
+            log_file.seek(log_offsets[job_id])
+            data = log_file.read()
+        # only read complete lines, the rest is read in the next check
+        data = data[: data.rfind(b"\n") + 1]
+        log_offsets[job_id] += len(data)
+        for line in data.decode("utf-8", errors="replace").splitlines():
+            if line.startswith(RETRY_HEADER):
+                trackers[job_id].reset()
+            trackers[job_id].update(line)
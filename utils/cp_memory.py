@@ -0,0 +1,235 @@
+"""
+This collection of functions and classes samples the resident memory (RSS) of running CellProfiler processes from
+/proc and only admits new CellProfiler jobs while the projected memory stays under a memory budget. The peak RSS per
+plate is saved to a memory profile so future runs can use it to estimate how much memory a job will need.
+"""
+
+import asyncio
+import json
+import os
+import pathlib
+from typing import Dict, List, Optional
+
+# number of bytes in a gigabyte to convert the memory budget set by the user
+BYTES_PER_GB = 1024**3
+
+
+def read_process_rss(pid: int) -> int:
+    """Read the resident memory (VmRSS) of one process from /proc/<pid>/status.
+
+    Args:
+        pid (int): process ID
+
+    Returns:
+        int: resident memory in bytes (0 if the process has exited)
+    """
+    try:
+        with open(f"/proc/{pid}/status") as status_file:
+            for line in status_file:
+                if line.startswith("VmRSS:"):
+                    # the value is reported in kB (e.g., "VmRSS:   123456 kB")
+                    return int(line.split()[1]) * 1024
+    except (FileNotFoundError, ProcessLookupError, PermissionError):
+        pass
+
+    return 0
+
+
+def read_available_memory() -> int:
+    """Read the memory available for new processes (MemAvailable) from /proc/meminfo.
+
+    Returns:
+        int: available memory in bytes
+    """
+    with open("/proc/meminfo") as meminfo_file:
+        for line in meminfo_file:
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) * 1024
+
+    raise RuntimeError("MemAvailable was not found in /proc/meminfo")
+
+
+def find_child_pids(pid: int) -> List[int]:
+    """Find the child processes of a process using /proc/<pid>/task/<tid>/children.
+
+    Args:
+        pid (int): process ID
+
+    Returns:
+        List[int]: process IDs of all direct children
+    """
+    child_pids = []
+    task_dir = pathlib.Path(f"/proc/{pid}/task")
+    try:
+        for task in task_dir.iterdir():
+            children = (task / "children").read_text().split()
+            child_pids.extend(int(child) for child in children)
+    except (FileNotFoundError, ProcessLookupError, PermissionError):
+        pass
+
+    return child_pids
+
+
+def read_process_tree_rss(pid: int) -> int:
+    """Read the total resident memory of a process and all of its descendants (e.g., any helper processes that
+    CellProfiler starts).
+
+    Args:
+        pid (int): process ID of the parent process
+
+    Returns:
+        int: total resident memory in bytes
+    """
+    total_rss = 0
+    pids_to_visit = [pid]
+    while pids_to_visit:
+        current_pid = pids_to_visit.pop()
+        total_rss += read_process_rss(current_pid)
+        pids_to_visit.extend(find_child_pids(current_pid))
+
+    return total_rss
+
+
+def load_memory_profile(profile_path: pathlib.Path) -> Dict[str, int]:
+    """Load the peak RSS (in bytes) per plate from a previous run.
+
+    Args:
+        profile_path (pathlib.Path): path to the memory profile JSON file
+
+    Returns:
+        Dict[str, int]: dictionary with plate names as keys and peak RSS in bytes as values
+    """
+    if not pathlib.Path(profile_path).exists():
+        return {}
+    with open(profile_path) as profile_file:
+        return json.load(profile_file)
+
+
+def save_memory_profile(profile_path: pathlib.Path, profile: Dict[str, int]) -> None:
+    """Save the peak RSS (in bytes) per plate, writing to a temporary file first so the profile is never left half written.
+
+    Args:
+        profile_path (pathlib.Path): path to the memory profile JSON file
+        profile (Dict[str, int]): dictionary with plate names as keys and peak RSS in bytes as values
+    """
+    profile_path = pathlib.Path(profile_path)
+    profile_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = profile_path.with_suffix(".json.tmp")
+    with open(temp_path, "w") as profile_file:
+        json.dump(profile, profile_file, indent=4, sort_keys=True)
+    os.replace(temp_path, profile_path)
+
+
+class MemoryAdmissionController:
+    """
+    Admits CellProfiler jobs only while the projected memory of all running jobs plus the new job stays under the
+    memory budget. The projected memory of a running job is the larger of its sampled RSS and its estimate, where the
+    estimate is the peak RSS for the plate from the memory profile (or the default if the plate has no profile yet).
+    """
+
+    def __init__(
+        self,
+        memory_budget: int,
+        default_job_memory: int,
+        profile_path: Optional[pathlib.Path] = None,
+        sample_interval: float = 5,
+    ):
+        """
+        Args:
+            memory_budget (int): maximum number of bytes all running CellProfiler processes can use together
+            default_job_memory (int): estimated bytes for a job when there is no profile for the plate
+            profile_path (Optional[pathlib.Path], optional): path to the memory profile JSON file to read the
+            estimates from and save the peak RSS to. Defaults to None (no profile is saved).
+            sample_interval (float, optional): number of seconds between each memory sample. Defaults to 5.
+        """
+        self.memory_budget = memory_budget
+        self.default_job_memory = default_job_memory
+        self.profile_path = profile_path
+        self.sample_interval = sample_interval
+        self.profile = load_memory_profile(profile_path) if profile_path else {}
+        # running jobs by job ID, holding the plate name, process ID, and current and peak RSS
+        self.running_jobs = {}
+        self._condition = None
+
+    def estimate(self, name: str) -> int:
+        """Estimate the number of bytes a job for a plate will use.
+
+        Args:
+            name (str): plate name for the job
+
+        Returns:
+            int: estimated bytes for the job
+        """
+        return self.profile.get(name, self.default_job_memory)
+
+    def projected_memory(self) -> int:
+        """Calculate the projected memory of all running jobs.
+
+        Returns:
+            int: projected bytes for all running jobs
+        """
+        return sum(
+            max(job["rss"], self.estimate(job["name"]))
+            for job in self.running_jobs.values()
+        )
+
+    async def admit(self, job_id: int, name: str) -> None:
+        """Wait until there is enough memory left in the budget to start the job. A job is always admitted if no other
+        jobs are running so a job that needs more than the budget can still run by itself.
+
+        Args:
+            job_id (int): unique ID for the job
+            name (str): plate name for the job
+        """
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            await self._condition.wait_for(
+                lambda: not self.running_jobs
+                or self.projected_memory() + self.estimate(name) <= self.memory_budget
+            )
+            self.running_jobs[job_id] = {"name": name, "pid": None, "rss": 0, "peak": 0}
+
+    def register(self, job_id: int, pid: int) -> None:
+        """Set the process ID for an admitted job once its CellProfiler process has started.
+
+        Args:
+            job_id (int): unique ID for the job
+            pid (int): process ID of the CellProfiler process
+        """
+        self.running_jobs[job_id]["pid"] = pid
+
+    def sample(self) -> None:
+        """Sample the RSS of every running CellProfiler process and update the peak RSS."""
+        for job in self.running_jobs.values():
+            if job["pid"] is None:
+                continue
+            job["rss"] = read_process_tree_rss(job["pid"])
+            job["peak"] = max(job["peak"], job["rss"])
+
+    async def release(self, job_id: int) -> None:
+        """Remove a finished job, record its peak RSS in the memory profile, and let waiting jobs check the budget again.
+
+        Args:
+            job_id (int): unique ID for the job
+        """
+        job = self.running_jobs.pop(job_id)
+        if job["peak"] > 0:
+            self.profile[job["name"]] = max(
+                self.profile.get(job["name"], 0), job["peak"]
+            )
+            if self.profile_path:
+                save_memory_profile(self.profile_path, self.profile)
+        async with self._condition:
+            self._condition.notify_all()
+
+    async def monitor(self) -> None:
+        """Sample the running processes every interval until cancelled, letting waiting jobs check the budget again
+        after each sample."""
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        while True:
+            self.sample()
+            async with self._condition:
+                self._condition.notify_all()
+            await asyncio.sleep(self.sample_interval)
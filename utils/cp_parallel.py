@@ -1,67 +1,62 @@
 """
-This collection of functions runs CellProfiler in parallel and can convert the results into log files
-for each process.
+This collection of functions runs CellProfiler in parallel (one process per plate) using an executor backend, which
+either runs the processes on this machine with the asyncio supervisor (default) or sends them to worker daemons on
+other hosts through a queue directory on a shared filesystem. The output of each process is streamed into a log file
+for each plate while it runs.
 """
 
-import logging
-import multiprocessing
 import os
 import pathlib
-import subprocess
-from concurrent.futures import ProcessPoolExecutor, Future
-from typing import List
+from typing import Optional
 
-from errors.exceptions import MaxWorkerError
-
-
-def results_to_log(
-    results: List[subprocess.CompletedProcess], log_dir: pathlib.Path, run_name: str
-) -> None:
-    """
-    This function will take the list of subprocess.results from a CellProfiler parallelization run and
-    convert into a log file for each process.
-
-    Args:
-        results (List[subprocess.CompletedProcess]): the outputs from a subprocess.run
-        log_dir (pathlib.Path): directory for log files
-        run_name (str): a given name for the type of CellProfiler run being done on the plates (example: whole image features)
-    """
-    # Access the command (args) and stderr (output) for each CompletedProcess object
-    for result in results:
-        # assign plate name and decode the CellProfiler output to use in log file
-        plate_name = result.args[6].name
-        output_string = result.stderr.decode("utf-8")
-
-        # set log file name as plate name from command
-        log_file_path = pathlib.Path(f"{log_dir}/{plate_name}_{run_name}_run.log")
-        # print output to a log file for each plate to view after the run
-        # set up logging configuration
-        log_format = "[%(asctime)s] [Process ID: %(process)d] %(message)s"
-        logging.basicConfig(
-            filename=log_file_path, level=logging.INFO, format=log_format
-        )
-
-        # log plate name and output string
-        logging.info(f"Plate Name: {plate_name}")
-        logging.info(f"Output String: {output_string}")
+from cp_executor import CellProfilerExecutor, LocalExecutor
+from cp_progress import PlateProgress
+from cp_scheduler import count_image_sets, image_input_arguments
 
 
 def run_cellprofiler_parallel(
     plate_info_dictionary: dict,
     run_name: str,
+    max_concurrent: Optional[int] = None,
+    timeout: Optional[float] = None,
+    max_retries: int = 0,
+    retry_backoff: float = 30,
+    report_interval: float = 60,
+    memory_budget_gb: Optional[float] = None,
+    default_job_memory_gb: float = 4,
+    executor: Optional[CellProfilerExecutor] = None,
 ) -> None:
     """
-    This function utilizes multi-processing to run CellProfiler pipelines in parallel.
+    This function runs CellProfiler pipelines in parallel, with one CellProfiler process per plate.
 
     Args:
-        plate_info_dictionary (dict): dictionary with all paths for CellProfiler to run a pipeline
+        plate_info_dictionary (dict): dictionary with all paths for CellProfiler to run a pipeline, where a plate can
+        include "path_to_file_list" to only process the images in a file list
         run_name (str): a given name for the type of CellProfiler run being done on the plates (example: whole image features)
+        max_concurrent (Optional[int], optional): maximum number of plates to run at once. Defaults to None, which
+        uses the number of plates (up to the number of CPUs on the machine).
+        timeout (Optional[float], optional): number of seconds before a plate is stopped. Defaults to None (no timeout).
+        max_retries (int, optional): number of times to retry a plate that returned an error. Defaults to 0.
+        retry_backoff (float, optional): number of seconds to wait before the first retry (doubles with each retry). Defaults to 30.
+        report_interval (float, optional): number of seconds between each progress report. Defaults to 60.
+        memory_budget_gb (Optional[float], optional): maximum GB of memory that all running CellProfiler processes can
+        use together, where new processes only start while the projected memory is under the budget. Defaults to None
+        (processes are only limited by the number of CPUs).
+        default_job_memory_gb (float, optional): estimated GB for a process when a plate has no peak memory recorded
+        from a previous run in the memory profile. Defaults to 4.
+        executor (Optional[CellProfilerExecutor], optional): executor backend that runs the CellProfiler processes
+        (e.g., a QueueExecutor to run plates on worker daemons across hosts). Defaults to None, which runs the
+        processes on this machine with a LocalExecutor using max_concurrent and memory_budget_gb (these are set on
+        each worker daemon when using a QueueExecutor).
 
     Raises:
         FileNotFoundError: if paths to pipeline and images do not exist
+        MaxWorkerError: if the maximum number of concurrent plates exceeds the number of CPUs on the machine (local executor)
     """
-    # create a list of commands for each plate with their respective log file
-    commands = []
+    # create a list of jobs for each plate with their respective log file
+    jobs = []
+    # track the progress for each plate using the number of image sets in the images directory
+    progress_dictionary = {}
 
     # make logs directory
     log_dir = pathlib.Path("./logs")
@@ -95,48 +90,53 @@ def run_cellprofiler_parallel(
             path_to_pipeline,
             "-o",
             path_to_output,
-            "-i",
-            path_to_images,
+            *image_input_arguments(info),
         ]
-        # creates a list of commands
-        commands.append(command)
-
-    # set the number of CPUs/workers as the number of commands
-    num_processes = len(commands)
-
-    # make sure that the number of workers does not exceed the maximum number of workers for the machine
-    if num_processes > multiprocessing.cpu_count():
-        raise MaxWorkerError(
-            "Exception occurred: The number of commands exceeds the number of CPUs/workers. Please reduce the number of commands."
+        # set plate name from the output directory and a log file for each plate
+        plate_name = pathlib.Path(path_to_output).name
+        jobs.append(
+            {
+                "name": plate_name,
+                "command": command,
+                "log_file_path": pathlib.Path(
+                    f"{log_dir}/{plate_name}_{run_name}_run.log"
+                ),
+            }
+        )
+        progress_dictionary[plate_name] = PlateProgress(
+            plate=plate_name,
+            total_image_sets=count_image_sets(
+                path_to_images, path_to_file_list=info.get("path_to_file_list")
+            ),
         )
 
-    # set parallelization executer to the number of commands
-    executor = ProcessPoolExecutor(max_workers=num_processes)
-
-    # creates a list of futures that are each CellProfiler process for each plate
-    futures: List[Future] = [
-        executor.submit(
-            subprocess.run,
-            args=command,
-            capture_output=True,
+    # run the plates on this machine if no executor is given, using the peak memory per plate recorded in the
+    # memory profile from previous runs as the estimate for each process when there is a memory budget
+    if executor is None:
+        executor = LocalExecutor(
+            max_concurrent=max_concurrent,
+            memory_budget_gb=memory_budget_gb,
+            default_job_memory_gb=default_job_memory_gb,
+            profile_path=pathlib.Path(f"{log_dir}/{run_name}_memory_profile.json"),
         )
-        for command in commands
-    ]
 
-    # the list of CompletedProcesses holds all the information from the CellProfiler run
-    results: List[subprocess.CompletedProcess] = [future.result() for future in futures]
+    results = executor.run(
+        jobs,
+        timeout=timeout,
+        max_retries=max_retries,
+        retry_backoff=retry_backoff,
+        progress_dictionary=progress_dictionary,
+        report_interval=report_interval,
+    )
 
     print("All processes have been completed!")
 
-    # for each process, confirm that the process completed successfully and return a log file
-    for result in results:
-        plate_name = result.args[6].name
-        # convert the results into log files
-        results_to_log(results=results, log_dir=log_dir, run_name=run_name)
-        if result.returncode == 1:
+    # for each process, confirm that the process completed successfully
+    for job, result in zip(jobs, results):
+        if result.returncode != 0:
             print(
-                f"A return code of {result.returncode} was returned for {plate_name}, which means there was an error in the CellProfiler run."
+                f"A return code of {result.returncode} was returned for {job['name']}, which means there was an error in the CellProfiler run."
             )
 
-    # to avoid having multiple print statements due to for loop, confirmation that logs are converted is printed here
-    print("All results have been converted to log files!")
+    # to avoid having multiple print statements due to for loop, confirmation that logs are written is printed here
+    print("All outputs have been written to log files!")
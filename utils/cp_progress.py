@@ -0,0 +1,128 @@
+"""
+This collection of classes parses the per image set lines that CellProfiler outputs while running to track live
+progress (image sets done, rate, and ETA) for each plate.
+"""
+
+import re
+import threading
+import time
+from typing import Dict, Optional
+
+# CellProfiler outputs a line per module for each image set (e.g., "... Image # 12, module IdentifyPrimaryObjects # 5: ...")
+PROGRESS_REGEX = re.compile(r"Image # (?P<ImageNumber>\d+), module (?P<Module>\S+)")
+
+
+class PlateProgress:
+    """
+    Holds the live progress of the CellProfiler run(s) for one plate. Multiple processes (e.g., batches of image sets)
+    can update the same plate progress.
+    """
+
+    def __init__(self, plate: str, total_image_sets: Optional[int] = None):
+        """
+        Args:
+            plate (str): name of the plate
+            total_image_sets (Optional[int], optional): number of image sets to process for the plate, which is
+            needed to calculate the ETA. Defaults to None.
+        """
+        self.plate = plate
+        self.total_image_sets = total_image_sets
+        self.completed_image_sets = 0
+        self.start_time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add_completed(self, num_image_sets: int = 1) -> None:
+        """Add to the number of completed image sets for the plate.
+
+        Args:
+            num_image_sets (int, optional): number of image sets that were completed. Defaults to 1.
+        """
+        with self._lock:
+            self.completed_image_sets += num_image_sets
+
+    @property
+    def rate(self) -> float:
+        """float: number of image sets completed per minute"""
+        elapsed_minutes = (time.monotonic() - self.start_time) / 60
+        if elapsed_minutes == 0:
+            return 0.0
+        return self.completed_image_sets / elapsed_minutes
+
+    @property
+    def eta(self) -> Optional[float]:
+        """Optional[float]: estimated minutes left for the plate (None if the total or rate is not known yet)"""
+        if self.total_image_sets is None or self.rate == 0:
+            return None
+        return max(self.total_image_sets - self.completed_image_sets, 0) / self.rate
+
+    def summary(self) -> str:
+        """Create a one line summary of the progress for the plate.
+
+        Returns:
+            str: summary with image sets done, rate, and ETA
+        """
+        total = "?" if self.total_image_sets is None else self.total_image_sets
+        eta = "unknown" if self.eta is None else f"{self.eta:.1f} min"
+        return f"{self.plate}: {self.completed_image_sets}/{total} image sets done ({self.rate:.2f} image sets/min, ETA {eta})"
+
+
+class ImageSetTracker:
+    """
+    Parses the lines output by one CellProfiler process to count the image sets it has completed, updating the
+    progress for the plate as it goes.
+    """
+
+    def __init__(self, progress: Optional[PlateProgress] = None):
+        """
+        Args:
+            progress (Optional[PlateProgress], optional): progress to update when an image set is completed. Defaults to None.
+        """
+        self.progress = progress
+        self.completed_image_sets = 0
+        # track the image set being processed as a new image number means the previous image set is done
+        self.current_image_number = None
+
+    def _add_completed(self, num_image_sets: int) -> None:
+        self.completed_image_sets += num_image_sets
+        if self.progress is not None:
+            self.progress.add_completed(num_image_sets)
+
+    def update(self, line: str) -> None:
+        """Update the number of completed image sets from a line of CellProfiler output.
+
+        Args:
+            line (str): line output by the CellProfiler process
+        """
+        match = PROGRESS_REGEX.search(line)
+        if match is None:
+            return
+        image_number = int(match.group("ImageNumber"))
+        if image_number != self.current_image_number:
+            if self.current_image_number is not None:
+                self._add_completed(1)
+            self.current_image_number = image_number
+
+    def finish(self, returncode: int) -> None:
+        """Count the last image set once the process has finished, which is only done if there was no error.
+
+        Args:
+            returncode (int): return code from the CellProfiler process
+        """
+        if returncode == 0 and self.current_image_number is not None:
+            self._add_completed(1)
+        self.current_image_number = None
+
+    def reset(self) -> None:
+        """Remove the image sets counted by this process from the plate progress (e.g., before the process is retried)."""
+        self._add_completed(-self.completed_image_sets)
+        self.current_image_number = None
+
+
+def print_progress(progress_dictionary: Dict[str, PlateProgress]) -> None:
+    """Print a summary of the progress for each plate.
+
+    Args:
+        progress_dictionary (Dict[str, PlateProgress]): dictionary with plate names as keys and plate progress as values
+    """
+    for progress in progress_dictionary.values():
+        print(progress.summary())
@@ -0,0 +1,219 @@
+"""
+This harness checks the `QueueExecutor` and the worker daemons (`cp_worker.py`) on one machine, using local worker
+processes as stand-ins for hosts and short Python commands as stand-ins for CellProfiler. While the jobs run, one
+worker is killed (a host that goes down) and another is paused past the heartbeat timeout (a slow but live host), and
+the harness checks that every job is finished once with a return code of 0 and that the paused worker does not report
+the job that was put back in the queue. Run it from any folder, for example:
+
+    python ../utils/cp_queue_harness.py --num-workers 3 --num-jobs 6
+"""
+
+import argparse
+import os
+import pathlib
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import List
+
+from cp_executor import QueueExecutor
+
+# worker daemon that is started for each stand-in host
+WORKER_SCRIPT = pathlib.Path(__file__).resolve().parent / "cp_worker.py"
+
+
+def wait_for_claim(
+    queue_dir: pathlib.Path, worker_name: str, timeout: float
+) -> pathlib.Path:
+    """Wait until a worker has claimed a job.
+
+    Args:
+        queue_dir (pathlib.Path): path to the queue directory
+        worker_name (str): name of the worker
+        timeout (float): number of seconds to wait
+
+    Raises:
+        TimeoutError: if the worker has not claimed a job before the timeout
+
+    Returns:
+        pathlib.Path: path to the claimed job file
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        claimed = sorted(
+            pathlib.Path(f"{queue_dir}/claimed/{worker_name}").glob("*.json")
+        )
+        if claimed:
+            return claimed[0]
+        time.sleep(0.1)
+
+    raise TimeoutError(
+        f"Worker {worker_name} did not claim a job in {timeout} seconds."
+    )
+
+
+def start_workers(
+    queue_dir: pathlib.Path, num_workers: int, poll_interval: float
+) -> List[subprocess.Popen]:
+    """Start the worker daemons as local processes.
+
+    Args:
+        queue_dir (pathlib.Path): path to the queue directory
+        num_workers (int): number of workers to start
+        poll_interval (float): number of seconds between each check of the queue
+
+    Returns:
+        List[subprocess.Popen]: worker processes, where worker i is named `worker_{i}`
+    """
+    return [
+        subprocess.Popen(
+            [
+                sys.executable,
+                str(WORKER_SCRIPT),
+                "--queue-dir",
+                str(queue_dir),
+                "--name",
+                f"worker_{index}",
+                "--poll-interval",
+                str(poll_interval),
+            ]
+        )
+        for index in range(num_workers)
+    ]
+
+
+def run_harness(
+    num_workers: int = 3,
+    num_jobs: int = 6,
+    job_seconds: float = 2,
+    stale_timeout: float = 3,
+    poll_interval: float = 0.5,
+) -> None:
+    """Run the jobs through the queue with local workers, kill one worker and pause another while they hold a job,
+    and check the results.
+
+    Args:
+        num_workers (int, optional): number of workers (at least 3, so one is left after the faults). Defaults to 3.
+        num_jobs (int, optional): number of jobs. Defaults to 6.
+        job_seconds (float, optional): number of seconds each job runs for. Defaults to 2.
+        stale_timeout (float, optional): number of seconds without a heartbeat before the jobs of a worker are put
+        back in the queue. Defaults to 3.
+        poll_interval (float, optional): number of seconds between each check of the queue for the coordinator and
+        the workers. Defaults to 0.5.
+
+    Raises:
+        ValueError: if there are less than 3 workers
+        AssertionError: if a job did not finish once with a return code of 0
+    """
+    if num_workers < 3:
+        raise ValueError("The harness needs at least 3 workers.")
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        queue_dir = pathlib.Path(f"{work_dir}/cp_queue")
+        executor = QueueExecutor(
+            queue_dir=queue_dir,
+            poll_interval=poll_interval,
+            stale_timeout=stale_timeout,
+        )
+        jobs = [
+            {
+                "name": f"plate_{index}",
+                "command": [
+                    sys.executable,
+                    "-c",
+                    f"import time; time.sleep({job_seconds})",
+                ],
+                "log_file_path": f"{work_dir}/logs/plate_{index}.log",
+            }
+            for index in range(num_jobs)
+        ]
+
+        results = {}
+        coordinator = threading.Thread(
+            target=lambda: results.update(completed=executor.run(jobs))
+        )
+        coordinator.start()
+        workers = start_workers(queue_dir, num_workers, poll_interval)
+
+        try:
+            # a host that goes down stops without putting its job back in the queue
+            wait_for_claim(queue_dir, "worker_0", timeout=30)
+            workers[0].kill()
+            print("Killed worker_0 while it held a job.")
+
+            # a slow but live host misses its heartbeats, so its job is put back in the queue while it still runs
+            claimed_path = wait_for_claim(queue_dir, "worker_1", timeout=30)
+            os.kill(workers[1].pid, signal.SIGSTOP)
+            print("Paused worker_1 while it held a job.")
+            deadline = time.monotonic() + stale_timeout + 30
+            while claimed_path.exists() and time.monotonic() < deadline:
+                time.sleep(poll_interval)
+            os.kill(workers[1].pid, signal.SIGCONT)
+            print("Resumed worker_1 after its job was put back in the queue.")
+
+            coordinator.join(timeout=num_jobs * job_seconds + 60)
+            if coordinator.is_alive():
+                raise AssertionError("Not all jobs were finished by the workers.")
+
+            # give the resumed worker time to finish its copy of the job and try to report it
+            time.sleep(job_seconds + 4 * poll_interval)
+        finally:
+            for worker in workers:
+                if worker.poll() is None:
+                    worker.send_signal(signal.SIGTERM)
+            for worker in workers:
+                worker.wait(timeout=30)
+
+        completed = results.get("completed", [])
+        if len(completed) != num_jobs or any(
+            result.returncode != 0 for result in completed
+        ):
+            raise AssertionError(
+                f"Expected {num_jobs} jobs with a return code of 0, got {[result.returncode for result in completed]}."
+            )
+        leftover = [
+            path.relative_to(queue_dir)
+            for folder in ["pending", "done", "claimed"]
+            for path in pathlib.Path(f"{queue_dir}/{folder}").rglob("*.json")
+        ]
+        if leftover:
+            raise AssertionError(
+                f"Jobs were left in the queue or reported twice: {leftover}"
+            )
+
+    print(
+        f"All {num_jobs} jobs finished once on {num_workers} workers with one killed and one paused worker."
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check the CellProfiler job queue with local worker daemons."
+    )
+    parser.add_argument(
+        "--num-workers", type=int, default=3, help="number of local workers"
+    )
+    parser.add_argument("--num-jobs", type=int, default=6, help="number of jobs")
+    parser.add_argument(
+        "--job-seconds",
+        type=float,
+        default=2,
+        help="number of seconds each job runs for",
+    )
+    parser.add_argument(
+        "--stale-timeout",
+        type=float,
+        default=3,
+        help="number of seconds without a heartbeat before a worker is treated as stopped",
+    )
+    args = parser.parse_args()
+
+    run_harness(
+        num_workers=args.num_workers,
+        num_jobs=args.num_jobs,
+        job_seconds=args.job_seconds,
+        stale_timeout=args.stale_timeout,
+    )
@@ -0,0 +1,632 @@
+"""
+This collection of functions splits the image sets for each plate into batches and runs CellProfiler on those batches
+using a fixed number of workers that is shared across all plates. When all batches for a plate are complete, the
+outputs from each batch are merged back into one output for the plate.
+"""
+
+import csv
+import hashlib
+import multiprocessing
+import os
+import pathlib
+import shutil
+import sqlite3
+import subprocess
+from functools import partial
+from typing import Dict, List, Optional, Tuple
+
+from cp_checkpoint import CheckpointManifest
+from cp_memory import BYTES_PER_GB, MemoryAdmissionController
+from cp_progress import PlateProgress
+from cp_supervisor import run_supervised
+from errors.exceptions import MaxWorkerError
+from image_index import IMAGE_EXTENSIONS, IMAGE_SET_REGEX
+
+# tables and files with experiment level information are the same for every batch so they are only kept once
+EXPERIMENT_PREFIX = "Experiment"
+
+
+def find_image_files(
+    path_to_images: pathlib.Path, path_to_file_list: Optional[pathlib.Path] = None
+) -> List[Tuple[str, str, str]]:
+    """Find the image files in a plate directory (or file list) with the well and site (FOV) of each image.
+
+    Args:
+        path_to_images (pathlib.Path): path to the directory with images for a plate
+        path_to_file_list (Optional[pathlib.Path], optional): path to a file list with one image path per line, which
+        is used instead of the directory if given. Defaults to None.
+
+    Returns:
+        List[Tuple[str, str, str]]: sorted path (relative to the image directory if not from a file list), well, and
+        site of each image
+    """
+    if path_to_file_list is not None:
+        file_paths = [
+            line.strip()
+            for line in pathlib.Path(path_to_file_list).read_text().splitlines()
+            if line.strip()
+        ]
+    else:
+        file_paths = [
+            str(file_path.relative_to(path_to_images))
+            for file_path in pathlib.Path(path_to_images).rglob("*")
+        ]
+
+    image_files = []
+    for file_path in file_paths:
+        file_path = pathlib.Path(file_path)
+        if file_path.suffix.lower() not in IMAGE_EXTENSIONS:
+            continue
+        match = IMAGE_SET_REGEX.search(file_path.name)
+        if match:
+            image_files.append(
+                (file_path.as_posix(), match.group("Well"), match.group("Site"))
+            )
+
+    return sorted(image_files)
+
+
+def count_image_sets(
+    path_to_images: pathlib.Path, path_to_file_list: Optional[pathlib.Path] = None
+) -> int:
+    """Count the number of image sets in a plate directory (or file list), where an image set is all of the channels
+    for one well and site (FOV).
+
+    Args:
+        path_to_images (pathlib.Path): path to the directory with images for a plate
+        path_to_file_list (Optional[pathlib.Path], optional): path to a file list with one image path per line, which
+        is counted instead of the directory if given. Defaults to None.
+
+    Returns:
+        int: number of image sets (unique well and site combinations) in the directory or file list
+    """
+    image_files = find_image_files(path_to_images, path_to_file_list=path_to_file_list)
+
+    return len({(well, site) for _, well, site in image_files})
+
+
+def hash_image_sets(
+    path_to_images: pathlib.Path, path_to_file_list: Optional[pathlib.Path] = None
+) -> str:
+    """Hash the image files in a plate directory (or file list), which changes if any image is added, removed, or
+    renamed even when the number of image sets stays the same.
+
+    Args:
+        path_to_images (pathlib.Path): path to the directory with images for a plate
+        path_to_file_list (Optional[pathlib.Path], optional): path to a file list with one image path per line, which
+        is hashed instead of the directory if given. Defaults to None.
+
+    Returns:
+        str: SHA-256 hash of the sorted image paths
+    """
+    image_hash = hashlib.sha256()
+    for file_path, _, _ in find_image_files(
+        path_to_images, path_to_file_list=path_to_file_list
+    ):
+        image_hash.update(f"{file_path}\n".encode("utf-8"))
+
+    return image_hash.hexdigest()
+
+
+def image_input_arguments(info: dict) -> List[str]:
+    """Create the CellProfiler arguments for the images of a plate, which is the file list if the plate has one
+    (e.g., to skip image sets flagged by whole image QC) or otherwise the image directory.
+
+    Args:
+        info (dict): plate info with "path_to_images" and an optional "path_to_file_list"
+
+    Returns:
+        List[str]: CellProfiler arguments for the images
+    """
+    if info.get("path_to_file_list") is not None:
+        return ["--file-list", str(info["path_to_file_list"])]
+    return ["-i", str(info["path_to_images"])]
+
+
+def split_image_sets(
+    num_image_sets: int,
+    batch_size: int,
+    image_set_ranges: Optional[List[Tuple[int, int]]] = None,
+) -> List[Tuple[int, int]]:
+    """Split the image sets for a plate into batches of first and last image set numbers to use with the
+    CellProfiler `-f` and `-l` flags (both are 1-indexed and inclusive).
+
+    Args:
+        num_image_sets (int): number of image sets in the plate
+        batch_size (int): maximum number of image sets per batch
+        image_set_ranges (Optional[List[Tuple[int, int]]], optional): only split these ranges of image sets (e.g., the
+        missing ranges when resuming a run). Defaults to None, which splits all image sets in the plate.
+
+    Returns:
+        List[Tuple[int, int]]: list of (first, last) image set numbers for each batch
+    """
+    if batch_size < 1:
+        raise ValueError("The batch size must be at least 1 image set.")
+
+    if image_set_ranges is None:
+        image_set_ranges = [(1, num_image_sets)]
+
+    return [
+        (first, min(first + batch_size - 1, range_last))
+        for range_first, range_last in image_set_ranges
+        for first in range(range_first, range_last + 1, batch_size)
+    ]
+
+
+def merge_sqlite_files(
+    batch_file: pathlib.Path,
+    merged_file: pathlib.Path,
+    image_set_range: Optional[Tuple[int, int]] = None,
+) -> None:
+    """Append all rows from the tables in a batch SQLite file into the merged SQLite file for the plate. If the merged
+    file does not exist yet, the batch file becomes the merged file.
+
+    Args:
+        batch_file (pathlib.Path): path to the SQLite file from one batch
+        merged_file (pathlib.Path): path to the SQLite file that holds all batches for a plate
+        image_set_range (Optional[Tuple[int, int]], optional): first and last image set in the batch, where any rows
+        already in the merged file for these image sets are replaced so merging the same batch again (e.g., when
+        resuming a run) does not duplicate rows. Defaults to None.
+    """
+    if not merged_file.exists():
+        merged_file.parent.mkdir(parents=True, exist_ok=True)
+        shutil.move(str(batch_file), str(merged_file))
+        return
+
+    conn = sqlite3.connect(str(merged_file))
+    try:
+        conn.execute("ATTACH DATABASE ? AS batch", (str(batch_file),))
+        batch_tables = conn.execute(
+            "SELECT name, sql FROM batch.sqlite_master WHERE type = 'table'"
+        ).fetchall()
+        merged_tables = {
+            name
+            for (name,) in conn.execute(
+                "SELECT name FROM main.sqlite_master WHERE type = 'table'"
+            )
+        }
+        for table_name, create_sql in batch_tables:
+            if table_name not in merged_tables:
+                conn.execute(create_sql)
+            elif table_name.startswith(EXPERIMENT_PREFIX):
+                continue
+            # ImageNumber is kept from the original image set numbers so rows from each batch do not collide
+            merged_columns = [
+                column[1]
+                for column in conn.execute(f'PRAGMA main.table_info("{table_name}")')
+            ]
+            if image_set_range is not None and "ImageNumber" in merged_columns:
+                conn.execute(
+                    f'DELETE FROM main."{table_name}" WHERE ImageNumber BETWEEN ? AND ?',
+                    image_set_range,
+                )
+            conn.execute(
+                f'INSERT INTO main."{table_name}" SELECT * FROM batch."{table_name}"'
+            )
+        conn.commit()
+        conn.execute("DETACH DATABASE batch")
+    finally:
+        conn.close()
+
+
+def merged_ranges_path(merged_file: pathlib.Path) -> pathlib.Path:
+    """Find the path to the file next to a merged CSV file that lists the ranges of image sets merged into it.
+
+    Args:
+        merged_file (pathlib.Path): path to the CSV file that holds all batches for a plate
+
+    Returns:
+        pathlib.Path: path to the ranges file (e.g., `.Image.csv.image_sets` for `Image.csv`)
+    """
+    return merged_file.with_name(f".{merged_file.name}.image_sets")
+
+
+def record_merged_range(
+    merged_file: pathlib.Path, image_set_range: Optional[Tuple[int, int]]
+) -> bool:
+    """Record the range of image sets that is about to be merged into a CSV file, one `first,last` line per range.
+
+    Args:
+        merged_file (pathlib.Path): path to the CSV file that holds all batches for a plate
+        image_set_range (Optional[Tuple[int, int]]): first and last image set in the batch
+
+    Returns:
+        bool: True if the range overlaps a range that was already merged (or recorded before the merge stopped), so
+        rows for those image sets can already be in the merged file
+    """
+    if image_set_range is None:
+        return False
+    first, last = image_set_range
+    ranges_path = merged_ranges_path(merged_file)
+    overlaps = False
+    if ranges_path.exists():
+        for line in ranges_path.read_text().splitlines():
+            merged_first, merged_last = (int(value) for value in line.split(","))
+            if merged_first <= last and first <= merged_last:
+                overlaps = True
+                break
+    with open(ranges_path, "a") as ranges_file:
+        ranges_file.write(f"{first},{last}\n")
+
+    return overlaps
+
+
+def merge_csv_files(
+    batch_file: pathlib.Path,
+    merged_file: pathlib.Path,
+    image_set_range: Optional[Tuple[int, int]] = None,
+) -> None:
+    """Add the rows from a batch CSV file (e.g., Image.csv from ExportToSpreadsheet) to the merged CSV file for the
+    plate, only keeping the header from the first batch. The batch rows are appended to the merged file, so rows are in
+    the order the batches were merged and merging a batch does not read the rows already merged. The merged file is
+    only rewritten (to a temporary file that is moved to the merged path) when the image sets in the batch were
+    already merged before, e.g., when a batch is merged again after a run is resumed.
+
+    Args:
+        batch_file (pathlib.Path): path to the CSV file from one batch
+        merged_file (pathlib.Path): path to the CSV file that holds all batches for a plate
+        image_set_range (Optional[Tuple[int, int]], optional): first and last image set in the batch, where any rows
+        already in the merged file for these image sets are replaced so merging the same batch again (e.g., when
+        resuming a run) does not duplicate rows. Defaults to None.
+    """
+    if batch_file.name.startswith(EXPERIMENT_PREFIX) and merged_file.exists():
+        return
+
+    merged_file.parent.mkdir(parents=True, exist_ok=True)
+    overlaps = record_merged_range(merged_file, image_set_range)
+    if not merged_file.exists():
+        shutil.move(str(batch_file), str(merged_file))
+        return
+
+    with open(batch_file, newline="") as batch_csv:
+        reader = csv.reader(batch_csv)
+        # skip header since it is already in the merged file
+        next(reader, None)
+        batch_rows = list(reader)
+
+    if not overlaps:
+        merged_size = merged_file.stat().st_size
+        try:
+            with open(merged_file, "a", newline="") as merged_csv:
+                csv.writer(merged_csv).writerows(batch_rows)
+        except BaseException:
+            # remove any rows that were partly appended
+            with open(merged_file, "r+") as merged_csv:
+                merged_csv.truncate(merged_size)
+            raise
+        return
+
+    with open(merged_file, newline="") as merged_csv:
+        reader = csv.reader(merged_csv)
+        header = next(reader, [])
+        rows = list(reader)
+
+    if "ImageNumber" in header and image_set_range is not None:
+        # ImageNumber is kept from the original image set numbers, so rows for the image sets in the batch are
+        # replaced, along with any row that was cut off by a merge that stopped partway through
+        column = header.index("ImageNumber")
+        first, last = image_set_range
+        rows = [
+            row
+            for row in rows
+            if len(row) == len(header) and not first <= int(row[column]) <= last
+        ]
+
+    temp_path = merged_file.with_name(f".{merged_file.name}.tmp")
+    try:
+        with open(temp_path, "w", newline="") as temp_csv:
+            writer = csv.writer(temp_csv)
+            writer.writerow(header)
+            writer.writerows(rows + batch_rows)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+    os.replace(temp_path, merged_file)
+
+
+def merge_batch_output(
+    batch_output_dir: pathlib.Path,
+    path_to_output: pathlib.Path,
+    image_set_range: Optional[Tuple[int, int]] = None,
+) -> None:
+    """Merge the outputs from a batch into the plate output directory. SQLite and CSV outputs are
+    concatenated and any other outputs (e.g., corrected images) are moved into the same relative path.
+
+    Args:
+        batch_output_dir (pathlib.Path): output directory for the batch
+        path_to_output (pathlib.Path): output directory for the plate
+        image_set_range (Optional[Tuple[int, int]], optional): first and last image set in the batch. Defaults to None.
+    """
+    for batch_file in sorted(pathlib.Path(batch_output_dir).rglob("*")):
+        if not batch_file.is_file():
+            continue
+        merged_file = pathlib.Path(path_to_output) / batch_file.relative_to(
+            batch_output_dir
+        )
+        if batch_file.suffix == ".sqlite":
+            merge_sqlite_files(
+                batch_file=batch_file,
+                merged_file=merged_file,
+                image_set_range=image_set_range,
+            )
+        elif batch_file.suffix == ".csv":
+            merge_csv_files(
+                batch_file=batch_file,
+                merged_file=merged_file,
+                image_set_range=image_set_range,
+            )
+        else:
+            merged_file.parent.mkdir(parents=True, exist_ok=True)
+            shutil.move(str(batch_file), str(merged_file))
+    # remove the batch directory once all of its outputs are merged
+    shutil.rmtree(batch_output_dir)
+
+
+def prepare_batch_output(batch_output: pathlib.Path) -> None:
+    """Create an empty output directory for a batch, removing any outputs left from a batch that did not finish.
+
+    Args:
+        batch_output (pathlib.Path): output directory for the batch
+    """
+    shutil.rmtree(batch_output, ignore_errors=True)
+    batch_output.mkdir(parents=True)
+
+
+def create_batch_jobs(
+    plate_info_dictionary: dict, batch_size: int
+) -> Dict[str, List[dict]]:
+    """Create the CellProfiler command and output directory for every batch of image sets in each plate. Image sets
+    that are already recorded as completed in the checkpoint manifest for a plate are skipped.
+
+    Args:
+        plate_info_dictionary (dict): dictionary with all paths for CellProfiler to run a pipeline, where a plate can
+        include "num_image_sets" to avoid counting the image sets from the image directory and "path_to_file_list" to
+        only process the images in a file list
+        batch_size (int): maximum number of image sets per batch
+
+    Raises:
+        FileNotFoundError: if paths to pipeline and images do not exist
+
+    Returns:
+        Dict[str, List[dict]]: dictionary with plate names as keys and a list of jobs for the batches of the plate
+    """
+    plate_jobs = {}
+
+    for plate, info in plate_info_dictionary.items():
+        # set paths for CellProfiler
+        path_to_pipeline = info["path_to_pipeline"]
+        path_to_images = info["path_to_images"]
+        path_to_output = info["path_to_output"]
+
+        # check to make sure paths to pipeline and directory of images are correct before running the pipeline
+        if not pathlib.Path(path_to_pipeline).resolve(strict=True):
+            raise FileNotFoundError(
+                f"The file '{pathlib.Path(path_to_pipeline).name}' does not exist"
+            )
+        if not pathlib.Path(path_to_images).is_dir():
+            raise FileNotFoundError(
+                f"Directory '{pathlib.Path(path_to_images).name}' does not exist or is not a directory"
+            )
+        # make output directory if it is not already created
+        pathlib.Path(path_to_output).mkdir(parents=True, exist_ok=True)
+
+        num_image_sets = info.get("num_image_sets") or count_image_sets(
+            path_to_images, path_to_file_list=info.get("path_to_file_list")
+        )
+        # the images are not listed again when the number of image sets is given, unless there is a file list
+        image_set_hash = None
+        if info.get("num_image_sets") is None or info.get("path_to_file_list"):
+            image_set_hash = hash_image_sets(
+                path_to_images, path_to_file_list=info.get("path_to_file_list")
+            )
+
+        # only create batches for the image sets that are not completed from a previous run (merged outputs are moved
+        # aside if the image sets changed since that run)
+        manifest = CheckpointManifest.load(
+            path_to_output=path_to_output,
+            num_image_sets=num_image_sets,
+            image_set_hash=image_set_hash,
+        )
+        if manifest.is_complete():
+            print(f"All image sets for {plate} have already been completed!")
+            continue
+
+        jobs = []
+        for first, last in split_image_sets(
+            num_image_sets, batch_size, image_set_ranges=manifest.missing_ranges()
+        ):
+            # each batch writes to its own directory to avoid workers writing to the same SQLite file
+            batch_output = pathlib.Path(
+                f"{path_to_output}/batches/batch_{first:05d}_{last:05d}"
+            )
+            # remove any partial outputs left from a batch that did not finish in a previous run or attempt
+            prepare_batch_output(batch_output)
+            command = [
+                "cellprofiler",
+                "-c",
+                "-r",
+                "-p",
+                str(path_to_pipeline),
+                "-o",
+                str(batch_output),
+                *image_input_arguments(info),
+                "-f",
+                str(first),
+                "-l",
+                str(last),
+            ]
+            jobs.append(
+                {
+                    "plate": plate,
+                    "first": first,
+                    "last": last,
+                    "command": command,
+                    "batch_output": batch_output,
+                    "path_to_output": pathlib.Path(path_to_output),
+                    "manifest": manifest,
+                    "prepare": partial(prepare_batch_output, batch_output),
+                }
+            )
+        plate_jobs[plate] = jobs
+
+    return plate_jobs
+
+
+def order_batch_jobs(plate_jobs: Dict[str, List[dict]]) -> List[dict]:
+    """Order the batches so the plate with the most batches starts first and every plate is interleaved
+    (round robin), which keeps all plates progressing and avoids one large plate setting the wall time.
+
+    Args:
+        plate_jobs (Dict[str, List[dict]]): dictionary with plate names as keys and a list of jobs for the batches
+
+    Returns:
+        List[dict]: single queue of jobs across all plates
+    """
+    plates = sorted(plate_jobs, key=lambda plate: len(plate_jobs[plate]), reverse=True)
+    max_batches = max((len(jobs) for jobs in plate_jobs.values()), default=0)
+
+    return [
+        plate_jobs[plate][index]
+        for index in range(max_batches)
+        for plate in plates
+        if index < len(plate_jobs[plate])
+    ]
+
+
+def run_cellprofiler_batched(
+    plate_info_dictionary: dict,
+    run_name: str,
+    batch_size: int = 25,
+    num_workers: Optional[int] = None,
+    timeout: Optional[float] = None,
+    max_retries: int = 1,
+    retry_backoff: float = 30,
+    report_interval: float = 60,
+    memory_budget_gb: Optional[float] = None,
+    default_job_memory_gb: float = 4,
+) -> None:
+    """Run CellProfiler pipelines on batches of image sets from all plates using a fixed number of workers.
+    All batches go into one queue so any worker that finishes picks up the next batch from whichever plate still
+    has work left. When a batch is complete, its outputs are merged into the plate output directory and the image
+    sets are recorded in the checkpoint manifest for the plate, so running again after a failure or interruption only
+    processes the image sets that are missing.
+
+    Args:
+        plate_info_dictionary (dict): dictionary with all paths for CellProfiler to run a pipeline
+        run_name (str): a given name for the type of CellProfiler run being done on the plates (example: whole image features)
+        batch_size (int, optional): maximum number of image sets per batch. Defaults to 25.
+        num_workers (Optional[int], optional): number of CellProfiler processes to run at once. Defaults to None,
+        which uses the number of CPUs on the machine.
+        timeout (Optional[float], optional): number of seconds before a batch is stopped. Defaults to None (no timeout).
+        max_retries (int, optional): number of times to retry a batch that returned an error. Defaults to 1.
+        retry_backoff (float, optional): number of seconds to wait before the first retry (doubles with each retry). Defaults to 30.
+        report_interval (float, optional): number of seconds between each progress report. Defaults to 60.
+        memory_budget_gb (Optional[float], optional): maximum GB of memory that all running CellProfiler processes can
+        use together, where new processes only start while the projected memory is under the budget. Defaults to None
+        (processes are only limited by the number of CPUs).
+        default_job_memory_gb (float, optional): estimated GB for a process when a plate has no peak memory recorded
+        from a previous run in the memory profile. Defaults to 4.
+
+    Raises:
+        MaxWorkerError: if the number of workers exceeds the number of CPUs on the machine
+    """
+    # set the number of workers as the number of CPUs if not set
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+
+    # make sure that the number of workers does not exceed the maximum number of workers for the machine
+    if num_workers > multiprocessing.cpu_count():
+        raise MaxWorkerError(
+            "Exception occurred: The number of workers exceeds the number of CPUs/workers. Please reduce the number of workers."
+        )
+
+    # make logs directory
+    log_dir = pathlib.Path("./logs")
+    os.makedirs(log_dir, exist_ok=True)
+
+    plate_jobs = create_batch_jobs(
+        plate_info_dictionary=plate_info_dictionary, batch_size=batch_size
+    )
+    jobs = order_batch_jobs(plate_jobs)
+    for job in jobs:
+        # the supervisor uses the job name to find the progress for the plate
+        job["name"] = job["plate"]
+        job["log_file_path"] = pathlib.Path(
+            f"{log_dir}/{job['plate']}_{run_name}_{job['first']}-{job['last']}_run.log"
+        )
+    print(
+        f"Running {len(jobs)} batches of up to {batch_size} image sets from {len(plate_jobs)} plates with {num_workers} workers"
+    )
+
+    # only start new processes while the projected memory is under the budget, using the peak memory per plate
+    # recorded in the memory profile from previous runs as the estimate for each process
+    admission = None
+    if memory_budget_gb is not None:
+        admission = MemoryAdmissionController(
+            memory_budget=int(memory_budget_gb * BYTES_PER_GB),
+            default_job_memory=int(default_job_memory_gb * BYTES_PER_GB),
+            profile_path=pathlib.Path(f"{log_dir}/{run_name}_memory_profile.json"),
+        )
+
+    # track the progress for each plate across all of its batches
+    progress_dictionary = {
+        plate: PlateProgress(
+            plate=plate,
+            total_image_sets=sum(
+                job["last"] - job["first"] + 1 for job in plate_jobs[plate]
+            ),
+        )
+        for plate in plate_jobs
+    }
+
+    # track the batches left and if any batch failed per plate to report when a plate is done
+    remaining_batches = {plate: len(plate_jobs[plate]) for plate in plate_jobs}
+    failed_plates = set()
+
+    def complete_batch(job: dict, result: subprocess.CompletedProcess) -> None:
+        plate = job["plate"]
+        remaining_batches[plate] -= 1
+
+        if result.returncode != 0:
+            failed_plates.add(plate)
+            print(
+                f"A return code of {result.returncode} was returned for {plate} (image sets {job['first']}-{job['last']}), which means there was an error in the CellProfiler run."
+            )
+        else:
+            # merge the batch right away so completed image sets are kept if the run is stopped
+            merge_batch_output(
+                batch_output_dir=job["batch_output"],
+                path_to_output=job["path_to_output"],
+                image_set_range=(job["first"], job["last"]),
+            )
+            job["manifest"].add_completed(job["first"], job["last"])
+
+        if remaining_batches[plate] > 0:
+            return
+
+        if plate in failed_plates:
+            print(
+                f"Not all image sets were completed for {plate} since at least one batch failed. Please check the log files for errors and run again to process the missing image sets."
+            )
+            return
+
+        # remove the empty directory that held the batches
+        shutil.rmtree(
+            pathlib.Path(f"{job['path_to_output']}/batches"),
+            ignore_errors=True,
+        )
+        print(f"All batches have been completed and merged for {plate}!")
+
+    run_supervised(
+        jobs,
+        max_concurrent=num_workers,
+        timeout=timeout,
+        max_retries=max_retries,
+        retry_backoff=retry_backoff,
+        progress_dictionary=progress_dictionary,
+        report_interval=report_interval,
+        admission=admission,
+        on_complete=complete_batch,
+    )
+
+    print("All processes have been completed!")
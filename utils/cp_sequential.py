@@ -1,15 +1,25 @@
 """
-These collection of functions runs CellProfiler and renames the .sqlite outputs to any specified name if 
+These collection of functions runs CellProfiler and renames the .sqlite outputs to any specified name if
 running an analysis pipeline.
 """
 
 # must use the annotations import as CellProfiler is restricted to Python 3.8 at this time so Optional
 # by itself only works in Python 3.10
+from __future__ import annotations
+
 import os
 import pathlib
+import shutil
 import subprocess
-from __future__ import annotations
-from typing import Optional
+from typing import Optional, TextIO
+
+from cp_checkpoint import MANIFEST_NAME, CheckpointManifest
+from cp_scheduler import (
+    count_image_sets,
+    hash_image_sets,
+    merge_batch_output,
+    split_image_sets,
+)
 
 
 def rename_sqlite_file(sqlite_dir_path: pathlib.Path, name: str):
@@ -42,12 +52,89 @@ def rename_sqlite_file(sqlite_dir_path: pathlib.Path, name: str):
         )
 
 
+def run_checkpointed_cellprofiler(
+    command: list,
+    path_to_output: str,
+    path_to_images: str,
+    checkpoint_size: int,
+    cellprofiler_output_file: TextIO,
+    checkpoint_name: str,
+):
+    """Run a CellProfiler command on chunks of image sets one after another, merging the outputs from each chunk into
+    a checkpoint folder for the plate (`{path_to_output}/.checkpoints/{checkpoint_name}`) and recording the completed
+    image sets in the checkpoint manifest. If the run stops partway through, running again only processes the image
+    sets that are not in the manifest. Once all image sets are completed, the merged outputs are moved into the output
+    folder, so plates that share an output folder never share a manifest or merged outputs.
+
+    Args:
+        command (list): CellProfiler command without the output folder or image set flags
+        path_to_output (str): path to the output folder
+        path_to_images (str): path to the images
+        checkpoint_size (int): number of image sets to run before saving a checkpoint
+        cellprofiler_output_file (TextIO): open log file for all outputs and errors
+        checkpoint_name (str): name of the plate or data set (e.g., the SQLite name) for the checkpoint folder
+    """
+    checkpoint_dir = pathlib.Path(f"{path_to_output}/.checkpoints/{checkpoint_name}")
+    checkpoint_dir.mkdir(parents=True, exist_ok=True)
+
+    num_image_sets = count_image_sets(pathlib.Path(path_to_images))
+    manifest = CheckpointManifest.load(
+        path_to_output=checkpoint_dir,
+        num_image_sets=num_image_sets,
+        image_set_hash=hash_image_sets(pathlib.Path(path_to_images)),
+    )
+
+    for first, last in split_image_sets(
+        num_image_sets, checkpoint_size, image_set_ranges=manifest.missing_ranges()
+    ):
+        # each chunk is written to its own folder and then merged into the checkpoint folder
+        chunk_output = pathlib.Path(
+            f"{checkpoint_dir}/batches/batch_{first:05d}_{last:05d}"
+        )
+        shutil.rmtree(chunk_output, ignore_errors=True)
+        chunk_output.mkdir(parents=True)
+
+        subprocess.run(
+            command + ["-o", str(chunk_output), "-f", str(first), "-l", str(last)],
+            stdout=cellprofiler_output_file,
+            stderr=cellprofiler_output_file,
+            check=True,
+        )
+        merge_batch_output(
+            batch_output_dir=chunk_output,
+            path_to_output=checkpoint_dir,
+            image_set_range=(first, last),
+        )
+        manifest.add_completed(first, last)
+        print(f"Image sets {first}-{last} of {num_image_sets} have been completed.")
+
+    # move the merged outputs into the output folder now that every image set is completed
+    shutil.rmtree(pathlib.Path(f"{checkpoint_dir}/batches"), ignore_errors=True)
+    for merged_file in sorted(checkpoint_dir.rglob("*")):
+        # the manifest and the hidden files that list the merged image sets are only needed for the checkpoint
+        if (
+            not merged_file.is_file()
+            or merged_file.name == MANIFEST_NAME
+            or merged_file.name.startswith(".")
+        ):
+            continue
+        output_file = pathlib.Path(path_to_output) / merged_file.relative_to(
+            checkpoint_dir
+        )
+        output_file.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(merged_file, output_file)
+    shutil.rmtree(checkpoint_dir)
+    if not any(checkpoint_dir.parent.iterdir()):
+        checkpoint_dir.parent.rmdir()
+
+
 def run_cellprofiler(
     path_to_pipeline: str,
     path_to_output: str,
     path_to_images: str,
     sqlite_name: Optional[None | str] = None,
     analysis_run: Optional[False | bool] = False,
+    checkpoint_size: Optional[None | int] = None,
 ):
     """Run CellProfiler on data. It can be used for either a illumination correction pipeline (default) and analysis pipeline (when
     parameter is set to True).
@@ -59,6 +146,9 @@ def run_cellprofiler(
         sqlite_name (str, optional): string with name for SQLite file for an analysis pipeline if you plan on running
         multiple sets of images (e.g., per plate) so that the outputs will have different names (default is None)
         analysis_run (bool, optional): will use functions to complete an analysis pipeline (default is False)
+        checkpoint_size (int, optional): run the images in chunks of this many image sets and save a checkpoint after
+        each chunk so a stopped run can be resumed from the missing image sets (default is None, which runs all
+        image sets in one CellProfiler process)
     """
     # check to make sure paths to pipeline and directory of images are correct before running the pipeline
     if not pathlib.Path(path_to_pipeline):
@@ -85,7 +175,7 @@ def run_cellprofiler(
             pathlib.Path(
                 f"logs/cellprofiler_output_{pathlib.Path(path_to_images).name}.log"
             ),
-            "w",
+            "a" if checkpoint_size is not None else "w",
         ) as cellprofiler_output_file:
             # run CellProfiler for a illumination correction pipeline
             command = [
@@ -94,17 +184,25 @@ def run_cellprofiler(
                 "-r",
                 "-p",
                 path_to_pipeline,
-                "-o",
-                path_to_output,
                 "-i",
                 path_to_images,
             ]
-            subprocess.run(
-                command,
-                stdout=cellprofiler_output_file,
-                stderr=cellprofiler_output_file,
-                check=True,
-            )
+            if checkpoint_size is not None:
+                run_checkpointed_cellprofiler(
+                    command=command,
+                    path_to_output=path_to_output,
+                    path_to_images=path_to_images,
+                    checkpoint_size=checkpoint_size,
+                    cellprofiler_output_file=cellprofiler_output_file,
+                    checkpoint_name=pathlib.Path(path_to_images).name,
+                )
+            else:
+                subprocess.run(
+                    command + ["-o", path_to_output],
+                    stdout=cellprofiler_output_file,
+                    stderr=cellprofiler_output_file,
+                    check=True,
+                )
             print(
                 f"The CellProfiler run has been completed with {pathlib.Path(path_to_images).name}. Please check log file for any errors."
             )
@@ -127,7 +225,8 @@ def run_cellprofiler(
         print(f"Starting CellProfiler analysis run on {sqlite_name}")
         # A log file is created for each plate or data set name (based on folder name with images) that holds all outputs and errors
         with open(
-            f"logs/cellprofiler_output_analysis_{sqlite_name}.log", "w"
+            f"logs/cellprofiler_output_analysis_{sqlite_name}.log",
+            "a" if checkpoint_size is not None else "w",
         ) as cellprofiler_output_file:
             command = [
                 "cellprofiler",
@@ -135,17 +234,25 @@ def run_cellprofiler(
                 "-r",
                 "-p",
                 path_to_pipeline,
-                "-o",
-                path_to_output,
                 "-i",
                 path_to_images,
             ]
-            subprocess.run(
-                command,
-                stdout=cellprofiler_output_file,
-                stderr=cellprofiler_output_file,
-                check=True,
-            )
+            if checkpoint_size is not None:
+                run_checkpointed_cellprofiler(
+                    command=command,
+                    path_to_output=path_to_output,
+                    path_to_images=path_to_images,
+                    checkpoint_size=checkpoint_size,
+                    cellprofiler_output_file=cellprofiler_output_file,
+                    checkpoint_name=sqlite_name,
+                )
+            else:
+                subprocess.run(
+                    command + ["-o", path_to_output],
+                    stdout=cellprofiler_output_file,
+                    stderr=cellprofiler_output_file,
+                    check=True,
+                )
             print(
                 f"The CellProfiler run has been completed with {pathlib.Path(path_to_images).name}. Please check log file for any errors."
             )
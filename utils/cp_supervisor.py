@@ -0,0 +1,298 @@
+"""
+This collection of functions supervises CellProfiler processes with asyncio. Each job is a CellProfiler command that
+is started with `asyncio.create_subprocess_exec`, with a limit on how many jobs run at once, a timeout per job,
+retries with backoff for jobs that return an error, and stopping of all running processes on cancellation (Ctrl-C).
+"""
+
+import asyncio
+import pathlib
+import signal
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from cp_memory import MemoryAdmissionController
+from cp_progress import ImageSetTracker, PlateProgress, print_progress
+
+# seconds to wait for a CellProfiler process to exit after it is asked to stop before it is killed
+TERMINATE_GRACE_PERIOD = 10
+
+# maximum number of bytes in one line of output (CellProfiler tracebacks can be longer than the asyncio default)
+STREAM_LINE_LIMIT = 2**20
+
+
+async def stop_process(process: asyncio.subprocess.Process) -> None:
+    """Stop a running process by asking it to terminate, and kill it if it does not exit in time.
+
+    Args:
+        process (asyncio.subprocess.Process): process to stop
+    """
+    if process.returncode is not None:
+        return
+    process.send_signal(signal.SIGTERM)
+    try:
+        await asyncio.wait_for(process.wait(), timeout=TERMINATE_GRACE_PERIOD)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+
+
+async def stream_process(
+    process: asyncio.subprocess.Process, log_file, tracker: ImageSetTracker
+) -> int:
+    """Write the output from a process to a log file line by line and update the image set progress.
+
+    Args:
+        process (asyncio.subprocess.Process): running CellProfiler process with stdout piped (stderr merged into stdout)
+        log_file: open log file for the process
+        tracker (ImageSetTracker): tracker for the image sets completed by the process
+
+    Returns:
+        int: return code from the process
+    """
+    async for line in process.stdout:
+        decoded_line = line.decode("utf-8", errors="replace")
+        log_file.write(decoded_line)
+        log_file.flush()
+        tracker.update(decoded_line)
+
+    return await process.wait()
+
+
+async def run_attempt(
+    job: dict,
+    attempt: int,
+    max_retries: int,
+    timeout: Optional[float],
+    tracker: ImageSetTracker,
+    admission: Optional[MemoryAdmissionController] = None,
+) -> int:
+    """Run one attempt of a CellProfiler job, streaming the output to the log file for the job.
+
+    Args:
+        job (dict): job with the "name", CellProfiler "command", "log_file_path", an optional "prepare" function
+        that is called before each attempt, and an optional "cwd" to run the command from
+        attempt (int): attempt number (0 is the first attempt)
+        max_retries (int): number of times a job that failed is retried
+        timeout (Optional[float]): number of seconds before the job is stopped (None means no timeout)
+        tracker (ImageSetTracker): tracker for the image sets completed by the job
+        admission (Optional[MemoryAdmissionController], optional): memory admission controller to register the
+        process with so its memory is sampled. Defaults to None.
+
+    Returns:
+        int: return code from the CellProfiler process
+    """
+    command = [str(argument) for argument in job["command"]]
+
+    # append to the log file after the first attempt to keep the output from failed attempts
+    with open(job["log_file_path"], "w" if attempt == 0 else "a") as log_file:
+        if attempt > 0:
+            log_file.write(f"\n[Retry {attempt} of {max_retries}]\n")
+        # clear any outputs from a failed attempt before the process starts (e.g., a partial SQLite file)
+        if job.get("prepare") is not None:
+            job["prepare"]()
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            limit=STREAM_LINE_LIMIT,
+            cwd=job.get("cwd"),
+        )
+        if admission is not None:
+            admission.register(id(job), process.pid)
+        try:
+            return await asyncio.wait_for(
+                stream_process(process, log_file, tracker), timeout=timeout
+            )
+        except asyncio.TimeoutError:
+            await stop_process(process)
+            log_file.write(f"\n[Stopped after the timeout of {timeout} seconds]\n")
+            print(f"{job['name']} was stopped after the timeout of {timeout} seconds.")
+            return process.returncode
+        except asyncio.CancelledError:
+            # stop the CellProfiler process when the run is cancelled (e.g., Ctrl-C)
+            await stop_process(process)
+            raise
+
+
+async def run_job(
+    job: dict,
+    semaphore: asyncio.Semaphore,
+    timeout: Optional[float],
+    max_retries: int,
+    retry_backoff: float,
+    progress: Optional[PlateProgress] = None,
+    admission: Optional[MemoryAdmissionController] = None,
+) -> subprocess.CompletedProcess:
+    """Run one CellProfiler job once a slot is open (and there is enough memory if using admission control),
+    retrying with exponential backoff if it returns an error or times out.
+
+    Args:
+        job (dict): job with the "name", CellProfiler "command", "log_file_path", and an optional "prepare" function
+        that is called before each attempt
+        semaphore (asyncio.Semaphore): semaphore that limits the number of jobs running at once
+        timeout (Optional[float]): number of seconds before a job is stopped (None means no timeout)
+        max_retries (int): number of times to retry a job that failed
+        retry_backoff (float): number of seconds to wait before the first retry (doubles with each retry)
+        progress (Optional[PlateProgress], optional): progress for the plate the job belongs to. Defaults to None.
+        admission (Optional[MemoryAdmissionController], optional): memory admission controller that the job must be
+        admitted by before it starts. Defaults to None.
+
+    Returns:
+        subprocess.CompletedProcess: the completed process from the last attempt (output is in the log file)
+    """
+    tracker = ImageSetTracker(progress=progress)
+
+    for attempt in range(max_retries + 1):
+        async with semaphore:
+            if admission is not None:
+                await admission.admit(id(job), job["name"])
+            try:
+                returncode = await run_attempt(
+                    job=job,
+                    attempt=attempt,
+                    max_retries=max_retries,
+                    timeout=timeout,
+                    tracker=tracker,
+                    admission=admission,
+                )
+            finally:
+                if admission is not None:
+                    await admission.release(id(job))
+
+        tracker.finish(returncode)
+        if returncode == 0:
+            break
+
+        # remove the image sets from the failed attempt since they will be processed again (or not kept)
+        tracker.reset()
+        if attempt == max_retries:
+            break
+
+        delay = retry_backoff * 2**attempt
+        print(
+            f"{job['name']} returned {returncode}, retrying in {delay:.0f} seconds (retry {attempt + 1} of {max_retries})."
+        )
+        await asyncio.sleep(delay)
+
+    return subprocess.CompletedProcess(args=job["command"], returncode=returncode)
+
+
+async def report_progress(
+    progress_dictionary: Dict[str, PlateProgress], report_interval: float
+) -> None:
+    """Print the progress for each plate every interval until cancelled.
+
+    Args:
+        progress_dictionary (Dict[str, PlateProgress]): dictionary with plate names as keys and plate progress as values
+        report_interval (float): number of seconds between each progress report
+    """
+    while True:
+        await asyncio.sleep(report_interval)
+        print_progress(progress_dictionary)
+
+
+async def supervise_jobs(
+    jobs: List[dict],
+    max_concurrent: int,
+    timeout: Optional[float] = None,
+    max_retries: int = 0,
+    retry_backoff: float = 30,
+    progress_dictionary: Optional[Dict[str, PlateProgress]] = None,
+    report_interval: float = 60,
+    on_complete: Optional[Callable[[dict, subprocess.CompletedProcess], None]] = None,
+    admission: Optional[MemoryAdmissionController] = None,
+) -> List[subprocess.CompletedProcess]:
+    """Run all jobs with at most `max_concurrent` CellProfiler processes running at once.
+
+    Args:
+        jobs (List[dict]): jobs with the "name", CellProfiler "command", and "log_file_path" (jobs are started in order)
+        max_concurrent (int): maximum number of CellProfiler processes to run at once
+        timeout (Optional[float], optional): number of seconds before a job is stopped. Defaults to None (no timeout).
+        max_retries (int, optional): number of times to retry a job that failed. Defaults to 0.
+        retry_backoff (float, optional): number of seconds to wait before the first retry. Defaults to 30.
+        progress_dictionary (Optional[Dict[str, PlateProgress]], optional): progress per plate, where the "name" of
+        each job is the plate. Defaults to None.
+        report_interval (float, optional): number of seconds between each progress report. Defaults to 60.
+        on_complete (Optional[Callable[[dict, subprocess.CompletedProcess], None]], optional): function called with
+        the job and completed process when each job is done. It runs in one background thread (one call at a time, so
+        it does not need to be thread safe), so slow work like merging outputs does not stop the output of other
+        processes from being read. Defaults to None.
+        admission (Optional[MemoryAdmissionController], optional): memory admission controller that only starts jobs
+        while the projected memory is under the budget. Defaults to None (jobs are only limited by max_concurrent).
+
+    Returns:
+        List[subprocess.CompletedProcess]: the completed processes in the same order as the jobs
+    """
+    semaphore = asyncio.Semaphore(max_concurrent)
+    progress_dictionary = progress_dictionary or {}
+    loop = asyncio.get_event_loop()
+    # one thread runs on_complete for every job in order, so the event loop keeps reading the output from processes
+    completion_executor = ThreadPoolExecutor(max_workers=1)
+
+    async def run_and_complete(job: dict) -> subprocess.CompletedProcess:
+        result = await run_job(
+            job=job,
+            semaphore=semaphore,
+            timeout=timeout,
+            max_retries=max_retries,
+            retry_backoff=retry_backoff,
+            progress=progress_dictionary.get(job["name"]),
+            admission=admission,
+        )
+        if on_complete is not None:
+            await loop.run_in_executor(completion_executor, on_complete, job, result)
+        return result
+
+    reporter = None
+    if progress_dictionary:
+        reporter = asyncio.ensure_future(
+            report_progress(progress_dictionary, report_interval)
+        )
+
+    # sample the memory of running processes to decide when the next job can start
+    monitor = None
+    if admission is not None:
+        monitor = asyncio.ensure_future(admission.monitor())
+
+    tasks = [asyncio.ensure_future(run_and_complete(job)) for job in jobs]
+    try:
+        results = await asyncio.gather(*tasks)
+    finally:
+        # cancel any jobs that are still running if one job raised an error or the run was cancelled
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for background_task in (reporter, monitor):
+            if background_task is not None:
+                background_task.cancel()
+        # wait for a call to on_complete that is running (e.g., a merge) so outputs are not left half written
+        completion_executor.shutdown(wait=True)
+
+    if progress_dictionary:
+        print_progress(progress_dictionary)
+
+    return list(results)
+
+
+def run_supervised(jobs: List[dict], **kwargs) -> List[subprocess.CompletedProcess]:
+    """Run jobs with the asyncio supervisor from synchronous code (e.g., a notebook converted to a script). On Ctrl-C,
+    all running CellProfiler processes are stopped before the KeyboardInterrupt is raised.
+
+    Args:
+        jobs (List[dict]): jobs with the "name", CellProfiler "command", and "log_file_path"
+        **kwargs: parameters passed to `supervise_jobs` (e.g., max_concurrent, timeout, max_retries)
+
+    Returns:
+        List[subprocess.CompletedProcess]: the completed processes in the same order as the jobs
+    """
+    # make sure log directories exist before any process starts
+    for job in jobs:
+        pathlib.Path(job["log_file_path"]).parent.mkdir(parents=True, exist_ok=True)
+
+    try:
+        # asyncio.run cancels all running jobs on Ctrl-C, which stops their CellProfiler processes
+        return asyncio.run(supervise_jobs(jobs, **kwargs))
+    except KeyboardInterrupt:
+        print("The run was cancelled and all CellProfiler processes have been stopped.")
+        raise
@@ -0,0 +1,286 @@
+"""
+This worker daemon claims CellProfiler jobs from a queue directory on a shared filesystem (filled by the
+`QueueExecutor` in `cp_executor.py`) and runs them with the asyncio supervisor. Start one worker per host (or several
+on one machine as stand-ins for hosts) from the folder the run is started from, for example:
+
+    python ../utils/cp_worker.py --queue-dir ./cp_queue --name node1 --max-concurrent 4
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import pathlib
+import signal
+import socket
+import uuid
+from typing import Dict, Optional
+
+from cp_executor import make_queue_dirs, parse_claimed_name, write_json_atomic
+from cp_memory import BYTES_PER_GB, MemoryAdmissionController
+from cp_supervisor import run_job
+
+
+def claim_job(
+    queue_dir: pathlib.Path, claimed_dir: pathlib.Path
+) -> Optional[pathlib.Path]:
+    """Claim the first pending job by moving its file into the claimed folder for the worker, with a new claim token
+    in the name (`<job ID>.<claim token>.json`). A rename is atomic, so if another worker claims the same job first the
+    next pending job is tried. The claimed file is the lease for the job: if the coordinator puts the job back in the
+    queue, the file is moved away and the worker no longer holds the claim.
+
+    Args:
+        queue_dir (pathlib.Path): path to the queue directory on the shared filesystem
+        claimed_dir (pathlib.Path): claimed folder for the worker
+
+    Returns:
+        Optional[pathlib.Path]: path to the claimed job file (None if there are no pending jobs)
+    """
+    for pending_path in sorted(pathlib.Path(f"{queue_dir}/pending").glob("*.json")):
+        claimed_path = pathlib.Path(
+            f"{claimed_dir}/{pending_path.stem}.{uuid.uuid4().hex}.json"
+        )
+        try:
+            os.rename(pending_path, claimed_path)
+        except FileNotFoundError:
+            continue
+        return claimed_path
+
+    return None
+
+
+def finish_job(
+    queue_dir: pathlib.Path,
+    claimed_path: pathlib.Path,
+    job: dict,
+    task: asyncio.Task,
+    worker_name: str,
+) -> bool:
+    """Write the return code for a finished job to the done folder and remove the job from the claimed folder. The
+    claimed file is moved out of the claimed folder first, which only succeeds if the worker still holds the claim, so
+    a job that the coordinator put back in the queue (e.g., after missed heartbeats) is never reported twice.
+
+    Args:
+        queue_dir (pathlib.Path): path to the queue directory on the shared filesystem
+        claimed_path (pathlib.Path): path to the claimed job file (from `claim_job`)
+        job (dict): job that was run
+        task (asyncio.Task): finished task that ran the job
+        worker_name (str): name of the worker
+
+    Returns:
+        bool: True if the worker still held the claim and the job was finished
+    """
+    job_id, claim_token = parse_claimed_name(claimed_path)
+    finishing_path = pathlib.Path(f"{queue_dir}/tmp/{claimed_path.name}")
+    try:
+        # the coordinator puts a job back in the queue by moving the same file, so only one of the two moves succeeds
+        os.rename(claimed_path, finishing_path)
+    except FileNotFoundError:
+        print(
+            f"{job['name']} was put back in the queue while it was running on this worker, so its result is not reported."
+        )
+        return False
+
+    cancelled_path = pathlib.Path(f"{queue_dir}/cancelled/{job_id}")
+    if task.cancelled():
+        # the job was cancelled by the coordinator, which is not waiting for a return code
+        cancelled_path.unlink(missing_ok=True)
+        print(f"{job['name']} was cancelled.")
+    else:
+        if task.exception() is not None:
+            print(f"{job['name']} raised an error: {task.exception()!r}")
+            returncode = -1
+        else:
+            returncode = task.result().returncode
+        write_json_atomic(
+            pathlib.Path(f"{queue_dir}/done/{job_id}.json"),
+            {
+                "name": job["name"],
+                "command": job["command"],
+                "returncode": returncode,
+                "worker": worker_name,
+                "claim_token": claim_token,
+            },
+            temp_dir=pathlib.Path(f"{queue_dir}/tmp"),
+        )
+        print(f"{job['name']} finished with a return code of {returncode}.")
+
+    finishing_path.unlink(missing_ok=True)
+
+    return True
+
+
+async def run_worker(
+    queue_dir: pathlib.Path,
+    worker_name: str,
+    max_concurrent: int = 1,
+    poll_interval: float = 5,
+    memory_budget_gb: Optional[float] = None,
+    default_job_memory_gb: float = 4,
+    exit_when_empty: bool = False,
+) -> None:
+    """Claim and run jobs from the queue until the worker is stopped (SIGTERM or Ctrl-C). When the worker is stopped,
+    its running CellProfiler processes are stopped and the jobs are put back in the queue for another worker.
+
+    Args:
+        queue_dir (pathlib.Path): path to the queue directory on the shared filesystem
+        worker_name (str): name of the worker, which must be unique across all hosts
+        max_concurrent (int, optional): maximum number of CellProfiler processes to run at once. Defaults to 1.
+        poll_interval (float, optional): number of seconds between each check of the queue (and heartbeat). Defaults to 5.
+        memory_budget_gb (Optional[float], optional): maximum GB of memory that all CellProfiler processes on this
+        worker can use together. Defaults to None (processes are only limited by max_concurrent).
+        default_job_memory_gb (float, optional): estimated GB for a process when a plate has no peak memory in the
+        memory profile for the worker. Defaults to 4.
+        exit_when_empty (bool, optional): stop the worker once there are no pending or running jobs. Defaults to False.
+    """
+    queue_dir = pathlib.Path(queue_dir).resolve()
+    make_queue_dirs(queue_dir)
+    claimed_dir = pathlib.Path(f"{queue_dir}/claimed/{worker_name}")
+    claimed_dir.mkdir(parents=True, exist_ok=True)
+    heartbeat = pathlib.Path(f"{queue_dir}/workers/{worker_name}")
+
+    # stop the worker the same way as Ctrl-C when it is sent SIGTERM (e.g., by a job scheduler)
+    asyncio.get_running_loop().add_signal_handler(
+        signal.SIGTERM, asyncio.current_task().cancel
+    )
+
+    semaphore = asyncio.Semaphore(max_concurrent)
+    admission = None
+    monitor = None
+    if memory_budget_gb is not None:
+        admission = MemoryAdmissionController(
+            memory_budget=int(memory_budget_gb * BYTES_PER_GB),
+            default_job_memory=int(default_job_memory_gb * BYTES_PER_GB),
+            profile_path=pathlib.Path(
+                f"{queue_dir}/workers/{worker_name}_memory_profile.json"
+            ),
+        )
+        monitor = asyncio.ensure_future(admission.monitor())
+
+    # running jobs by claimed job file, holding the job and the task that runs it
+    running: Dict[pathlib.Path, tuple] = {}
+    print(f"Worker {worker_name} is waiting for jobs in {queue_dir}.")
+
+    try:
+        while True:
+            heartbeat.touch()
+
+            for claimed_path, (job, task) in list(running.items()):
+                job_id = parse_claimed_name(claimed_path)[0]
+                if task.done():
+                    finish_job(queue_dir, claimed_path, job, task, worker_name)
+                    del running[claimed_path]
+                elif not claimed_path.exists():
+                    # the coordinator put the job back in the queue, so another worker may already be running it
+                    print(
+                        f"The claim on {job['name']} was lost, so the job is stopped on this worker."
+                    )
+                    task.cancel()
+                elif pathlib.Path(f"{queue_dir}/cancelled/{job_id}").exists():
+                    task.cancel()
+
+            while len(running) < max_concurrent:
+                claimed_path = claim_job(queue_dir, claimed_dir)
+                if claimed_path is None:
+                    break
+                with open(claimed_path) as job_file:
+                    job = json.load(job_file)
+                print(f"Worker {worker_name} claimed {job['name']}.")
+                task = asyncio.ensure_future(
+                    run_job(
+                        job=job,
+                        semaphore=semaphore,
+                        timeout=job["timeout"],
+                        max_retries=job["max_retries"],
+                        retry_backoff=job["retry_backoff"],
+                        admission=admission,
+                    )
+                )
+                running[claimed_path] = (job, task)
+
+            if exit_when_empty and not running:
+                break
+
+            await asyncio.sleep(poll_interval)
+    finally:
+        # report the jobs that finished since the last check, then stop the running CellProfiler processes and put
+        # their jobs back in the queue for another worker
+        for claimed_path, (job, task) in list(running.items()):
+            if task.done():
+                finish_job(queue_dir, claimed_path, job, task, worker_name)
+                del running[claimed_path]
+            else:
+                task.cancel()
+        await asyncio.gather(
+            *[task for _, task in running.values()], return_exceptions=True
+        )
+        for claimed_path, (job, task) in running.items():
+            job_id = parse_claimed_name(claimed_path)[0]
+            # the marker is written before the job is back in pending, so the coordinator resets the progress from
+            # the log before the next worker writes it again
+            requeued_path = pathlib.Path(f"{queue_dir}/requeued/{job_id}")
+            requeued_path.touch()
+            try:
+                os.rename(
+                    claimed_path, pathlib.Path(f"{queue_dir}/pending/{job_id}.json")
+                )
+            except FileNotFoundError:
+                # the coordinator already put the job back in the queue
+                requeued_path.unlink(missing_ok=True)
+                continue
+            print(f"{job['name']} was put back in the queue.")
+        if monitor is not None:
+            monitor.cancel()
+        heartbeat.unlink(missing_ok=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run CellProfiler jobs from a queue directory on a shared filesystem."
+    )
+    parser.add_argument(
+        "--queue-dir", required=True, help="path to the queue directory"
+    )
+    parser.add_argument(
+        "--name",
+        default=socket.gethostname(),
+        help="unique name for the worker (defaults to the host name)",
+    )
+    parser.add_argument(
+        "--max-concurrent",
+        type=int,
+        default=1,
+        help="maximum number of CellProfiler processes to run at once",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=5,
+        help="number of seconds between each check of the queue",
+    )
+    parser.add_argument(
+        "--memory-budget-gb",
+        type=float,
+        default=None,
+        help="maximum GB of memory for all CellProfiler processes on this worker",
+    )
+    parser.add_argument(
+        "--exit-when-empty",
+        action="store_true",
+        help="stop the worker once there are no pending or running jobs",
+    )
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(
+            run_worker(
+                queue_dir=args.queue_dir,
+                worker_name=args.name,
+                max_concurrent=args.max_concurrent,
+                poll_interval=args.poll_interval,
+                memory_budget_gb=args.memory_budget_gb,
+                exit_when_empty=args.exit_when_empty,
+            )
+        )
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        print(f"Worker {args.name} was stopped.")
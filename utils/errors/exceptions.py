@@ -7,3 +7,10 @@ class MaxWorkerError(Exception):
     Raised when the number of workers assigned to `max_workers` exceeds the number of CPU/workers on the machine. 
     """
     pass
+
+
+class ImageIndexError(Exception):
+    """
+    Raised when an image is not in the image index for a plate or the images for a plate have missing channels or are corrupt.
+    """
+    pass
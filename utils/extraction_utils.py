@@ -4,40 +4,255 @@ cells.SingleCells class in Pycytominer. This file also hold a function to add si
 to the single cell count dataframes.
 """
 
+import atexit
+import sqlite3
+import threading
+from typing import Dict, Iterator, List, Optional, Union
+
 import numpy as np
 import pandas as pd
 import pathlib
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+# engines for each sqlite file (by absolute path) that are shared by all reads in the process
+SQLITE_ENGINES: Dict[str, Engine] = {}
+SQLITE_ENGINES_LOCK = threading.Lock()
+
+
+def sqlite_path(sqlite_file: Union[str, pathlib.Path]) -> str:
+    """
+    find the absolute path to a sqlite file from a path or a SQLAlchemy URL (e.g. "sqlite:///path/to/file.sqlite")
+
+    Parameters
+    ----------
+    sqlite_file : str or pathlib.Path
+        path or SQLAlchemy URL for the sqlite file
+
+    Returns
+    -------
+    str:
+        absolute path to the sqlite file
+    """
+    sqlite_file = str(sqlite_file)
+    if sqlite_file.startswith("sqlite:///"):
+        sqlite_file = sqlite_file[len("sqlite:///") :]
+
+    return str(pathlib.Path(sqlite_file).resolve(strict=True))
+
+
+def get_sqlite_engine(
+    sqlite_file: Union[str, pathlib.Path],
+    mmap_size: int = 1024**3,
+    cache_size_kb: int = 256 * 1024,
+    pool_size: int = 4,
+) -> Engine:
+    """
+    get the engine for a sqlite file, creating it the first time the file is read. Connections are opened read-only
+    and kept in a pool, so reading several tables or plates from the same file reuses warm connections.
+
+    Parameters
+    ----------
+    sqlite_file : str or pathlib.Path
+        path or SQLAlchemy URL for the sqlite file
+    mmap_size : int
+        number of bytes of the file to memory map for each connection (default = 1 GB)
+    cache_size_kb : int
+        size of the page cache for each connection in KB (default = 256 MB)
+    pool_size : int
+        number of connections to keep open in the pool, where more connections are opened if needed (e.g. more chunk
+        iterators are open at once than pool_size) and closed once they are returned (default = 4)
+
+    Returns
+    -------
+    sqlalchemy.engine.Engine:
+        engine for the sqlite file
+    """
+    path = sqlite_path(sqlite_file)
+
+    with SQLITE_ENGINES_LOCK:
+        if path not in SQLITE_ENGINES:
+            # the file is opened read-only so CellProfiler outputs are never changed or locked for writing
+            engine = create_engine(
+                "sqlite://",
+                creator=lambda: sqlite3.connect(
+                    f"{pathlib.Path(path).as_uri()}?mode=ro",
+                    uri=True,
+                    check_same_thread=False,
+                ),
+                poolclass=QueuePool,
+                pool_size=pool_size,
+                # open extra connections instead of waiting for one to be returned, as an open chunk iterator holds
+                # its connection until it is read or closed and waiting would block forever
+                max_overflow=-1,
+            )
+
+            @event.listens_for(engine, "connect")
+            def set_pragmas(dbapi_connection, connection_record):
+                cursor = dbapi_connection.cursor()
+                cursor.execute(f"PRAGMA mmap_size = {int(mmap_size)}")
+                # a negative cache size is in KB instead of pages
+                cursor.execute(f"PRAGMA cache_size = -{int(cache_size_kb)}")
+                cursor.execute("PRAGMA query_only = 1")
+                cursor.close()
+
+            SQLITE_ENGINES[path] = engine
+
+        return SQLITE_ENGINES[path]
+
+
+def dispose_sqlite_engines(sqlite_file: Optional[Union[str, pathlib.Path]] = None):
+    """
+    close the pooled connections for a sqlite file (or all sqlite files) and remove the engine from the cache, which
+    is needed before the file is moved, deleted, or written to again
+
+    Parameters
+    ----------
+    sqlite_file : str or pathlib.Path
+        path or SQLAlchemy URL for the sqlite file, if None then all engines are disposed (default = None)
+    """
+    with SQLITE_ENGINES_LOCK:
+        if sqlite_file is None:
+            paths = list(SQLITE_ENGINES)
+        else:
+            paths = [sqlite_path(sqlite_file)]
+        for path in paths:
+            engine = SQLITE_ENGINES.pop(path, None)
+            if engine is not None:
+                engine.dispose()
+
+
+# close all pooled connections when the process exits
+atexit.register(dispose_sqlite_engines)
+
+
+def resolve_image_columns(
+    table_columns: List[str],
+    image_feature_categories: Optional[List[str]] = None,
+    image_cols: Optional[List[str]] = None,
+    strata: Optional[List[str]] = None,
+) -> List[str]:
+    """
+    find the columns to read from the image table based on the feature group prefixes and metadata columns
+
+    Parameters
+    ----------
+    table_columns : list of str
+        all columns in the image table (in the order of the table)
+    image_feature_categories : list of str
+        image feature groups to read including the prefix (e.g. ["Image_Correlation", "Image_ImageQuality"]),
+        if None then all columns are read (default = None)
+    image_cols : list of str
+        metadata columns to read from the image table (default = None)
+    strata : list of str
+        columns to groupby and aggregate single cells (default = None)
+
+    Returns
+    -------
+    list of str:
+        columns to read in the order of the table
+    """
+    if image_feature_categories is None:
+        return list(table_columns)
+
+    # metadata columns are read even if they do not match a feature group
+    metadata_cols = set(image_cols or []) | set(strata or [])
+    missing_cols = metadata_cols - set(table_columns)
+    if missing_cols:
+        raise ValueError(
+            f"The image table is missing the following columns: {sorted(missing_cols)}"
+        )
+
+    return [
+        column
+        for column in table_columns
+        if column in metadata_cols or column.startswith(tuple(image_feature_categories))
+    ]
 
 
 def load_sqlite_as_df(
     sqlite_file: str,
     image_table_name: str = "Per_Image",
-) -> pd.DataFrame:
+    image_feature_categories: Optional[List[str]] = None,
+    image_cols: Optional[List[str]] = None,
+    strata: Optional[List[str]] = None,
+    chunksize: Optional[int] = None,
+) -> Union[pd.DataFrame, Iterator[pd.DataFrame]]:
     """
-    load in table with image feature data from sqlite file
+    load in table with image feature data from sqlite file, only reading the columns for the selected feature groups
+    so the memory used scales with the selected columns and not the whole table
 
     Parameters
     ----------
     sqlite_file : str
-        string of path to the sqlite file
+        string of path to the sqlite file, or a SQLAlchemy URL (e.g. "sqlite:///path/to/file.sqlite")
     image_table_name : str
         string of the name with the image feature data (default = "Per_Image")
+    image_feature_categories : list of str
+        image feature groups to read including the prefix (e.g. ["Image_Correlation", "Image_ImageQuality"]),
+        if None then all columns are read (default = None)
+    image_cols : list of str
+        metadata columns to read from the image table (default = None)
+    strata : list of str
+        columns to groupby and aggregate single cells (default = None)
+    chunksize : int
+        number of rows to read at a time, if set then an iterator of chunks is returned and the connection is
+        returned to the pool once all chunks are read (default = None)
 
     Returns
     -------
-    pd.DataFrame:
-        dataframe containing image feature data
+    pd.DataFrame or an iterator of pd.DataFrame:
+        dataframe containing image feature data, or an iterator of chunks if chunksize is set
+    """
+    # get the cached engine for the sqlite file, so the connection goes back to the pool once the table is read
+    engine = get_sqlite_engine(sqlite_file)
+
+    with engine.connect() as conn:
+        # read only the columns that are needed from the table
+        table_columns = [
+            column["name"] for column in inspect(conn).get_columns(image_table_name)
+        ]
+        columns = resolve_image_columns(
+            table_columns=table_columns,
+            image_feature_categories=image_feature_categories,
+            image_cols=image_cols,
+            strata=strata,
+        )
+        quoted_columns = ", ".join(f'"{column}"' for column in columns)
+        image_query = f'select {quoted_columns} from "{image_table_name}"'
+
+        if chunksize is None:
+            return pd.read_sql(sql=text(image_query), con=conn)
+
+    return iterate_sqlite_chunks(
+        engine=engine, image_query=image_query, chunksize=chunksize
+    )
+
+
+def iterate_sqlite_chunks(
+    engine, image_query: str, chunksize: int
+) -> Iterator[pd.DataFrame]:
     """
-    # connect to the sqlite file to be able read the contents
-    engine = create_engine(sqlite_file)
-    conn = engine.connect()
+    read the rows from a query in chunks, keeping one connection from the pool until all chunks are read (or the
+    iterator is closed) and then returning it to the pool
 
-    # read and output all columns and rows from table into a dataframe to
-    image_query = f"select * from {image_table_name}"
-    image_df = pd.read_sql(sql=image_query, con=conn)
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+        engine for the sqlite file (from get_sqlite_engine)
+    image_query : str
+        query to read the rows
+    chunksize : int
+        number of rows to read at a time
 
-    return image_df
+    Yields
+    ------
+    pd.DataFrame:
+        chunk of rows from the query
+    """
+    with engine.connect() as conn:
+        yield from pd.read_sql(sql=text(image_query), con=conn, chunksize=chunksize)
 
 
 def extract_image_features(image_feature_categories, image_df, image_cols, strata):
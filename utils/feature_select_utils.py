@@ -0,0 +1,441 @@
+"""
+This collection of functions performs feature selection on single-cell profiles with one pass over the data, giving
+the same features as `pycytominer.feature_select` (version 1.2.0, which is pinned in the environment files) with the
+variance, correlation, blocklist, and missing value operations. For each block of rows, the mean, variance, and number
+of missing values of each feature are merged into totals, and the sums needed for the Pearson correlation of every pair
+of features are added with float32 matrix products, so the full correlation matrix is never computed from all single
+cells at once. The variance threshold of pycytominer 1.2.0 drops a feature if either the frequency cutoff or the unique
+value cutoff fails, which needs the number of distinct values and the counts of the two most common values, so those
+are counted in a second pass one feature at a time. A report is made with every feature that was dropped and why.
+"""
+
+import pathlib
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import pycytominer
+from normalize_utils import (
+    FEATURE_PREFIXES,
+    infer_columns,
+    iter_df_blocks,
+    iter_sample_blocks,
+    merge_moments,
+)
+from parquet_utils import transform_parquet
+
+# operations that can be performed, in the order they are listed by the user
+FEATURE_SELECT_OPS = [
+    "variance_threshold",
+    "correlation_threshold",
+    "blocklist",
+    "drop_na_columns",
+]
+
+
+def load_blocklist(blocklist_file: Optional[pathlib.Path] = None) -> List[str]:
+    """Load the features to exclude from a blocklist file with a "blocklist" column.
+
+    Args:
+        blocklist_file (Optional[pathlib.Path], optional): path to the blocklist file. Defaults to None (the default
+        blocklist from pycytominer).
+
+    Returns:
+        List[str]: features in the blocklist
+    """
+    if blocklist_file is None:
+        blocklist_file = pathlib.Path(
+            f"{pathlib.Path(pycytominer.__file__).parent}/data/blocklist_features.txt"
+        )
+
+    return pd.read_csv(blocklist_file)["blocklist"].tolist()
+
+
+def compute_feature_stats(
+    blocks: Iterable[np.ndarray], num_features: int
+) -> Dict[str, np.ndarray]:
+    """Find the statistics for feature selection with one pass over blocks of rows. The count, mean, and sum of
+    squares of each feature are merged in float64 (see `normalize_utils.merge_moments`). For the correlation, the
+    values are shifted by the mean of the first block (the correlation does not change with a shift, but the sums stay
+    small) and the pairwise sums are added with float32 matrix products. The sums for pairs only use rows where both
+    features have a value, the same as pandas, and are only computed with masks for blocks with missing values.
+
+    Args:
+        blocks (Iterable[np.ndarray]): blocks of rows with one column for each feature
+        num_features (int): number of features
+
+    Returns:
+        Dict[str, np.ndarray]: number of rows ("num_rows"), count, mean, and sum of squares of each feature, and the
+        number of rows ("pair_count"), sums ("pair_sum"), sums of squares ("pair_sum_squares"), and sums of products
+        ("pair_products") for each pair of features, where the sums in row i are for feature i with feature j
+    """
+    count = np.zeros(num_features)
+    mean = np.zeros(num_features)
+    sum_squares = np.zeros(num_features)
+    pair_count = np.zeros((num_features, num_features))
+    pair_sum = np.zeros((num_features, num_features))
+    pair_sum_squares = np.zeros((num_features, num_features))
+    pair_products = np.zeros((num_features, num_features))
+    num_rows = 0
+    shift = None
+
+    for values in blocks:
+        values = np.asarray(values, dtype=np.float64)
+        num_rows += values.shape[0]
+        count, mean, sum_squares = merge_moments(
+            count=count, mean=mean, sum_squares=sum_squares, values=values
+        )
+
+        if shift is None:
+            # after the first block the merged mean is the mean of the first block (0 for features without values)
+            shift = mean.copy()
+        shifted = (values - shift).astype(np.float32)
+        is_missing = np.isnan(shifted)
+
+        if not is_missing.any():
+            pair_count += shifted.shape[0]
+            # without missing values the sums for feature i are the same for every pair
+            column_sums = shifted.sum(axis=0, dtype=np.float64)
+            column_sum_squares = np.square(shifted).sum(axis=0, dtype=np.float64)
+            pair_sum += column_sums[:, None]
+            pair_sum_squares += column_sum_squares[:, None]
+            pair_products += shifted.T @ shifted
+        else:
+            is_value = (~is_missing).astype(np.float32)
+            shifted[is_missing] = 0
+            pair_count += is_value.T @ is_value
+            pair_sum += shifted.T @ is_value
+            pair_sum_squares += np.square(shifted).T @ is_value
+            pair_products += shifted.T @ shifted
+
+    return {
+        "num_rows": np.array(num_rows),
+        "count": count,
+        "mean": mean,
+        "sum_squares": sum_squares,
+        "pair_count": pair_count,
+        "pair_sum": pair_sum,
+        "pair_sum_squares": pair_sum_squares,
+        "pair_products": pair_products,
+    }
+
+
+def iter_df_columns(
+    profiles: pd.DataFrame, features: List[str], samples: str = "all"
+) -> Iterator[np.ndarray]:
+    """Get the values of each feature for the samples in a data frame one feature at a time.
+
+    Args:
+        profiles (pd.DataFrame): single-cell profiles
+        features (List[str]): feature columns to get
+        samples (str, optional): query for the samples to get. Defaults to "all".
+
+    Yields:
+        np.ndarray: values of one feature for the samples, in the order of `features`
+    """
+    profiles = profiles if samples == "all" else profiles.query(samples)
+    for feature in features:
+        yield profiles[feature].to_numpy(dtype=np.float64)
+
+
+def iter_parquet_columns(
+    parquet_file: pq.ParquetFile,
+    features: List[str],
+    samples: str = "all",
+    columns_per_read: int = 64,
+) -> Iterator[np.ndarray]:
+    """Read the values of each feature for the samples in a parquet file one feature at a time, reading a group of
+    feature columns (and the metadata columns for the query) at a time so only that group is in memory.
+
+    Args:
+        parquet_file (pq.ParquetFile): parquet file with the single-cell profiles
+        features (List[str]): feature columns to read
+        samples (str, optional): query for the samples to read. Defaults to "all".
+        columns_per_read (int, optional): number of feature columns to read at a time. Defaults to 64.
+
+    Yields:
+        np.ndarray: values of one feature for the samples, in the order of `features`
+    """
+    metadata = [] if samples == "all" else infer_columns(parquet_file.schema_arrow)[0]
+    for start in range(0, len(features), columns_per_read):
+        group = features[start : start + columns_per_read]
+        group_df = parquet_file.read(columns=metadata + group).to_pandas()
+        yield from iter_df_columns(profiles=group_df, features=group, samples=samples)
+
+
+def compute_value_counts(
+    columns: Iterable[np.ndarray], num_features: int
+) -> Dict[str, np.ndarray]:
+    """Count the distinct values of each feature and how many times the two most common values are found, for the
+    variance threshold, with one feature at a time in memory. Missing values are not counted, the same as
+    `pandas.Series.value_counts` and `pandas.Series.nunique` in pycytominer.
+
+    Args:
+        columns (Iterable[np.ndarray]): values of each feature (e.g., from `iter_df_columns` or `iter_parquet_columns`)
+        num_features (int): number of features
+
+    Returns:
+        Dict[str, np.ndarray]: number of distinct values ("num_unique") and the counts of the most common and second
+        most common values ("top_counts", with 0 if a feature has fewer distinct values) of each feature
+    """
+    num_unique = np.zeros(num_features, dtype=np.int64)
+    top_counts = np.zeros((num_features, 2), dtype=np.int64)
+
+    for index, column in enumerate(columns):
+        value_counts = np.unique(column[~np.isnan(column)], return_counts=True)[1]
+        num_unique[index] = len(value_counts)
+        most_common = np.sort(value_counts)[::-1][:2]
+        top_counts[index, : len(most_common)] = most_common
+
+    return {"num_unique": num_unique, "top_counts": top_counts}
+
+
+def pairwise_correlation(feature_stats: Dict[str, np.ndarray]) -> np.ndarray:
+    """Find the Pearson correlation of every pair of features from the pairwise sums.
+
+    Args:
+        feature_stats (Dict[str, np.ndarray]): statistics from `compute_feature_stats`
+
+    Returns:
+        np.ndarray: correlation matrix (NaN for pairs without enough rows or variance)
+    """
+    n = feature_stats["pair_count"]
+    sum_x = feature_stats["pair_sum"]
+    sum_y = sum_x.T
+    covariance = n * feature_stats["pair_products"] - sum_x * sum_y
+    variance_x = n * feature_stats["pair_sum_squares"] - sum_x**2
+    variance_y = variance_x.T
+    with np.errstate(divide="ignore", invalid="ignore"):
+        correlation = covariance / np.sqrt(variance_x * variance_y)
+    correlation[(variance_x <= 0) | (variance_y <= 0) | (n < 2)] = np.nan
+
+    return np.clip(correlation, -1, 1)
+
+
+def select_features(
+    features: List[str],
+    feature_stats: Dict[str, np.ndarray],
+    operation: List[str] = FEATURE_SELECT_OPS,
+    na_cutoff: float = 0.05,
+    corr_threshold: float = 0.9,
+    freq_cut: float = 0.05,
+    unique_cut: float = 0.01,
+    blocklist: Optional[List[str]] = None,
+) -> pd.DataFrame:
+    """Perform each feature selection operation in order on the features left by the previous operations, using the
+    statistics from one pass over the data.
+
+    Args:
+        features (List[str]): features in the same order as the statistics
+        feature_stats (Dict[str, np.ndarray]): statistics from `compute_feature_stats`, with the "num_unique" and
+        "top_counts" from `compute_value_counts` if the variance threshold is used
+        operation (List[str], optional): operations to perform (from FEATURE_SELECT_OPS). Defaults to FEATURE_SELECT_OPS.
+        na_cutoff (float, optional): features with a larger proportion of missing values are dropped. Defaults to 0.05.
+        corr_threshold (float, optional): the feature with the larger total correlation is dropped for each pair with a
+        larger correlation. Defaults to 0.9.
+        freq_cut (float, optional): features where the count of the second most common value divided by the count of
+        the most common value is smaller (or with less than two distinct values) are dropped by the variance
+        threshold. Defaults to 0.05.
+        unique_cut (float, optional): features where the number of distinct values divided by the number of rows is
+        smaller are dropped by the variance threshold. Defaults to 0.01.
+        blocklist (Optional[List[str]], optional): features to drop. Defaults to None (the pycytominer blocklist).
+
+    Raises:
+        ValueError: if an operation is not in FEATURE_SELECT_OPS or the variance threshold is used without the value
+        counts in the statistics
+
+    Returns:
+        pd.DataFrame: report with the "feature", "operation", and "reason" for each feature that was dropped
+    """
+    unknown_ops = set(operation) - set(FEATURE_SELECT_OPS)
+    if unknown_ops:
+        raise ValueError(
+            f"The operations {sorted(unknown_ops)} are not in {FEATURE_SELECT_OPS}."
+        )
+
+    if "variance_threshold" in operation and "num_unique" not in feature_stats:
+        raise ValueError(
+            "The variance threshold needs the value counts from compute_value_counts."
+        )
+
+    num_rows = int(feature_stats["num_rows"])
+    na_proportion = 1 - feature_stats["count"] / max(num_rows, 1)
+
+    report = []
+    kept = np.ones(len(features), dtype=bool)
+    for op in operation:
+        excluded = {}
+        if op == "variance_threshold":
+            # a feature is dropped if it fails either cutoff (the same as `pycytominer.operations.variance_threshold`)
+            for index in np.flatnonzero(kept):
+                num_unique = feature_stats["num_unique"][index]
+                first_count, second_count = feature_stats["top_counts"][index]
+                reasons = []
+                # features with less than two distinct values always fail the frequency cutoff
+                if num_unique < 2:
+                    reasons.append(f"{num_unique} distinct values")
+                elif second_count / first_count < freq_cut:
+                    reasons.append(
+                        f"frequency ratio {second_count / first_count:.3g} < {freq_cut}"
+                    )
+                if num_rows > 0 and num_unique / num_rows < unique_cut:
+                    reasons.append(
+                        f"unique ratio {num_unique / num_rows:.3g} < {unique_cut}"
+                    )
+                if reasons:
+                    excluded[index] = ", ".join(reasons)
+        elif op == "drop_na_columns":
+            for index in np.flatnonzero(kept & (na_proportion > na_cutoff)):
+                excluded[index] = (
+                    f"{na_proportion[index]:.2%} missing values > {na_cutoff:.2%}"
+                )
+        elif op == "blocklist":
+            blocklist_features = set(
+                load_blocklist() if blocklist is None else blocklist
+            )
+            for index in np.flatnonzero(kept):
+                if features[index] in blocklist_features:
+                    excluded[index] = "in blocklist"
+        elif op == "correlation_threshold":
+            kept_index = np.flatnonzero(kept)
+            correlation = pairwise_correlation(feature_stats)[
+                np.ix_(kept_index, kept_index)
+            ]
+            # features with a lower total correlation to the other features are kept (the same as pycytominer)
+            rank = np.empty(len(kept_index), dtype=int)
+            rank[np.argsort(np.nansum(np.abs(correlation), axis=0), kind="stable")] = (
+                np.arange(len(kept_index))
+            )
+            with np.errstate(invalid="ignore"):
+                pair_a, pair_b = np.nonzero(np.tril(correlation > corr_threshold, k=-1))
+            for a, b in zip(pair_a, pair_b):
+                drop, other = (a, b) if rank[a] > rank[b] else (b, a)
+                excluded.setdefault(
+                    kept_index[drop],
+                    f"correlation {correlation[a, b]:.3f} > {corr_threshold} with "
+                    f"{features[kept_index[other]]}",
+                )
+
+        for index, reason in excluded.items():
+            report.append(
+                {"feature": features[index], "operation": op, "reason": reason}
+            )
+            kept[index] = False
+
+    return pd.DataFrame(report, columns=["feature", "operation", "reason"])
+
+
+def feature_select_df(
+    profiles: pd.DataFrame,
+    operation: List[str] = FEATURE_SELECT_OPS,
+    samples: str = "all",
+    block_size: int = 8192,
+    **kwargs,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Perform feature selection on profiles in memory, finding the statistics one block of rows at a time (with a
+    second pass to count the values of each feature if the variance threshold is used).
+
+    Args:
+        profiles (pd.DataFrame): single-cell profiles (e.g., normalized profiles)
+        operation (List[str], optional): operations to perform (from FEATURE_SELECT_OPS). Defaults to FEATURE_SELECT_OPS.
+        samples (str, optional): query for the samples to find the statistics with. Defaults to "all".
+        block_size (int, optional): number of rows in each block. Defaults to 8192.
+        **kwargs: thresholds for `select_features` (e.g., na_cutoff)
+
+    Returns:
+        Tuple[pd.DataFrame, pd.DataFrame]: profiles without the dropped features and the report of dropped features
+    """
+    features = [
+        column
+        for column in profiles.columns
+        if column.startswith(FEATURE_PREFIXES)
+        and pd.api.types.is_numeric_dtype(profiles[column])
+    ]
+    feature_stats = compute_feature_stats(
+        blocks=iter_df_blocks(
+            profiles=profiles,
+            features=features,
+            samples=samples,
+            block_size=block_size,
+        ),
+        num_features=len(features),
+    )
+    if "variance_threshold" in operation:
+        feature_stats.update(
+            compute_value_counts(
+                columns=iter_df_columns(
+                    profiles=profiles, features=features, samples=samples
+                ),
+                num_features=len(features),
+            )
+        )
+    report = select_features(
+        features=features,
+        feature_stats=feature_stats,
+        operation=operation,
+        **kwargs,
+    )
+
+    return profiles.drop(columns=report["feature"].tolist()), report
+
+
+def feature_select_parquet(
+    input_path: pathlib.Path,
+    output_path: pathlib.Path,
+    operation: List[str] = FEATURE_SELECT_OPS,
+    samples: str = "all",
+    batch_size: int = 8192,
+    **kwargs,
+) -> pd.DataFrame:
+    """Perform feature selection on a parquet file with one pass over the features to find the statistics (with a
+    second pass that reads a group of features at a time to count their values if the variance threshold is used), and then
+    write the kept columns one batch of rows at a time (see `parquet_utils.transform_parquet`).
+
+    Args:
+        input_path (pathlib.Path): path to the parquet file with the single-cell profiles (e.g., normalized profiles)
+        output_path (pathlib.Path): path to save the feature selected profiles
+        operation (List[str], optional): operations to perform (from FEATURE_SELECT_OPS). Defaults to FEATURE_SELECT_OPS.
+        samples (str, optional): query for the samples to find the statistics with. Defaults to "all".
+        batch_size (int, optional): maximum number of rows to read at a time. Defaults to 8192.
+        **kwargs: thresholds for `select_features` (e.g., na_cutoff)
+
+    Returns:
+        pd.DataFrame: report with the "feature", "operation", and "reason" for each feature that was dropped
+    """
+    with open(input_path, "rb") as input_file:
+        parquet_file = pq.ParquetFile(input_file)
+        features = infer_columns(parquet_file.schema_arrow)[1]
+        feature_stats = compute_feature_stats(
+            blocks=iter_sample_blocks(
+                parquet_file=parquet_file,
+                features=features,
+                samples=samples,
+                batch_size=batch_size,
+            ),
+            num_features=len(features),
+        )
+        if "variance_threshold" in operation:
+            feature_stats.update(
+                compute_value_counts(
+                    columns=iter_parquet_columns(
+                        parquet_file=parquet_file, features=features, samples=samples
+                    ),
+                    num_features=len(features),
+                )
+            )
+
+    report = select_features(
+        features=features,
+        feature_stats=feature_stats,
+        operation=operation,
+        **kwargs,
+    )
+    transform_parquet(
+        input_path=input_path,
+        output_path=output_path,
+        drop_columns=report["feature"].tolist(),
+        batch_size=batch_size,
+    )
+
+    return report
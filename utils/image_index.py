@@ -0,0 +1,430 @@
+"""
+This collection of functions and classes scans a plate directory of images once and saves an index of every image
+(plate, well, site, and channel with the path, size, modified time, and TIFF dimensions/data type) as a CSV file.
+Each stage can look up images in the index instead of walking the filesystem, and missing channels or corrupt images
+are found before CellProfiler starts.
+"""
+
+import csv
+import os
+import pathlib
+import re
+import struct
+from collections import Counter
+from typing import Dict, List, Optional, Set, Tuple
+
+from errors.exceptions import ImageIndexError
+
+# regex from the CellProfiler pipelines to extract the well, site, and channel from the image file names
+IMAGE_SET_REGEX = re.compile(
+    r"(?P<Well>[A-H][0-9]{2})(?P<Site>f[0-9]{2})(?P<Channel>d[0-4])"
+)
+
+# file extensions that CellProfiler will load as images
+IMAGE_EXTENSIONS = (".tif", ".tiff")
+
+# channels for each image set (d0 to d4)
+CHANNELS = [f"d{i}" for i in range(5)]
+
+# columns in the image index CSV file
+INDEX_COLUMNS = [
+    "plate",
+    "well",
+    "site",
+    "channel",
+    "path",
+    "size",
+    "mtime",
+    "width",
+    "height",
+    "dtype",
+    "error",
+]
+
+# TIFF tags needed to find the dimensions and data type of an image and check that the pixel data is in the file
+TIFF_TAGS = {
+    256: "width",
+    257: "height",
+    258: "bits_per_sample",
+    273: "strip_offsets",
+    277: "samples_per_pixel",
+    279: "strip_byte_counts",
+    324: "tile_offsets",
+    325: "tile_byte_counts",
+    339: "sample_format",
+}
+
+# struct formats for the TIFF field types that are used by the tags above (BYTE, SHORT, LONG, and LONG8)
+TIFF_TYPES = {1: "B", 3: "H", 4: "I", 16: "Q"}
+
+# data type from the TIFF sample format (1 = unsigned integer, 2 = signed integer, 3 = float)
+SAMPLE_FORMATS = {1: "uint", 2: "int", 3: "float"}
+
+
+def read_tiff_header(file_path: pathlib.Path) -> dict:
+    """Read the dimensions and data type of a TIFF image from the first image file directory (IFD) without loading
+    the pixel data, and check that the pixel data is not cut off (e.g., from an incomplete download).
+
+    Args:
+        file_path (pathlib.Path): path to the TIFF image
+
+    Raises:
+        ValueError: if the file is not a TIFF image or the header or pixel data is incomplete
+
+    Returns:
+        dict: dictionary with the "width", "height", and "dtype" of the image (e.g., "uint16")
+    """
+    file_size = os.path.getsize(file_path)
+    with open(file_path, "rb") as tiff_file:
+        header = tiff_file.read(16)
+        if header[:2] == b"II":
+            byte_order = "<"
+        elif header[:2] == b"MM":
+            byte_order = ">"
+        else:
+            raise ValueError("not a TIFF file")
+
+        version = struct.unpack(f"{byte_order}H", header[2:4])[0]
+        if version == 42:
+            # classic TIFF uses 32-bit offsets and 12 byte IFD entries
+            ifd_offset = struct.unpack(f"{byte_order}I", header[4:8])[0]
+            count_format, entry_format, entry_size, value_size = "H", "HHI", 12, 4
+        elif version == 43:
+            # BigTIFF uses 64-bit offsets and 20 byte IFD entries
+            ifd_offset = struct.unpack(f"{byte_order}Q", header[8:16])[0]
+            count_format, entry_format, entry_size, value_size = "Q", "HHQ", 20, 8
+        else:
+            raise ValueError(f"unknown TIFF version {version}")
+
+        tiff_file.seek(ifd_offset)
+        count_size = struct.calcsize(count_format)
+        count_bytes = tiff_file.read(count_size)
+        if len(count_bytes) < count_size:
+            raise ValueError("incomplete TIFF header")
+        num_entries = struct.unpack(f"{byte_order}{count_format}", count_bytes)[0]
+        entries = tiff_file.read(num_entries * entry_size)
+        if len(entries) < num_entries * entry_size:
+            raise ValueError("incomplete TIFF header")
+
+        tags = {}
+        for i in range(num_entries):
+            entry = entries[i * entry_size : (i + 1) * entry_size]
+            tag, field_type, count = struct.unpack(
+                f"{byte_order}{entry_format}", entry[: entry_size - value_size]
+            )
+            if tag not in TIFF_TAGS or field_type not in TIFF_TYPES:
+                continue
+            value_format = f"{byte_order}{count}{TIFF_TYPES[field_type]}"
+            value_bytes = entry[entry_size - value_size :]
+            # values that do not fit in the entry are stored at an offset in the file
+            if struct.calcsize(value_format) > value_size:
+                offset = struct.unpack(
+                    f"{byte_order}{'I' if value_size == 4 else 'Q'}", value_bytes
+                )[0]
+                tiff_file.seek(offset)
+                value_bytes = tiff_file.read(struct.calcsize(value_format))
+                if len(value_bytes) < struct.calcsize(value_format):
+                    raise ValueError("incomplete TIFF header")
+            else:
+                value_bytes = value_bytes[: struct.calcsize(value_format)]
+            tags[TIFF_TAGS[tag]] = struct.unpack(value_format, value_bytes)
+
+    if "width" not in tags or "height" not in tags:
+        raise ValueError("TIFF header is missing the image dimensions")
+
+    # make sure the last strip (or tile) of pixel data ends before the end of the file
+    offsets = tags.get("strip_offsets", tags.get("tile_offsets"))
+    byte_counts = tags.get("strip_byte_counts", tags.get("tile_byte_counts"))
+    if offsets is None or byte_counts is None:
+        raise ValueError("TIFF header is missing the location of the pixel data")
+    if max(offset + count for offset, count in zip(offsets, byte_counts)) > file_size:
+        raise ValueError("pixel data is cut off")
+
+    bits_per_sample = tags.get("bits_per_sample", (1,))[0]
+    sample_format = SAMPLE_FORMATS.get(tags.get("sample_format", (1,))[0], "unknown")
+    samples_per_pixel = tags.get("samples_per_pixel", (1,))[0]
+    dtype = f"{sample_format}{bits_per_sample}"
+    if samples_per_pixel > 1:
+        dtype = f"{dtype}x{samples_per_pixel}"
+
+    return {"width": tags["width"][0], "height": tags["height"][0], "dtype": dtype}
+
+
+class ImageIndex:
+    """
+    Index of the images in one plate directory, with one row per image keyed by (well, site, channel).
+    """
+
+    def __init__(self, plate: str, rows: List[dict]):
+        """
+        Args:
+            plate (str): name of the plate
+            rows (List[dict]): one dictionary per image with the columns in `INDEX_COLUMNS`
+        """
+        self.plate = plate
+        self.rows = rows
+        self._paths = {
+            (row["well"], row["site"], row["channel"]): row["path"] for row in rows
+        }
+
+    @classmethod
+    def build(
+        cls,
+        plate_dir: pathlib.Path,
+        plate: Optional[str] = None,
+        index_path: Optional[pathlib.Path] = None,
+    ) -> "ImageIndex":
+        """Scan a plate directory and create the index, saving it as a CSV file if an index path is given. If the
+        index file already exists, the TIFF header is only read again for images that changed size or modified time.
+
+        Args:
+            plate_dir (pathlib.Path): directory with the images for the plate (subfolders are included)
+            plate (Optional[str], optional): name of the plate. Defaults to None, which uses the name of the directory.
+            index_path (Optional[pathlib.Path], optional): path to the CSV file to save the index. Defaults to None.
+
+        Returns:
+            ImageIndex: index for the plate
+        """
+        plate_dir = pathlib.Path(plate_dir).resolve(strict=True)
+        plate = plate or plate_dir.name
+
+        # reuse the rows from the saved index for images that have not changed
+        previous_rows = {}
+        if index_path is not None and pathlib.Path(index_path).exists():
+            previous_rows = {row["path"]: row for row in cls.load(index_path).rows}
+
+        rows = []
+        for file_path in sorted(plate_dir.rglob("*")):
+            if file_path.suffix.lower() not in IMAGE_EXTENSIONS:
+                continue
+            match = IMAGE_SET_REGEX.search(file_path.name)
+            if match is None:
+                continue
+            stat = file_path.stat()
+            previous_row = previous_rows.get(str(file_path))
+            if (
+                previous_row is not None
+                and previous_row["size"] == stat.st_size
+                and previous_row["mtime"] == stat.st_mtime
+            ):
+                rows.append(previous_row)
+                continue
+
+            row = {
+                "plate": plate,
+                "well": match.group("Well"),
+                "site": match.group("Site"),
+                "channel": match.group("Channel"),
+                "path": str(file_path),
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+                "width": None,
+                "height": None,
+                "dtype": None,
+                "error": None,
+            }
+            try:
+                row.update(read_tiff_header(file_path))
+            except (OSError, ValueError, struct.error) as error:
+                row["error"] = str(error)
+            rows.append(row)
+
+        index = cls(plate=plate, rows=rows)
+        if index_path is not None:
+            index.save(index_path)
+
+        return index
+
+    @classmethod
+    def load(cls, index_path: pathlib.Path) -> "ImageIndex":
+        """Load an index from a CSV file.
+
+        Args:
+            index_path (pathlib.Path): path to the CSV file with the index
+
+        Returns:
+            ImageIndex: index for the plate
+        """
+        rows = []
+        with open(index_path, newline="") as index_file:
+            for row in csv.DictReader(index_file):
+                for column in ["size", "width", "height"]:
+                    row[column] = int(row[column]) if row[column] else None
+                row["mtime"] = float(row["mtime"])
+                row["dtype"] = row["dtype"] or None
+                row["error"] = row["error"] or None
+                rows.append(row)
+        plate = rows[0]["plate"] if rows else pathlib.Path(index_path).stem
+
+        return cls(plate=plate, rows=rows)
+
+    def save(self, index_path: pathlib.Path) -> None:
+        """Save the index as a CSV file, writing to a temporary file first so the index is never left half written.
+
+        Args:
+            index_path (pathlib.Path): path to the CSV file to save the index
+        """
+        index_path = pathlib.Path(index_path)
+        index_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = index_path.with_suffix(".csv.tmp")
+        with open(temp_path, "w", newline="") as index_file:
+            writer = csv.DictWriter(index_file, fieldnames=INDEX_COLUMNS)
+            writer.writeheader()
+            writer.writerows(self.rows)
+        os.replace(temp_path, index_path)
+
+    def path(self, well: str, site: str, channel: str) -> pathlib.Path:
+        """Find the path to the image for a well, site, and channel.
+
+        Args:
+            well (str): well (e.g., "B02")
+            site (str): site (e.g., "f01")
+            channel (str): channel (e.g., "d0")
+
+        Raises:
+            ImageIndexError: if there is no image for the well, site, and channel in the index
+
+        Returns:
+            pathlib.Path: path to the image
+        """
+        key = (well, site, channel)
+        if key not in self._paths:
+            raise ImageIndexError(
+                f"There is no image for well {well}, site {site}, and channel {channel} in plate {self.plate}."
+            )
+        return pathlib.Path(self._paths[key])
+
+    def image_sets(self) -> List[Tuple[str, str]]:
+        """List the image sets (well and site) in the plate.
+
+        Returns:
+            List[Tuple[str, str]]: sorted (well, site) for each image set
+        """
+        return sorted({(row["well"], row["site"]) for row in self.rows})
+
+    def write_file_list(
+        self,
+        file_list_path: pathlib.Path,
+        excluded_image_sets: Optional[Set[Tuple[str, str]]] = None,
+    ) -> int:
+        """Write the paths to the images for each image set that is not excluded as a CellProfiler file list (one path
+        per line), which is used with `--file-list` instead of loading the whole plate directory.
+
+        Args:
+            file_list_path (pathlib.Path): path to the file list
+            excluded_image_sets (Optional[Set[Tuple[str, str]]], optional): (well, site) of the image sets to skip.
+            Defaults to None.
+
+        Returns:
+            int: number of image sets in the file list
+        """
+        excluded_image_sets = excluded_image_sets or set()
+        image_sets = [
+            image_set
+            for image_set in self.image_sets()
+            if image_set not in excluded_image_sets
+        ]
+        included = set(image_sets)
+        rows = sorted(
+            (row for row in self.rows if (row["well"], row["site"]) in included),
+            key=lambda row: (row["well"], row["site"], row["channel"]),
+        )
+
+        file_list_path = pathlib.Path(file_list_path)
+        file_list_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(file_list_path, "w") as file_list:
+            file_list.writelines(f"{row['path']}\n" for row in rows)
+
+        return len(image_sets)
+
+    def find_problems(self, channels: List[str] = CHANNELS) -> List[str]:
+        """Find image sets that are missing channels, images that could not be read, and images with different
+        dimensions or data type than most images in the plate.
+
+        Args:
+            channels (List[str], optional): channels expected for every image set. Defaults to CHANNELS (d0 to d4).
+
+        Returns:
+            List[str]: one message per problem (empty if there are no problems)
+        """
+        problems = []
+        for well, site in self.image_sets():
+            missing = [
+                channel
+                for channel in channels
+                if (well, site, channel) not in self._paths
+            ]
+            if missing:
+                problems.append(
+                    f"{self.plate} {well}{site} is missing channel(s) {', '.join(missing)}"
+                )
+
+        readable_rows = [row for row in self.rows if row["error"] is None]
+        for row in self.rows:
+            if row["error"] is not None:
+                problems.append(f"{row['path']} could not be read ({row['error']})")
+
+        # images from one plate are expected to all have the same dimensions and data type
+        if readable_rows:
+            expected = Counter(
+                (row["width"], row["height"], row["dtype"]) for row in readable_rows
+            ).most_common(1)[0][0]
+            for row in readable_rows:
+                if (row["width"], row["height"], row["dtype"]) != expected:
+                    problems.append(
+                        f"{row['path']} is {row['width']}x{row['height']} {row['dtype']} (expected {expected[0]}x{expected[1]} {expected[2]})"
+                    )
+
+        return problems
+
+    def validate(self, channels: List[str] = CHANNELS) -> None:
+        """Check the index for problems before running CellProfiler.
+
+        Args:
+            channels (List[str], optional): channels expected for every image set. Defaults to CHANNELS (d0 to d4).
+
+        Raises:
+            ImageIndexError: if there are no images or any problems are found (all problems are in the message)
+        """
+        if not self.rows:
+            raise ImageIndexError(
+                f"There are no images in the index for plate {self.plate}."
+            )
+        problems = self.find_problems(channels=channels)
+        if problems:
+            raise ImageIndexError(
+                f"{len(problems)} problem(s) were found in the images for plate {self.plate}:\n"
+                + "\n".join(problems)
+            )
+
+
+def build_plate_indexes(
+    plate_dirs: Dict[str, pathlib.Path], index_dir: pathlib.Path
+) -> Dict[str, ImageIndex]:
+    """Build (or update) and validate the image index for each plate, saving each index as
+    `{index_dir}/{plate}_image_index.csv`.
+
+    Args:
+        plate_dirs (Dict[str, pathlib.Path]): dictionary with plate names as keys and image directories as values
+        index_dir (pathlib.Path): directory to save the index for each plate
+
+    Raises:
+        ImageIndexError: if any plate has missing channels or corrupt images
+
+    Returns:
+        Dict[str, ImageIndex]: dictionary with plate names as keys and image indexes as values
+    """
+    indexes = {}
+    for plate, plate_dir in plate_dirs.items():
+        indexes[plate] = ImageIndex.build(
+            plate_dir=plate_dir,
+            plate=plate,
+            index_path=pathlib.Path(f"{index_dir}/{plate}_image_index.csv"),
+        )
+        print(
+            f"{plate}: {len(indexes[plate].rows)} images in {len(indexes[plate].image_sets())} image sets"
+        )
+    for index in indexes.values():
+        index.validate()
+
+    return indexes
@@ -0,0 +1,301 @@
+"""
+This collection of functions standardizes (z-scores) single-cell profiles saved as a parquet file without loading the
+whole plate into memory, giving the same result as `pycytominer.normalize(method="standardize")`. The file is read
+twice, one batch of rows at a time: the first pass finds the mean and standard deviation of each feature for the
+samples used as the reference (by merging the mean and sum of squares from each batch), and the second pass writes the
+standardized features for every single cell. The two passes are separate functions, so the mean and standard deviation
+from one plate can be saved and used to standardize another plate (see transform_utils).
+"""
+
+import os
+import pathlib
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# prefixes of the feature columns (the same compartments that pycytominer infers)
+FEATURE_PREFIXES = ("Cells_", "Cytoplasm_", "Nuclei_")
+
+
+def infer_columns(schema: pa.Schema) -> Tuple[List[str], List[str]]:
+    """Find the metadata columns (`Metadata_` prefix) and numeric feature columns (see FEATURE_PREFIXES) in a parquet
+    schema, in the order of the file.
+
+    Args:
+        schema (pa.Schema): Arrow schema of the parquet file
+
+    Returns:
+        Tuple[List[str], List[str]]: metadata columns and feature columns
+    """
+    meta_features = [
+        field.name for field in schema if field.name.startswith("Metadata_")
+    ]
+    features = [
+        field.name
+        for field in schema
+        if field.name.startswith(FEATURE_PREFIXES)
+        and (pa.types.is_floating(field.type) or pa.types.is_integer(field.type))
+    ]
+
+    return meta_features, features
+
+
+def merge_moments(
+    count: np.ndarray, mean: np.ndarray, sum_squares: np.ndarray, values: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Merge the count, mean, and sum of squared differences from the mean of each feature for a batch of rows into
+    the totals from the previous batches (Chan et al. parallel variance), skipping missing values.
+
+    Args:
+        count (np.ndarray): number of values for each feature in the previous batches
+        mean (np.ndarray): mean of each feature in the previous batches
+        sum_squares (np.ndarray): sum of squared differences from the mean of each feature in the previous batches
+        values (np.ndarray): batch of rows with one column for each feature
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: updated count, mean, and sum of squares for each feature
+    """
+    is_value = ~np.isnan(values)
+    batch_count = is_value.sum(axis=0)
+    batch_mean = np.divide(
+        np.where(is_value, values, 0).sum(axis=0),
+        batch_count,
+        out=np.zeros(values.shape[1]),
+        where=batch_count > 0,
+    )
+    batch_sum_squares = np.where(is_value, values - batch_mean, 0) ** 2
+    batch_sum_squares = batch_sum_squares.sum(axis=0)
+
+    total_count = count + batch_count
+    delta = batch_mean - mean
+    batch_weight = np.divide(
+        batch_count,
+        total_count,
+        out=np.zeros(values.shape[1]),
+        where=total_count > 0,
+    )
+    mean = mean + delta * batch_weight
+    sum_squares = sum_squares + batch_sum_squares + delta**2 * count * batch_weight
+
+    return total_count, mean, sum_squares
+
+
+def iter_sample_blocks(
+    parquet_file: pq.ParquetFile,
+    features: List[str],
+    samples: str = "all",
+    batch_size: int = 10000,
+) -> Iterator[np.ndarray]:
+    """Read the features for the samples in a parquet file one batch of rows at a time.
+
+    Args:
+        parquet_file (pq.ParquetFile): parquet file with the single-cell profiles
+        features (List[str]): feature columns to read
+        samples (str, optional): query for the samples to read (e.g., "Metadata_treatment == 'DMSO'"). Defaults to
+        "all".
+        batch_size (int, optional): maximum number of rows to read at a time. Defaults to 10000.
+
+    Yields:
+        np.ndarray: batch of rows for the samples with one column for each feature
+    """
+    # the query can use any metadata column, so they are read with the features
+    columns = features
+    if samples != "all":
+        columns = infer_columns(parquet_file.schema_arrow)[0] + features
+
+    for batch in parquet_file.iter_batches(batch_size=batch_size, columns=columns):
+        batch_df = batch.to_pandas()
+        if samples != "all":
+            batch_df = batch_df.query(samples)
+        yield batch_df[features].to_numpy(dtype=np.float64)
+
+
+def iter_df_blocks(
+    profiles: pd.DataFrame,
+    features: List[str],
+    samples: str = "all",
+    block_size: int = 10000,
+) -> Iterator[np.ndarray]:
+    """Get the features for the samples in a data frame one block of rows at a time.
+
+    Args:
+        profiles (pd.DataFrame): single-cell profiles
+        features (List[str]): feature columns to get
+        samples (str, optional): query for the samples to get (e.g., "Metadata_treatment == 'DMSO'"). Defaults to
+        "all".
+        block_size (int, optional): number of rows in each block. Defaults to 10000.
+
+    Yields:
+        np.ndarray: block of rows for the samples with one column for each feature
+    """
+    values = (profiles if samples == "all" else profiles.query(samples))[features]
+    for start in range(0, values.shape[0], block_size):
+        yield values.iloc[start : start + block_size].to_numpy(dtype=np.float64)
+
+
+def compute_standardize_stats(
+    blocks: Iterable[np.ndarray], num_features: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Find the mean and standard deviation of each feature for the samples used as the reference, merging one block
+    of rows at a time. Like the StandardScaler used by pycytominer, the standard deviation is for the population,
+    missing values are skipped, and features without variance have a standard deviation of 1.
+
+    Args:
+        blocks (Iterable[np.ndarray]): blocks of rows for the reference samples with one column for each feature
+        (e.g., from `iter_sample_blocks`)
+        num_features (int): number of features
+
+    Raises:
+        ValueError: if there are no rows
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: mean and standard deviation of each feature
+    """
+    count = np.zeros(num_features)
+    mean = np.zeros(num_features)
+    sum_squares = np.zeros(num_features)
+    num_samples = 0
+    for values in blocks:
+        num_samples += values.shape[0]
+        count, mean, sum_squares = merge_moments(
+            count=count, mean=mean, sum_squares=sum_squares, values=values
+        )
+
+    if num_samples == 0:
+        raise ValueError(
+            "There are no single cells to find the mean and standard deviation with."
+        )
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = np.where(count > 0, mean, np.nan)
+        std = np.sqrt(np.where(count > 0, sum_squares / count, np.nan))
+    # features without variance are only centered (the same as StandardScaler)
+    std[std < 10 * np.finfo(np.float64).eps] = 1.0
+
+    return mean, std
+
+
+def write_standardized_parquet(
+    input_path: pathlib.Path,
+    output_path: pathlib.Path,
+    features: List[str],
+    center: np.ndarray,
+    scale: np.ndarray,
+    meta_features: Optional[List[str]] = None,
+    batch_size: int = 10000,
+) -> int:
+    """Write the metadata columns and the standardized features ((value - center) / scale, as float64) from a parquet
+    file one batch of rows at a time. The center and scale can be from the same file or from a reference plate.
+
+    Args:
+        input_path (pathlib.Path): path to the parquet file with the single-cell profiles (e.g., annotated profiles)
+        output_path (pathlib.Path): path to save the standardized profiles
+        features (List[str]): feature columns to standardize (other features are not written)
+        center (np.ndarray): value to subtract from each feature
+        scale (np.ndarray): value to divide each feature by
+        meta_features (Optional[List[str]], optional): metadata columns to keep. Defaults to None (inferred).
+        batch_size (int, optional): maximum number of rows to read at a time. Defaults to 10000.
+
+    Returns:
+        int: number of rows written
+    """
+    output_path = pathlib.Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = output_path.with_name(f".{output_path.name}.tmp")
+    center = np.asarray(center, dtype=np.float64)
+    scale = np.asarray(scale, dtype=np.float64)
+
+    num_rows = 0
+    with open(input_path, "rb") as input_file:
+        parquet_file = pq.ParquetFile(input_file)
+        if meta_features is None:
+            meta_features = infer_columns(parquet_file.schema_arrow)[0]
+
+        schema = pa.schema(
+            [parquet_file.schema_arrow.field(column) for column in meta_features]
+            + [pa.field(feature, pa.float64()) for feature in features]
+        )
+        try:
+            with pq.ParquetWriter(temp_path, schema) as writer:
+                for batch in parquet_file.iter_batches(
+                    batch_size=batch_size, columns=meta_features + features
+                ):
+                    values = np.column_stack(
+                        [
+                            batch.column(feature).to_numpy(zero_copy_only=False)
+                            for feature in features
+                        ]
+                    ).astype(np.float64)
+                    standardized = (values - center) / scale
+                    arrays = [batch.column(column) for column in meta_features] + [
+                        # missing values are written as nulls, the same as pandas
+                        pa.array(standardized[:, index], from_pandas=True)
+                        for index in range(len(features))
+                    ]
+                    writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+                    num_rows += batch.num_rows
+        except BaseException:
+            temp_path.unlink(missing_ok=True)
+            raise
+    os.replace(temp_path, output_path)
+
+    return num_rows
+
+
+def standardize_parquet(
+    input_path: pathlib.Path,
+    output_path: pathlib.Path,
+    samples: str = "all",
+    features: Optional[List[str]] = None,
+    meta_features: Optional[List[str]] = None,
+    batch_size: int = 10000,
+) -> pd.DataFrame:
+    """Standardize the features in a parquet file with two passes over the file, so only one batch of rows is in
+    memory at a time. The output has the metadata columns followed by the standardized features (as float64), the same
+    as `pycytominer.normalize(method="standardize")`.
+
+    Args:
+        input_path (pathlib.Path): path to the parquet file with the single-cell profiles (e.g., annotated profiles)
+        output_path (pathlib.Path): path to save the standardized profiles
+        samples (str, optional): query for the samples to use as the reference (e.g., "Metadata_treatment == 'DMSO'").
+        Defaults to "all".
+        features (Optional[List[str]], optional): feature columns to standardize. Defaults to None (inferred).
+        meta_features (Optional[List[str]], optional): metadata columns to keep. Defaults to None (inferred).
+        batch_size (int, optional): maximum number of rows to read at a time. Defaults to 10000.
+
+    Returns:
+        pd.DataFrame: "center" (mean) and "scale" (standard deviation) of each feature (index)
+    """
+    with open(input_path, "rb") as input_file:
+        parquet_file = pq.ParquetFile(input_file)
+        if features is None:
+            features = infer_columns(parquet_file.schema_arrow)[1]
+
+        # Pass 1: mean and standard deviation of the reference samples
+        center, scale = compute_standardize_stats(
+            blocks=iter_sample_blocks(
+                parquet_file=parquet_file,
+                features=features,
+                samples=samples,
+                batch_size=batch_size,
+            ),
+            num_features=len(features),
+        )
+
+    # Pass 2: write the standardized features for every single cell
+    write_standardized_parquet(
+        input_path=input_path,
+        output_path=output_path,
+        features=features,
+        center=center,
+        scale=scale,
+        meta_features=meta_features,
+        batch_size=batch_size,
+    )
+
+    return pd.DataFrame(
+        {"center": center, "scale": scale}, index=pd.Index(features, name="feature")
+    )
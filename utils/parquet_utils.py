@@ -0,0 +1,159 @@
+"""
+This collection of functions updates parquet files (e.g., converted profiles) one batch of rows at a time instead of
+loading the whole file into pandas. Columns can be renamed, moved, or dropped, rows can be removed with a filter, and
+columns with one value can be added. The updated file is written to a temporary file next to the output and moved to
+the output path once all batches are written.
+"""
+
+import os
+import pathlib
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+
+def not_null_filter(column: str) -> Callable[[pa.RecordBatch], pa.Array]:
+    """Create a row filter that keeps rows where a column is not null or NaN.
+
+    Args:
+        column (str): name of the column (after renaming)
+
+    Returns:
+        Callable[[pa.RecordBatch], pa.Array]: row filter for `transform_parquet`
+    """
+    return lambda batch: pc.invert(pc.is_null(batch.column(column), nan_is_null=True))
+
+
+def mask_filter(keep_mask: np.ndarray) -> Callable[[pa.RecordBatch], pa.Array]:
+    """Create a row filter from a boolean mask for every row in the file (e.g., the single cells that passed QC),
+    which is applied to the batches in the order they are read.
+
+    Args:
+        keep_mask (np.ndarray): boolean mask of the rows to keep, in the same order as the rows in the file
+
+    Returns:
+        Callable[[pa.RecordBatch], pa.Array]: row filter for `transform_parquet`
+    """
+    keep_mask = np.asarray(keep_mask, dtype=bool)
+    position = [0]
+
+    def filter_batch(batch: pa.RecordBatch) -> pa.Array:
+        start = position[0]
+        position[0] += batch.num_rows
+        return pa.array(keep_mask[start : position[0]])
+
+    return filter_batch
+
+
+def transform_batch(
+    batch: pa.RecordBatch,
+    rename: Dict[str, str],
+    first_columns: List[str],
+    drop_columns: List[str],
+    row_filter: Optional[Callable[[pa.RecordBatch], pa.Array]],
+    constant_columns: Dict[str, Any],
+) -> pa.RecordBatch:
+    """Update one batch of rows from a parquet file.
+
+    Args:
+        batch (pa.RecordBatch): rows from the parquet file
+        rename (Dict[str, str]): dictionary with current column names as keys and new names as values
+        first_columns (List[str]): columns (after renaming) to move to the front in this order
+        drop_columns (List[str]): columns (after renaming) to remove
+        row_filter (Optional[Callable[[pa.RecordBatch], pa.Array]]): function that returns a boolean mask of the
+        rows to keep from the renamed batch
+        constant_columns (Dict[str, Any]): dictionary with column names as keys and the value for every row as
+        values (an existing column is replaced in the same position, otherwise it is added to the end)
+
+    Returns:
+        pa.RecordBatch: updated rows
+    """
+    batch = batch.rename_columns(
+        [rename.get(name, name) for name in batch.schema.names]
+    )
+
+    if row_filter is not None:
+        batch = batch.filter(row_filter(batch))
+
+    names = [name for name in batch.schema.names if name not in drop_columns]
+    arrays = {name: batch.column(name) for name in names}
+    for name, value in constant_columns.items():
+        if name not in arrays:
+            names.append(name)
+        arrays[name] = pa.array([value] * batch.num_rows, type=pa.scalar(value).type)
+
+    order = [name for name in first_columns if name in arrays] + [
+        name for name in names if name not in first_columns
+    ]
+
+    return pa.RecordBatch.from_arrays([arrays[name] for name in order], names=order)
+
+
+def transform_parquet(
+    input_path: pathlib.Path,
+    output_path: Optional[pathlib.Path] = None,
+    rename: Optional[Dict[str, str]] = None,
+    first_columns: Optional[List[str]] = None,
+    drop_columns: Optional[List[str]] = None,
+    row_filter: Optional[Callable[[pa.RecordBatch], pa.Array]] = None,
+    constant_columns: Optional[Dict[str, Any]] = None,
+    batch_size: int = 65536,
+) -> int:
+    """Rename, move, drop, or add columns and remove rows from a parquet file one batch of rows at a time, so the
+    memory used is one batch instead of the whole file.
+
+    Args:
+        input_path (pathlib.Path): path to the parquet file
+        output_path (Optional[pathlib.Path], optional): path to save the updated parquet file. Defaults to None
+        (the input file is replaced).
+        rename (Optional[Dict[str, str]], optional): dictionary with current column names as keys and new names as
+        values. Defaults to None.
+        first_columns (Optional[List[str]], optional): columns (after renaming) to move to the front in this order,
+        other columns keep their order. Defaults to None.
+        drop_columns (Optional[List[str]], optional): columns (after renaming) to remove. Defaults to None.
+        row_filter (Optional[Callable[[pa.RecordBatch], pa.Array]], optional): function that returns a boolean mask
+        of the rows to keep from the renamed batch (e.g., `not_null_filter("Metadata_ImageNumber")`). Defaults to None.
+        constant_columns (Optional[Dict[str, Any]], optional): dictionary with column names as keys and the value
+        for every row as values. Defaults to None.
+        batch_size (int, optional): maximum number of rows to read at a time. Defaults to 65536.
+
+    Returns:
+        int: number of rows written
+    """
+    input_path = pathlib.Path(input_path)
+    output_path = input_path if output_path is None else pathlib.Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    transform = dict(
+        rename=rename or {},
+        first_columns=first_columns or [],
+        drop_columns=drop_columns or [],
+        row_filter=row_filter,
+        constant_columns=constant_columns or {},
+    )
+
+    temp_path = output_path.with_name(f".{output_path.name}.tmp")
+    num_rows = 0
+    with open(input_path, "rb") as input_file:
+        parquet_file = pq.ParquetFile(input_file)
+        # find the schema of the output from an empty batch so files without rows are still written
+        empty_batch = pa.RecordBatch.from_arrays(
+            [pa.array([], type=field.type) for field in parquet_file.schema_arrow],
+            schema=parquet_file.schema_arrow,
+        )
+        schema = transform_batch(empty_batch, **transform).schema
+
+        try:
+            with pq.ParquetWriter(temp_path, schema) as writer:
+                for batch in parquet_file.iter_batches(batch_size=batch_size):
+                    batch = transform_batch(batch, **transform)
+                    writer.write_table(pa.Table.from_batches([batch], schema=schema))
+                    num_rows += batch.num_rows
+        except BaseException:
+            temp_path.unlink(missing_ok=True)
+            raise
+    os.replace(temp_path, output_path)
+
+    return num_rows
@@ -0,0 +1,71 @@
+"""
+This collection of functions turns the whole image QC outliers (`qc_outliers.csv` from `1.evaluate_qc`) into a list of
+image sets to exclude for each plate, and writes a CellProfiler file list per plate without those image sets so
+flagged FOVs are never processed by illumination correction or analysis.
+"""
+
+import csv
+import pathlib
+from typing import Dict, Set, Tuple
+
+from image_index import ImageIndex
+
+
+def load_qc_exclusions(outliers_path: pathlib.Path) -> Dict[str, Set[Tuple[str, str]]]:
+    """Load the image sets (well and site) flagged as blur or saturation outliers for each plate. An image set is
+    excluded if any of its channels is an outlier.
+
+    Args:
+        outliers_path (pathlib.Path): path to the QC outliers CSV file with "Metadata_Plate", "Metadata_Well", and
+        "Metadata_Site" columns
+
+    Raises:
+        ValueError: if an outlier does not have a plate, well, or site (the outliers need to be created again)
+
+    Returns:
+        Dict[str, Set[Tuple[str, str]]]: dictionary with plate names as keys and (well, site) to exclude as values
+    """
+    exclusions = {}
+    with open(outliers_path, newline="") as outliers_file:
+        for row in csv.DictReader(outliers_file):
+            plate = row.get("Metadata_Plate")
+            well = row.get("Metadata_Well")
+            site = row.get("Metadata_Site")
+            if not plate or not well or not site:
+                raise ValueError(
+                    f"An outlier in {pathlib.Path(outliers_path).name} is missing the plate, well, or site. Please run 1.evaluate_qc again to create the outliers."
+                )
+            exclusions.setdefault(plate, set()).add((well, site))
+
+    return exclusions
+
+
+def write_qc_file_lists(
+    plate_info_dictionary: dict,
+    image_indexes: Dict[str, ImageIndex],
+    outliers_path: pathlib.Path,
+    file_list_dir: pathlib.Path,
+) -> None:
+    """Write a CellProfiler file list for each plate without the image sets flagged by whole image QC and add the
+    "path_to_file_list" to the plate info so CellProfiler only loads the images in the file list.
+
+    Args:
+        plate_info_dictionary (dict): dictionary with all paths for CellProfiler to run a pipeline
+        image_indexes (Dict[str, ImageIndex]): dictionary with plate names as keys and image indexes as values
+        outliers_path (pathlib.Path): path to the QC outliers CSV file
+        file_list_dir (pathlib.Path): directory to save the file list for each plate as `{plate}_file_list.txt`
+    """
+    exclusions = load_qc_exclusions(outliers_path)
+
+    for plate, info in plate_info_dictionary.items():
+        excluded_image_sets = exclusions.get(plate, set())
+        file_list_path = pathlib.Path(
+            f"{file_list_dir}/{plate}_file_list.txt"
+        ).resolve()
+        num_image_sets = image_indexes[plate].write_file_list(
+            file_list_path=file_list_path, excluded_image_sets=excluded_image_sets
+        )
+        info["path_to_file_list"] = file_list_path
+        print(
+            f"{plate}: {num_image_sets} image sets will be processed ({len(image_indexes[plate].image_sets()) - num_image_sets} image sets skipped from QC)"
+        )
@@ -0,0 +1,420 @@
+"""
+This utility file holds functions for calculating and evaluating whole image QC metrics. The blur (PowerLogLogSlope)
+and saturation (PercentMaximal) metrics can be calculated with NumPy across a process pool, writing the same columns
+as the `Image.csv` from the CellProfiler QC pipeline. The `ImageQuality_*` metrics for every channel are reshaped from
+wide to long in one pass, z-scored per plate and channel (or any other grouping), and compared against channel/metric
+rules to create an image level pass/fail mask.
+"""
+
+import csv
+import os
+import pathlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import tifffile
+from image_index import ImageIndex
+
+# regex to split ImageQuality columns into the metric and channel (e.g., "ImageQuality_PercentMaximal_OrigDNA")
+QC_COLUMN_REGEX = r"^ImageQuality_(?P<Metric>[A-Za-z]+)_Orig(?P<Channel>[A-Za-z]+)$"
+
+# regex to extract the well and site from the file name of an image (same for all channels)
+WELL_REGEX = r"_(\w{3})\w*\.TIF"
+SITE_REGEX = r"_\w{3}(\w{3})\w*\.TIF"
+
+# image names for each channel in the whole image QC pipeline (NamesAndTypes module)
+QC_CHANNELS = {
+    "d0": "OrigDNA",
+    "d1": "OrigER",
+    "d2": "OrigPM",
+    "d3": "OrigMito",
+    "d4": "OrigActin",
+}
+
+# rules used for CFReT, where only the DNA and PM channels are used to flag blur (above or below the mean) and
+# saturation (large smudges in DNA and overlapping cells in PM)
+DEFAULT_QC_RULES = [
+    {
+        "name": "PowerLogLogSlope",
+        "metric": "PowerLogLogSlope",
+        "channels": ["DNA", "PM"],
+        "direction": "both",
+        "threshold_z": 2,
+    },
+    {
+        "name": "PercentMaximal",
+        "metric": "PercentMaximal",
+        "channels": ["DNA", "PM"],
+        "direction": "both",
+        "threshold_z": 2,
+    },
+]
+
+
+def calculate_power_log_log_slope(pixels: np.ndarray) -> float:
+    """Calculate the slope of the radial power spectrum on a log-log scale, which is the same as PowerLogLogSlope
+    from the CellProfiler MeasureImageQuality module (using `centrosome.radial_power_spectrum.rps`). Blurry images
+    have a slope closer to 0.
+
+    Args:
+        pixels (np.ndarray): 2D image
+
+    Returns:
+        float: PowerLogLogSlope for the image (0 if the image has one intensity value)
+    """
+    pixels = pixels.astype(np.float64)
+    if len(np.unique(pixels)) <= 1:
+        return 0.0
+
+    # distance of each frequency from the closest corner of the FFT (where the low frequencies are)
+    rows, columns = pixels.shape
+    radii2 = np.arange(rows).reshape((rows, 1)) ** 2 + np.arange(columns) ** 2
+    radii2 = np.minimum(radii2, np.flipud(radii2))
+    radii2 = np.minimum(radii2, np.fliplr(radii2))
+    radii = np.floor(np.sqrt(radii2)).astype(int) + 1
+
+    # normalize the intensity so the metric does not depend on the brightness of the image
+    pixels = pixels / np.median(np.abs(pixels - pixels.mean()))
+    magnitude = np.abs(np.fft.fft2(pixels - pixels.mean()))
+
+    # sum the magnitude and power for each radius, skipping the DC component and radii past 1/8 of the image width
+    labels = np.arange(2, np.floor(min(rows, columns) / 8.0)).astype(int)
+    if len(labels) == 0:
+        return 0.0
+    magnitude_sums = np.bincount(radii.ravel(), weights=magnitude.ravel())[labels]
+    power_sums = np.bincount(radii.ravel(), weights=(magnitude**2).ravel())[labels]
+    if magnitude_sums.sum() <= 0:
+        return 0.0
+
+    valid = magnitude_sums > 0
+    if valid.sum() <= 1:
+        return 0.0
+    log_radii = np.log(labels[valid])
+    log_power = np.log(power_sums[valid])
+    finite = np.isfinite(log_power)
+    design = np.column_stack((log_radii[finite], np.ones(finite.sum())))
+
+    return float(np.linalg.lstsq(design, log_power[finite], rcond=None)[0][0])
+
+
+def calculate_percent_maximal(pixels: np.ndarray) -> float:
+    """Calculate the percent of pixels at the maximum intensity of the image, which is the same as PercentMaximal
+    from the CellProfiler MeasureImageQuality module.
+
+    Args:
+        pixels (np.ndarray): 2D image
+
+    Returns:
+        float: percent of pixels at the maximum intensity
+    """
+    if pixels.size == 0:
+        return 0.0
+    return 100.0 * float(np.sum(pixels == pixels.max())) / float(pixels.size)
+
+
+def measure_image_set(image_set: Tuple[int, Dict[str, str]]) -> dict:
+    """Calculate the blur and saturation metrics for each channel of one image set (run in a worker process).
+
+    Args:
+        image_set (Tuple[int, Dict[str, str]]): image number and dictionary with the image name (e.g., "OrigDNA") as
+        keys and the path to the image as values
+
+    Returns:
+        dict: row for the image set with the same column names as `Image.csv` from the QC pipeline
+    """
+    image_number, image_paths = image_set
+    row = {"ImageNumber": image_number}
+    for image_name, image_path in image_paths.items():
+        pixels = tifffile.imread(image_path)
+        row[f"FileName_{image_name}"] = pathlib.Path(image_path).name
+        row[f"PathName_{image_name}"] = str(pathlib.Path(image_path).parent)
+        row[f"ImageQuality_PowerLogLogSlope_{image_name}"] = (
+            calculate_power_log_log_slope(pixels)
+        )
+        row[f"ImageQuality_PercentMaximal_{image_name}"] = calculate_percent_maximal(
+            pixels
+        )
+
+    return row
+
+
+def measure_plate_quality(
+    plate_index: ImageIndex,
+    output_path: pathlib.Path,
+    num_workers: Optional[int] = None,
+    chunksize: int = 8,
+    channels: Dict[str, str] = QC_CHANNELS,
+) -> int:
+    """Calculate the blur and saturation metrics for every image set in a plate with a process pool, writing each
+    row to the `Image.csv` as it is finished so only the images being processed are held in memory.
+
+    Args:
+        plate_index (ImageIndex): image index for the plate
+        output_path (pathlib.Path): path to the CSV file (e.g., `qc_results/<plate>/Image.csv`)
+        num_workers (Optional[int], optional): number of worker processes. Defaults to None (number of CPUs).
+        chunksize (int, optional): number of image sets sent to a worker at a time. Defaults to 8.
+        channels (Dict[str, str], optional): dictionary with channels as keys and image names as values. Defaults to
+        QC_CHANNELS.
+
+    Returns:
+        int: number of image sets measured
+    """
+    # image numbers are in the same order as the image sets (well and site), starting at 1 like CellProfiler
+    image_sets = [
+        (
+            image_number,
+            {
+                image_name: str(plate_index.path(well, site, channel))
+                for channel, image_name in channels.items()
+            },
+        )
+        for image_number, (well, site) in enumerate(plate_index.image_sets(), start=1)
+    ]
+    image_names = list(channels.values())
+    columns = (
+        ["ImageNumber"]
+        + [f"FileName_{name}" for name in image_names]
+        + [f"PathName_{name}" for name in image_names]
+        + [f"ImageQuality_PowerLogLogSlope_{name}" for name in image_names]
+        + [f"ImageQuality_PercentMaximal_{name}" for name in image_names]
+    )
+
+    output_path = pathlib.Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = output_path.with_suffix(".csv.tmp")
+    with open(temp_path, "w", newline="") as output_file, ProcessPoolExecutor(
+        max_workers=num_workers
+    ) as executor:
+        writer = csv.DictWriter(output_file, fieldnames=columns)
+        writer.writeheader()
+        for row in executor.map(measure_image_set, image_sets, chunksize=chunksize):
+            writer.writerow(row)
+    os.replace(temp_path, output_path)
+
+    return len(image_sets)
+
+
+def load_qc_results(
+    qc_results_dir: pathlib.Path,
+    plates: Optional[List[str]] = None,
+    file_name_column: str = "FileName_OrigActin",
+) -> pd.DataFrame:
+    """Load the `Image.csv` with the QC metrics for each plate and add the plate, well, and site as metadata.
+
+    Args:
+        qc_results_dir (pathlib.Path): directory with one folder per plate containing `Image.csv`
+        plates (Optional[List[str]], optional): plates to load. Defaults to None (all plates in the directory).
+        file_name_column (str, optional): column with the file name of an image to extract the well and site from.
+        Defaults to "FileName_OrigActin".
+
+    Returns:
+        pd.DataFrame: data frame with one row per image set from all plates
+    """
+    if plates is None:
+        plates = sorted(
+            path.name
+            for path in pathlib.Path(qc_results_dir).iterdir()
+            if pathlib.Path(f"{path}/Image.csv").exists()
+        )
+
+    plate_dfs = []
+    for plate in plates:
+        plate_df = pd.read_csv(pathlib.Path(f"{qc_results_dir}/{plate}/Image.csv"))
+        plate_df["Metadata_Plate"] = plate
+        plate_df["Metadata_Well"] = plate_df[file_name_column].str.extract(
+            WELL_REGEX, expand=False
+        )
+        plate_df["Metadata_Site"] = plate_df[file_name_column].str.extract(
+            SITE_REGEX, expand=False
+        )
+        plate_dfs.append(plate_df)
+
+    return pd.concat(plate_dfs, ignore_index=True)
+
+
+def melt_image_quality(
+    qc_df: pd.DataFrame,
+    metrics: Optional[List[str]] = None,
+    channels: Optional[List[str]] = None,
+) -> pd.DataFrame:
+    """Reshape the `ImageQuality_{metric}_Orig{channel}` columns from wide to long format, with one row per image
+    and channel and one column per metric. Only the metric columns are reshaped, so the metadata is not copied for
+    each channel (use the "ImageIndex" column to join the metadata back from the wide data frame).
+
+    Args:
+        qc_df (pd.DataFrame): data frame from `Image.csv` with one row per image set
+        metrics (Optional[List[str]], optional): metrics to include (e.g., "PowerLogLogSlope"). Defaults to None (all).
+        channels (Optional[List[str]], optional): channels to include (e.g., "DNA"). Defaults to None (all).
+
+    Returns:
+        pd.DataFrame: long data frame with "ImageIndex", "Channel", and an `ImageQuality_{metric}` column per metric
+    """
+    # split the QC column names into the metric and channel, keeping only the columns that match
+    column_parts = qc_df.columns.to_series().str.extract(QC_COLUMN_REGEX).dropna()
+    if metrics is not None:
+        column_parts = column_parts[column_parts["Metric"].isin(metrics)]
+    if channels is not None:
+        column_parts = column_parts[column_parts["Channel"].isin(channels)]
+
+    metric_df = qc_df[column_parts.index]
+    metric_df.columns = pd.MultiIndex.from_frame(column_parts)
+    metric_df.index.name = "ImageIndex"
+
+    # stack the channel level of the columns into rows to create one row per image and channel
+    long_df = metric_df.stack(level="Channel")
+    long_df.columns = [f"ImageQuality_{metric}" for metric in long_df.columns]
+
+    return long_df.reset_index()
+
+
+def add_zscores(
+    long_df: pd.DataFrame,
+    qc_df: pd.DataFrame,
+    group_by: Tuple[str, ...] = ("Metadata_Plate", "Channel"),
+) -> pd.DataFrame:
+    """Add a z-score column (`{metric column}_zscore`) for every metric, where the mean and standard deviation
+    (population, same as `scipy.stats.zscore`) are calculated within each group.
+
+    Args:
+        long_df (pd.DataFrame): long data frame from `melt_image_quality`
+        qc_df (pd.DataFrame): wide data frame the long data frame was created from (used for metadata groups)
+        group_by (Tuple[str, ...], optional): columns to calculate the z-scores within, which can be "Channel" or
+        any metadata column. Defaults to ("Metadata_Plate", "Channel").
+
+    Returns:
+        pd.DataFrame: long data frame with the z-score columns added
+    """
+    metric_columns = [
+        column for column in long_df.columns if column.startswith("ImageQuality_")
+    ]
+    # only the metadata columns used for grouping are looked up for each row of the long data frame
+    group_keys = [
+        (
+            long_df[column]
+            if column in long_df.columns
+            else qc_df[column].reindex(long_df["ImageIndex"]).to_numpy()
+        )
+        for column in group_by
+    ]
+
+    grouped = long_df.groupby(group_keys, sort=False)[metric_columns]
+    counts = grouped.transform("count")
+    # convert the sample standard deviation to the population standard deviation
+    population_std = grouped.transform("std") * ((counts - 1) / counts) ** 0.5
+    zscores = (long_df[metric_columns] - grouped.transform("mean")) / population_std
+    zscores.columns = [f"{column}_zscore" for column in metric_columns]
+
+    return pd.concat([long_df, zscores], axis=1)
+
+
+def apply_qc_rules(long_df: pd.DataFrame, rules: List[dict]) -> pd.DataFrame:
+    """Flag each image and channel with a column per rule (True if the image fails the rule).
+
+    Args:
+        long_df (pd.DataFrame): long data frame with z-scores from `add_zscores`
+        rules (List[dict]): rules with an optional "name" (defaults to the metric), the "metric", the "channels" the
+        rule applies to, the "direction" of outliers ("above", "below", or "both"), and the "threshold_z" (number of
+        standard deviations from the mean)
+
+    Raises:
+        ValueError: if two rules have the same name (e.g., two rules for one metric without a name) or a rule has an
+        unknown direction
+
+    Returns:
+        pd.DataFrame: copy of the long data frame with a `Flag_{name}` column per rule and a "Flagged" column for any
+        rule
+    """
+    rule_names = [rule.get("name", rule["metric"]) for rule in rules]
+    duplicated_names = sorted(
+        {name for name in rule_names if rule_names.count(name) > 1}
+    )
+    if duplicated_names:
+        raise ValueError(
+            f"The rule names {duplicated_names} are used more than once, please give each rule a unique 'name'."
+        )
+
+    flags = {}
+    for rule_name, rule in zip(rule_names, rules):
+        zscores = long_df[f"ImageQuality_{rule['metric']}_zscore"]
+        if rule["direction"] == "above":
+            outliers = zscores > rule["threshold_z"]
+        elif rule["direction"] == "below":
+            outliers = zscores < -rule["threshold_z"]
+        elif rule["direction"] == "both":
+            outliers = zscores.abs() > rule["threshold_z"]
+        else:
+            raise ValueError(
+                f"Unknown direction '{rule['direction']}', please use 'above', 'below', or 'both'."
+            )
+        flags[f"Flag_{rule_name}"] = outliers & long_df["Channel"].isin(
+            rule["channels"]
+        )
+
+    flags_df = pd.DataFrame(flags, index=long_df.index)
+    flags_df["Flagged"] = flags_df.any(axis=1)
+
+    # flags from applying rules before are replaced
+    return pd.concat(
+        [long_df.drop(columns=flags_df.columns, errors="ignore"), flags_df], axis=1
+    )
+
+
+def evaluate_whole_image_qc(
+    qc_df: pd.DataFrame,
+    rules: List[dict] = DEFAULT_QC_RULES,
+    group_by: Tuple[str, ...] = ("Metadata_Plate", "Channel"),
+) -> Tuple[pd.Series, pd.DataFrame]:
+    """Evaluate the whole image QC metrics for all plates, returning an image level pass/fail mask and the flags
+    for each image and channel.
+
+    Args:
+        qc_df (pd.DataFrame): data frame from `load_qc_results` with one row per image set
+        rules (List[dict], optional): channel/metric rules (see `apply_qc_rules`). Defaults to DEFAULT_QC_RULES.
+        group_by (Tuple[str, ...], optional): columns to calculate the z-scores within. Defaults to
+        ("Metadata_Plate", "Channel").
+
+    Returns:
+        Tuple[pd.Series, pd.DataFrame]: boolean mask aligned to `qc_df` (True if the image set passes every rule)
+        and the long data frame with the metrics, z-scores, and flags per image and channel
+    """
+    metrics = sorted({rule["metric"] for rule in rules})
+    long_df = melt_image_quality(qc_df, metrics=metrics)
+    long_df = add_zscores(long_df, qc_df, group_by=group_by)
+    long_df = apply_qc_rules(long_df, rules)
+
+    failed_images = long_df.loc[long_df["Flagged"], "ImageIndex"].unique()
+    pass_mask = ~qc_df.index.isin(failed_images)
+
+    return pd.Series(pass_mask, index=qc_df.index, name="Passed_QC"), long_df
+
+
+def get_outliers(
+    qc_df: pd.DataFrame, long_df: pd.DataFrame, flag_column: str = "Flagged"
+) -> pd.DataFrame:
+    """Join the metadata to the flagged images and channels to create the outlier table (e.g., `qc_outliers.csv`).
+
+    Args:
+        qc_df (pd.DataFrame): wide data frame with the metadata columns
+        long_df (pd.DataFrame): long data frame with flags from `evaluate_whole_image_qc`
+        flag_column (str, optional): flag column to select the outliers with. Defaults to "Flagged" (any rule).
+
+    Returns:
+        pd.DataFrame: one row per flagged image and channel with the metadata, metrics, and channel
+    """
+    flagged_df = long_df[long_df[flag_column]]
+    metadata_df = qc_df.filter(like="Metadata_").drop(
+        columns=["Metadata_Series", "Metadata_Frame"], errors="ignore"
+    )
+    metric_columns = [
+        column
+        for column in flagged_df.columns
+        if column.startswith("ImageQuality_") and not column.endswith("_zscore")
+    ]
+
+    return (
+        metadata_df.loc[flagged_df["ImageIndex"]]
+        .reset_index(drop=True)
+        .join(flagged_df[metric_columns + ["Channel"]].reset_index(drop=True))
+    )
@@ -0,0 +1,272 @@
+"""
+This collection of functions processes the cleaned single-cell profiles with pycytominer. For each plate, the profiles
+are annotated with the platemap (joined through the dictionary codes of the wells, see annotate_utils), the metadata
+columns are renamed, and the profiles are normalized and feature selected as data frames in memory, so each stage does
+not write and read the profiles again. Only the requested outputs are saved, and plates are processed at the same time
+in a process pool.
+For plates that do not fit in memory, the annotated profiles can instead be normalized from the parquet file one batch
+of rows at a time (see normalize_utils). Feature selection uses one pass over the normalized profiles (see
+feature_select_utils). The center and scale of each feature and the features kept by feature selection are saved as a
+transform, so other plates can be projected into the same feature space without fitting again (see transform_utils).
+"""
+
+import os
+import pathlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Optional
+
+import pandas as pd
+import pyarrow as pa
+from annotate_utils import annotate_parquet
+from cp_memory import BYTES_PER_GB, read_available_memory
+from feature_select_utils import (
+    FEATURE_SELECT_OPS,
+    feature_select_df,
+    feature_select_parquet,
+)
+from normalize_utils import (
+    compute_standardize_stats,
+    infer_columns,
+    iter_df_blocks,
+    standardize_parquet,
+)
+from pycytominer import normalize
+from transform_utils import make_transform, save_transform
+
+# outputs that can be saved for each plate (the file is saved as `{plate}_sc_{output}.parquet`)
+OUTPUT_NAMES = ["annotated", "normalized", "feature_selected"]
+
+# metadata columns to rename after annotation
+COLUMN_NAME_MAPPING = {
+    "Image_Metadata_Site": "Metadata_Site",
+}
+
+
+def process_plate(
+    plate: str,
+    profile_path: pathlib.Path,
+    platemap_path: pathlib.Path,
+    output_dir: pathlib.Path,
+    samples: str = "all",
+    feature_select_ops: List[str] = FEATURE_SELECT_OPS,
+    outputs: List[str] = OUTPUT_NAMES,
+    stream_normalize: bool = False,
+) -> Dict[str, str]:
+    """Annotate, rename, normalize, and feature select the single-cell profiles for one plate in memory, saving only
+    the requested outputs. Feature selection is skipped if its output is not requested, and otherwise a report of the
+    dropped features is saved as `{plate}_sc_feature_select_report.csv` (see feature_select_utils). The center and scale
+    of each feature and the kept features are always saved as `{plate}_sc_transform.json` (see transform_utils). With
+    `stream_normalize`, the annotated and normalized profiles are always written to parquet files (temporary files
+    that are removed even if a step fails, if they are not requested) and the normalization reads one batch of rows at
+    a time instead of the whole plate, which uses less memory but writes and reads the profiles on disk again.
+
+    Args:
+        plate (str): name of the plate
+        profile_path (pathlib.Path): path to the cleaned single-cell profiles for the plate
+        platemap_path (pathlib.Path): path to the platemap for the plate
+        output_dir (pathlib.Path): directory to save the outputs as `{plate}_sc_{output}.parquet`
+        samples (str, optional): query for the samples to use as the reference for normalization. Defaults to "all".
+        feature_select_ops (List[str], optional): operations to perform for feature selection. Defaults to
+        FEATURE_SELECT_OPS.
+        outputs (List[str], optional): outputs to save (from OUTPUT_NAMES). Defaults to OUTPUT_NAMES.
+        stream_normalize (bool, optional): normalize the annotated parquet file one batch of rows at a time. Defaults
+        to False.
+
+    Raises:
+        ValueError: if an output is not in OUTPUT_NAMES
+
+    Returns:
+        Dict[str, str]: dictionary with the output names (and "feature_select_report" and "transform") as keys and paths
+        to the saved files as values
+    """
+    unknown_outputs = set(outputs) - set(OUTPUT_NAMES)
+    if unknown_outputs:
+        raise ValueError(
+            f"The outputs {sorted(unknown_outputs)} are not in {OUTPUT_NAMES}."
+        )
+
+    output_files = {
+        output_name: str(pathlib.Path(f"{output_dir}/{plate}_sc_{output_name}.parquet"))
+        for output_name in outputs
+    }
+
+    def save_output(output_name: str, profiles: pd.DataFrame):
+        if output_name in output_files:
+            profiles.to_parquet(output_files[output_name], index=False)
+
+    print("Performing annotation for", plate, "...")
+    # Step 1: Annotation (the metadata columns are renamed before the profiles are saved or normalized)
+    profiles = annotate_parquet(
+        profile_path=profile_path,
+        platemap_path=platemap_path,
+        join_on=["Metadata_well_position", "Image_Metadata_Well"],
+    ).rename(columns=COLUMN_NAME_MAPPING)
+    save_output("annotated", profiles)
+
+    print(
+        "Performing normalization for", plate, "using this samples parameter:", samples
+    )
+    # temporary files for the profiles that were not requested, which are removed even if a step fails
+    temp_paths = []
+    try:
+        # Step 2: Normalization
+        if stream_normalize:
+            # the annotated and normalized profiles are read from files, so files that were not requested are temporary
+            file_paths = {
+                output_name: output_files.get(
+                    output_name,
+                    str(
+                        pathlib.Path(f"{output_dir}/.{plate}_sc_{output_name}.parquet")
+                    ),
+                )
+                for output_name in ["annotated", "normalized"]
+            }
+            temp_paths = [
+                file_paths[output_name]
+                for output_name in file_paths
+                if output_name not in output_files
+            ]
+            if "annotated" not in output_files:
+                profiles.to_parquet(file_paths["annotated"], index=False)
+            del profiles
+            stats = standardize_parquet(
+                input_path=file_paths["annotated"],
+                output_path=file_paths["normalized"],
+                samples=samples,
+            )
+            if "annotated" not in output_files:
+                pathlib.Path(file_paths["annotated"]).unlink()
+        else:
+            # the center and scale are not returned by pycytominer, so they are found from the same samples for the transform
+            features = infer_columns(
+                pa.Schema.from_pandas(profiles.head(0), preserve_index=False)
+            )[1]
+            center, scale = compute_standardize_stats(
+                blocks=iter_df_blocks(
+                    profiles=profiles, features=features, samples=samples
+                ),
+                num_features=len(features),
+            )
+            stats = pd.DataFrame(
+                {"center": center, "scale": scale},
+                index=pd.Index(features, name="feature"),
+            )
+            profiles = normalize(
+                profiles=profiles, method="standardize", samples=samples
+            )
+            save_output("normalized", profiles)
+
+        if "feature_selected" in output_files:
+            print("Performing feature selection for", plate, "...")
+            # Step 3: Feature selection (in one pass over the normalized profiles, with a report of the dropped features)
+            if stream_normalize:
+                report = feature_select_parquet(
+                    input_path=file_paths["normalized"],
+                    output_path=output_files["feature_selected"],
+                    operation=feature_select_ops,
+                    na_cutoff=0,
+                )
+            else:
+                profiles, report = feature_select_df(
+                    profiles=profiles, operation=feature_select_ops, na_cutoff=0
+                )
+                save_output("feature_selected", profiles)
+            output_files["feature_select_report"] = str(
+                pathlib.Path(f"{output_dir}/{plate}_sc_feature_select_report.csv")
+            )
+            report.to_csv(output_files["feature_select_report"], index=False)
+            kept_features = stats.index.difference(
+                report["feature"], sort=False
+            ).tolist()
+        else:
+            kept_features = stats.index.tolist()
+
+        # Save the normalization and feature selection as a transform to apply to other plates
+        output_files["transform"] = str(
+            pathlib.Path(f"{output_dir}/{plate}_sc_transform.json")
+        )
+        save_transform(
+            transform=make_transform(
+                plate=plate, stats=stats, kept_features=kept_features, samples=samples
+            ),
+            path=output_files["transform"],
+        )
+    finally:
+        for temp_path in temp_paths:
+            pathlib.Path(temp_path).unlink(missing_ok=True)
+
+    return output_files
+
+
+def process_plates(
+    plate_info_dictionary: Dict[str, Dict[str, str]],
+    output_dir: pathlib.Path,
+    samples: Optional[Dict[str, str]] = None,
+    feature_select_ops: List[str] = FEATURE_SELECT_OPS,
+    outputs: List[str] = OUTPUT_NAMES,
+    num_workers: Optional[int] = None,
+    memory_limit_gb: float = 16,
+    stream_normalize: bool = False,
+) -> Dict[str, Dict[str, str]]:
+    """Process the single-cell profiles for each plate at the same time in a process pool (see `process_plate`). The
+    largest plates are started first, so the total time is close to the time for the largest plate when there are
+    enough workers.
+
+    Args:
+        plate_info_dictionary (Dict[str, Dict[str, str]]): dictionary with plate names as keys and dictionaries with
+        the "profile_path" and "platemap_path" for the plate as values
+        output_dir (pathlib.Path): directory to save the outputs as `{plate}_sc_{output}.parquet`
+        samples (Optional[Dict[str, str]], optional): dictionary with plate names as keys and the query for the samples
+        to use as the reference for normalization as values. Defaults to None ("all" for every plate).
+        feature_select_ops (List[str], optional): operations to perform for feature selection. Defaults to
+        FEATURE_SELECT_OPS.
+        outputs (List[str], optional): outputs to save (from OUTPUT_NAMES). Defaults to OUTPUT_NAMES.
+        num_workers (Optional[int], optional): number of worker processes. Defaults to None (one per plate, limited by
+        the number of CPUs and how many memory limits fit in the available memory).
+        memory_limit_gb (float, optional): GB of memory expected for each worker, which only sets the number of workers.
+        Defaults to 16.
+        stream_normalize (bool, optional): normalize the annotated parquet file for each plate one batch of rows at a
+        time. Defaults to False.
+
+    Returns:
+        Dict[str, Dict[str, str]]: dictionary with plate names as keys and the paths to the saved outputs as values
+    """
+    samples = samples or {}
+    if num_workers is None:
+        num_workers = min(
+            len(plate_info_dictionary),
+            os.cpu_count(),
+            read_available_memory() // int(memory_limit_gb * BYTES_PER_GB),
+        )
+    num_workers = max(1, num_workers)
+    print(
+        f"Processing {len(plate_info_dictionary)} plates with {num_workers} workers ({memory_limit_gb} GB each)"
+    )
+
+    plates = sorted(
+        plate_info_dictionary,
+        key=lambda plate: os.path.getsize(plate_info_dictionary[plate]["profile_path"]),
+        reverse=True,
+    )
+    output_files = {}
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = {
+            executor.submit(
+                process_plate,
+                plate=plate,
+                profile_path=plate_info_dictionary[plate]["profile_path"],
+                platemap_path=plate_info_dictionary[plate]["platemap_path"],
+                output_dir=output_dir,
+                samples=samples.get(plate, "all"),
+                feature_select_ops=feature_select_ops,
+                outputs=outputs,
+                stream_normalize=stream_normalize,
+            ): plate
+            for plate in plates
+        }
+        for future in as_completed(futures):
+            plate = futures[future]
+            output_files[plate] = future.result()
+            print(f"Single-cell processing has been performed for {plate}")
+
+    return output_files
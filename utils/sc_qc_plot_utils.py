@@ -0,0 +1,190 @@
+"""
+This collection of functions makes the single-cell QC figures for plates with millions of single cells. Scatterplots
+are drawn as 2-D histograms (one raster image for the single cells that passed QC and one for the outliers) and
+density plots are drawn from a sample of single cells taken from every well, so the time to make and save a figure
+stays the same as the number of single cells grows. The threshold lines are the feature values from the QC conditions
+(see `sc_qc_utils.get_threshold_values`).
+"""
+
+from typing import Dict, List, Optional
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import seaborn as sns
+from matplotlib.axes import Axes
+from matplotlib.colors import LinearSegmentedColormap, LogNorm
+from matplotlib.patches import Patch
+
+PASSED_LABEL = "Single-cell passed QC"
+FAILED_LABEL = "Single-cell failed QC"
+# colors for the single cells that passed and failed QC
+QC_PALETTE = {PASSED_LABEL: "#006400", FAILED_LABEL: "#990090"}
+# colors for the threshold lines in the order of the features
+THRESHOLD_COLORS = ["r", "b", "k"]
+
+
+def stratified_sample(
+    plate_df: pd.DataFrame,
+    max_cells: int,
+    strata: Optional[List[str]] = None,
+    random_state: int = 0,
+) -> pd.DataFrame:
+    """Take a sample of about `max_cells` single cells with the same fraction from each group (e.g., each well), so
+    every group is in the sample with the same proportion as in the plate.
+
+    Args:
+        plate_df (pd.DataFrame): single cells for a plate
+        max_cells (int): maximum number of single cells in the sample
+        strata (Optional[List[str]], optional): columns to group the single cells by. Defaults to None (no groups).
+        random_state (int, optional): seed for the sample so the figures are the same each time. Defaults to 0.
+
+    Returns:
+        pd.DataFrame: sample of the single cells (all single cells if there are not more than `max_cells`)
+    """
+    if plate_df.shape[0] <= max_cells:
+        return plate_df
+
+    fraction = max_cells / plate_df.shape[0]
+    if not strata:
+        return plate_df.sample(frac=fraction, random_state=random_state)
+
+    return plate_df.groupby(strata, group_keys=False, dropna=False).sample(
+        frac=fraction, random_state=random_state
+    )
+
+
+def draw_threshold_lines(
+    ax: Axes, threshold_values: Dict[str, float], x: str, y: Optional[str] = None
+):
+    """Draw a line for the threshold of the x feature (vertical) and y feature (horizontal).
+
+    Args:
+        ax (Axes): axes to draw the lines on
+        threshold_values (Dict[str, float]): dictionary with feature names as keys and the feature value of the
+        threshold as values (from `sc_qc_utils.get_threshold_values`)
+        x (str): feature on the x-axis
+        y (Optional[str], optional): feature on the y-axis. Defaults to None.
+    """
+    for color, feature in zip(THRESHOLD_COLORS, threshold_values):
+        label = f"Threshold for {feature}: {threshold_values[feature]:.2f}"
+        if feature == x:
+            ax.axvline(
+                x=threshold_values[feature], color=color, linestyle="--", label=label
+            )
+        elif feature == y:
+            ax.axhline(
+                y=threshold_values[feature], color=color, linestyle="--", label=label
+            )
+
+
+def plot_outlier_density(
+    plate_df: pd.DataFrame,
+    x: str,
+    y: str,
+    is_outlier: np.ndarray,
+    threshold_values: Optional[Dict[str, float]] = None,
+    bins: int = 300,
+    ax: Optional[Axes] = None,
+) -> Axes:
+    """Plot two features for every single cell as 2-D histograms instead of a scatterplot, where each bin is colored
+    by the number of single cells (log scale) that passed QC (green) or failed QC (purple). The histograms are drawn
+    as raster images, so the figure has the same size for any number of single cells.
+
+    Args:
+        plate_df (pd.DataFrame): single cells for a plate
+        x (str): feature on the x-axis
+        y (str): feature on the y-axis
+        is_outlier (np.ndarray): boolean mask of the single cells that failed QC (in the same order as plate_df)
+        threshold_values (Optional[Dict[str, float]], optional): dictionary with feature names as keys and the feature
+        value of the threshold as values to draw as lines. Defaults to None.
+        bins (int, optional): number of bins for each axis. Defaults to 300.
+        ax (Optional[Axes], optional): axes to plot on. Defaults to None (current axes).
+
+    Returns:
+        Axes: axes with the plot
+    """
+    ax = plt.gca() if ax is None else ax
+    x_values = plate_df[x].to_numpy(dtype=np.float64)
+    y_values = plate_df[y].to_numpy(dtype=np.float64)
+    is_outlier = np.asarray(is_outlier, dtype=bool)
+    finite = np.isfinite(x_values) & np.isfinite(y_values)
+
+    # use the same bins for both groups so the images line up
+    x_edges = np.histogram_bin_edges(x_values[finite], bins=bins)
+    y_edges = np.histogram_bin_edges(y_values[finite], bins=bins)
+
+    for label, cells in ((PASSED_LABEL, ~is_outlier), (FAILED_LABEL, is_outlier)):
+        counts, _, _ = np.histogram2d(
+            x_values[finite & cells], y_values[finite & cells], bins=[x_edges, y_edges]
+        )
+        if not counts.any():
+            continue
+        # bins without single cells are masked so they are transparent
+        ax.imshow(
+            np.ma.masked_equal(counts.T, 0),
+            origin="lower",
+            extent=(x_edges[0], x_edges[-1], y_edges[0], y_edges[-1]),
+            aspect="auto",
+            interpolation="nearest",
+            cmap=LinearSegmentedColormap.from_list(
+                label, ["#d9d9d9", QC_PALETTE[label]]
+            ),
+            norm=LogNorm(vmin=1, vmax=counts.max()),
+            alpha=0.8,
+        )
+
+    if threshold_values:
+        draw_threshold_lines(ax=ax, threshold_values=threshold_values, x=x, y=y)
+
+    # add the QC status to the legend with the threshold lines
+    handles, labels = ax.get_legend_handles_labels()
+    ax.legend(
+        handles=[Patch(color=color) for color in QC_PALETTE.values()] + handles,
+        labels=list(QC_PALETTE) + labels,
+        loc="lower right",
+        prop={"size": 10},
+    )
+    ax.set_xlabel(x)
+    ax.set_ylabel(y)
+
+    return ax
+
+
+def plot_feature_kde(
+    plate_df: pd.DataFrame,
+    feature: str,
+    threshold_values: Optional[Dict[str, float]] = None,
+    strata: Optional[List[str]] = None,
+    max_cells: int = 50000,
+    ax: Optional[Axes] = None,
+) -> Axes:
+    """Plot the distribution of a feature from a sample of single cells (taken from every group, see
+    `stratified_sample`), so the time to fit the density does not depend on the number of single cells.
+
+    Args:
+        plate_df (pd.DataFrame): single cells for a plate
+        feature (str): feature to plot
+        threshold_values (Optional[Dict[str, float]], optional): dictionary with feature names as keys and the feature
+        value of the threshold as values to draw as lines. Defaults to None.
+        strata (Optional[List[str]], optional): columns to group the single cells by when sampling (e.g.,
+        ["Image_Metadata_Well"]). Defaults to None (no groups).
+        max_cells (int, optional): maximum number of single cells to fit the density with. Defaults to 50000.
+        ax (Optional[Axes], optional): axes to plot on. Defaults to None (current axes).
+
+    Returns:
+        Axes: axes with the plot
+    """
+    ax = plt.gca() if ax is None else ax
+    sample_df = stratified_sample(
+        plate_df=plate_df[list(dict.fromkeys([feature] + (strata or [])))],
+        max_cells=max_cells,
+        strata=strata,
+    )
+    sns.kdeplot(x=feature, data=sample_df, fill=True, ax=ax)
+
+    if threshold_values:
+        draw_threshold_lines(ax=ax, threshold_values=threshold_values, x=feature)
+        ax.legend()
+
+    return ax
@@ -0,0 +1,336 @@
+"""
+This collection of functions performs single-cell quality control (QC) for all converted plates at once. The z-score
+thresholds for each QC condition (e.g., large nuclei with high intensity) are read from a config file with default
+thresholds and thresholds for specific plates. Each plate is processed in its own worker process, where the outliers
+for all conditions are found in one pass over the QC features (only these and the metadata columns are loaded), the
+cleaned single cells are streamed to a new file, and the outliers are returned to be saved into one table.
+"""
+
+import pathlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+import yaml
+
+import parquet_utils
+
+# metadata columns to include with the outliers
+METADATA_COLUMNS = [
+    "Image_Metadata_Plate",
+    "Image_Metadata_Well",
+    "Image_Metadata_Site",
+    "Metadata_Nuclei_Location_Center_X",
+    "Metadata_Nuclei_Location_Center_Y",
+]
+
+
+def load_qc_config(config_path: pathlib.Path) -> dict:
+    """Load the single-cell QC config with the default thresholds for each condition ("default") and any thresholds
+    that are different for a plate ("plates").
+
+    Args:
+        config_path (pathlib.Path): path to the YAML config file
+
+    Raises:
+        ValueError: if the config does not have default thresholds
+
+    Returns:
+        dict: single-cell QC config
+    """
+    with open(config_path) as config_file:
+        qc_config = yaml.load(config_file, Loader=yaml.FullLoader)
+
+    if not qc_config or "default" not in qc_config:
+        raise ValueError(
+            f"The single-cell QC config {pathlib.Path(config_path).name} is missing the default thresholds."
+        )
+    qc_config.setdefault("plates", {})
+
+    return qc_config
+
+
+def get_plate_conditions(qc_config: dict, plate: str) -> Dict[str, Dict[str, float]]:
+    """Find the thresholds for each QC condition for a plate, where the thresholds for a condition set for the plate
+    replace the default thresholds for that condition.
+
+    Args:
+        qc_config (dict): single-cell QC config
+        plate (str): name of the plate
+
+    Returns:
+        Dict[str, Dict[str, float]]: dictionary with condition names as keys and feature thresholds (feature name
+        and z-score threshold) as values
+    """
+    conditions = dict(qc_config["default"])
+    conditions.update(qc_config["plates"].get(plate) or {})
+
+    return conditions
+
+
+def get_qc_columns(
+    conditions: Dict[str, Dict[str, float]],
+    metadata_columns: List[str] = METADATA_COLUMNS,
+) -> List[str]:
+    """Find the columns needed for single-cell QC, which are the metadata columns and the features used by any
+    condition, so only these columns are loaded from a converted plate.
+
+    Args:
+        conditions (Dict[str, Dict[str, float]]): dictionary with condition names as keys and feature thresholds as values
+        metadata_columns (List[str], optional): metadata columns to include with the outliers. Defaults to METADATA_COLUMNS.
+
+    Returns:
+        List[str]: metadata columns followed by the QC features (without duplicates)
+    """
+    return list(
+        dict.fromkeys(
+            metadata_columns
+            + [
+                feature
+                for feature_thresholds in conditions.values()
+                for feature in feature_thresholds
+            ]
+        )
+    )
+
+
+def compute_qc_bitmask(
+    plate_df: pd.DataFrame, conditions: Dict[str, Dict[str, float]]
+) -> np.ndarray:
+    """Find which QC conditions each single cell failed in one vectorized pass. The z-scores are computed once for the
+    features used by any condition (only those columns are read from plate_df), and then every condition is evaluated
+    as a boolean mask. A single cell fails a condition if it is past all thresholds for that condition (a negative
+    threshold is below the mean and any other threshold is above the mean), the same as coSMicQC.
+
+    Args:
+        plate_df (pd.DataFrame): converted single cells for a plate
+        conditions (Dict[str, Dict[str, float]]): dictionary with condition names as keys and feature thresholds as values
+
+    Raises:
+        ValueError: if a feature used by a condition is not in plate_df or there are more than 64 conditions
+
+    Returns:
+        np.ndarray: bitmask for each single cell (in the same order as plate_df), where bit i is set if the single cell
+        failed the ith condition (in the order of the conditions) and 0 means the single cell passed QC
+    """
+    if len(conditions) > 64:
+        raise ValueError(
+            f"At most 64 QC conditions can be used at once, but {len(conditions)} were given."
+        )
+
+    features = list(
+        dict.fromkeys(
+            feature
+            for feature_thresholds in conditions.values()
+            for feature in feature_thresholds
+        )
+    )
+    missing_features = [
+        feature for feature in features if feature not in plate_df.columns
+    ]
+    if missing_features:
+        raise ValueError(
+            f"The following QC features do not exist in the DataFrame: {missing_features}"
+        )
+
+    # z-score each feature once (population standard deviation like scipy.stats.zscore used by coSMicQC)
+    values = plate_df[features].to_numpy(dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        zscores = (values - values.mean(axis=0)) / values.std(axis=0)
+    feature_index = {feature: index for index, feature in enumerate(features)}
+
+    # use the smallest unsigned integer type that has a bit for every condition
+    bitmask_dtype = next(
+        dtype
+        for dtype in (np.uint8, np.uint16, np.uint32, np.uint64)
+        if np.iinfo(dtype).bits >= len(conditions)
+    )
+    bitmask = np.zeros(len(plate_df), dtype=bitmask_dtype)
+    for bit, feature_thresholds in enumerate(conditions.values()):
+        failed = np.ones(len(plate_df), dtype=bool)
+        for feature, threshold in feature_thresholds.items():
+            feature_zscores = zscores[:, feature_index[feature]]
+            # only negative thresholds are below the mean (a threshold of 0 flags single cells above the mean)
+            if threshold < 0:
+                failed &= feature_zscores < threshold
+            else:
+                failed &= feature_zscores > threshold
+        bitmask |= failed.astype(bitmask_dtype) << bitmask_dtype(bit)
+
+    return bitmask
+
+
+def get_threshold_values(
+    plate_df: pd.DataFrame, conditions: Dict[str, Dict[str, float]]
+) -> Dict[str, Dict[str, float]]:
+    """Convert the z-score thresholds for each condition into the feature values where single cells start to fail
+    (mean + threshold * standard deviation), using the same z-scores as compute_qc_bitmask, so the thresholds can be
+    drawn on QC plots.
+
+    Args:
+        plate_df (pd.DataFrame): converted single cells for a plate
+        conditions (Dict[str, Dict[str, float]]): dictionary with condition names as keys and feature thresholds as values
+
+    Returns:
+        Dict[str, Dict[str, float]]: dictionary with condition names as keys and the feature value for each threshold
+        (feature name and value) as values
+    """
+    features = get_qc_columns(conditions=conditions, metadata_columns=[])
+    values = plate_df[features].to_numpy(dtype=np.float64)
+    means = dict(zip(features, values.mean(axis=0)))
+    stds = dict(zip(features, values.std(axis=0)))
+
+    return {
+        condition: {
+            feature: float(means[feature] + threshold * stds[feature])
+            for feature, threshold in feature_thresholds.items()
+        }
+        for condition, feature_thresholds in conditions.items()
+    }
+
+
+def find_plate_outliers(
+    plate_df: pd.DataFrame,
+    conditions: Dict[str, Dict[str, float]],
+    metadata_columns: List[str] = METADATA_COLUMNS,
+) -> pd.DataFrame:
+    """Find the single cells that are outliers for any QC condition, using one pass over the QC features for all
+    conditions (see compute_qc_bitmask).
+
+    Args:
+        plate_df (pd.DataFrame): converted single cells for a plate
+        conditions (Dict[str, Dict[str, float]]): dictionary with condition names as keys and feature thresholds as values
+        metadata_columns (List[str], optional): metadata columns to include with the outliers. Defaults to METADATA_COLUMNS.
+
+    Returns:
+        pd.DataFrame: one row per outlier (with the same index as plate_df) with the metadata columns, the features
+        used for QC, a "QC_Bitmask" column with the conditions that failed, and an "Outlier_<condition>" column for
+        each condition
+    """
+    bitmask = compute_qc_bitmask(plate_df=plate_df, conditions=conditions)
+    is_outlier = bitmask != 0
+
+    features = list(
+        dict.fromkeys(
+            feature
+            for feature_thresholds in conditions.values()
+            for feature in feature_thresholds
+        )
+    )
+    # only the rows and columns for the outliers are copied from plate_df
+    plate_outliers = plate_df.loc[is_outlier, metadata_columns + features].copy()
+    outlier_bitmask = bitmask[is_outlier]
+    plate_outliers["QC_Bitmask"] = outlier_bitmask
+    for bit, condition in enumerate(conditions):
+        plate_outliers[f"Outlier_{condition}"] = (
+            (outlier_bitmask >> outlier_bitmask.dtype.type(bit)) & 1
+        ).astype(bool)
+
+    return plate_outliers
+
+
+def run_plate_qc(
+    plate: str,
+    converted_path: pathlib.Path,
+    cleaned_dir: pathlib.Path,
+    conditions: Dict[str, Dict[str, float]],
+    metadata_columns: List[str] = METADATA_COLUMNS,
+    batch_size: int = 65536,
+) -> pd.DataFrame:
+    """Find the outliers for one plate and save the single cells that passed QC as `{plate}_cleaned.parquet`. Only the
+    metadata and QC feature columns are loaded to find the outliers, and then the converted file is streamed through
+    the mask one batch of rows at a time, so the memory used does not depend on the number of features in the file.
+
+    Args:
+        plate (str): name of the plate
+        converted_path (pathlib.Path): path to the converted parquet file for the plate
+        cleaned_dir (pathlib.Path): directory to save the cleaned parquet file
+        conditions (Dict[str, Dict[str, float]]): dictionary with condition names as keys and feature thresholds as values
+        metadata_columns (List[str], optional): metadata columns to include with the outliers. Defaults to METADATA_COLUMNS.
+        batch_size (int, optional): maximum number of rows to read at a time when saving the cleaned file. Defaults to 65536.
+
+    Returns:
+        pd.DataFrame: outliers for the plate
+    """
+    plate_df = pd.read_parquet(
+        converted_path,
+        columns=get_qc_columns(
+            conditions=conditions, metadata_columns=metadata_columns
+        ),
+    )
+
+    plate_outliers = find_plate_outliers(
+        plate_df=plate_df, conditions=conditions, metadata_columns=metadata_columns
+    )
+
+    # the rows are in the same order as the file, so the mask lines up with the batches from the file
+    keep_mask = ~plate_df.index.isin(plate_outliers.index)
+    num_cleaned = parquet_utils.transform_parquet(
+        input_path=converted_path,
+        output_path=pathlib.Path(f"{cleaned_dir}/{plate}_cleaned.parquet"),
+        row_filter=parquet_utils.mask_filter(keep_mask),
+        batch_size=batch_size,
+    )
+    print(
+        f"{plate}: {plate_outliers.shape[0]} outliers were removed, {num_cleaned} single cells passed QC"
+    )
+
+    return plate_outliers
+
+
+def run_sc_qc(
+    converted_dir: pathlib.Path,
+    cleaned_dir: pathlib.Path,
+    config_path: pathlib.Path,
+    outliers_path: pathlib.Path,
+    plates: Optional[List[str]] = None,
+    num_workers: Optional[int] = None,
+) -> pd.DataFrame:
+    """Perform single-cell QC for every converted plate at the same time in a process pool, saving the cleaned
+    parquet file for each plate and one table with the outliers from all plates.
+
+    Args:
+        converted_dir (pathlib.Path): directory with the converted plates (`{plate}_converted.parquet`)
+        cleaned_dir (pathlib.Path): directory to save the cleaned plates (`{plate}_cleaned.parquet`)
+        config_path (pathlib.Path): path to the single-cell QC config
+        outliers_path (pathlib.Path): path to save the outliers from all plates as a parquet file
+        plates (Optional[List[str]], optional): plates to process. Defaults to None (all converted plates).
+        num_workers (Optional[int], optional): number of worker processes. Defaults to None (number of CPUs).
+
+    Returns:
+        pd.DataFrame: outliers from all plates
+    """
+    qc_config = load_qc_config(config_path)
+    converted_paths = {
+        path.name.replace("_converted.parquet", ""): path
+        for path in sorted(pathlib.Path(converted_dir).glob("*_converted.parquet"))
+    }
+    if plates is not None:
+        converted_paths = {plate: converted_paths[plate] for plate in plates}
+    pathlib.Path(cleaned_dir).mkdir(parents=True, exist_ok=True)
+
+    all_outliers = {}
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = {
+            executor.submit(
+                run_plate_qc,
+                plate=plate,
+                converted_path=converted_path,
+                cleaned_dir=cleaned_dir,
+                conditions=get_plate_conditions(qc_config, plate),
+            ): plate
+            for plate, converted_path in converted_paths.items()
+        }
+        for future in as_completed(futures):
+            all_outliers[futures[future]] = future.result()
+
+    # save the outliers in the same order as the plates with the index of each single cell in its plate
+    outliers_df = pd.concat(
+        [all_outliers[plate] for plate in converted_paths],
+        keys=list(converted_paths),
+        names=["Metadata_Plate", "Metadata_Index"],
+    ).reset_index()
+    outliers_df.to_parquet(outliers_path, index=False)
+
+    return outliers_df
@@ -0,0 +1,214 @@
+"""
+This collection of functions saves the normalization and feature selection fit on one plate as a "transform" (the
+center and scale of each feature and the list of features kept by feature selection) in a JSON file, and applies it to
+the single-cell profiles of another plate. A new plate is projected into the same feature space as the reference plate
+(e.g., the plate the models were trained on) in one pass over its annotated profiles, without fitting the
+normalization or feature selection again.
+"""
+
+import json
+import os
+import pathlib
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from normalize_utils import write_standardized_parquet
+
+# keys that every saved transform has
+TRANSFORM_KEYS = [
+    "plate",
+    "samples",
+    "method",
+    "features",
+    "center",
+    "scale",
+    "kept_features",
+]
+
+
+def make_transform(
+    plate: str,
+    stats: pd.DataFrame,
+    kept_features: Optional[List[str]] = None,
+    samples: str = "all",
+) -> Dict[str, Any]:
+    """Make the transform for a plate from the standardize stats and the features kept by feature selection.
+
+    Args:
+        plate (str): name of the plate the transform was fit on
+        stats (pd.DataFrame): "center" and "scale" of each feature (index), from `normalize_utils.standardize_parquet`
+        kept_features (Optional[List[str]], optional): features kept by feature selection. Defaults to None (all
+        features).
+        samples (str, optional): query for the samples used as the reference for normalization. Defaults to "all".
+
+    Raises:
+        ValueError: if a kept feature is not in the stats
+
+    Returns:
+        Dict[str, Any]: transform with the keys in TRANSFORM_KEYS
+    """
+    features = stats.index.tolist()
+    kept_features = features if kept_features is None else list(kept_features)
+    missing_features = set(kept_features) - set(features)
+    if missing_features:
+        raise ValueError(
+            f"The kept features {sorted(missing_features)} do not have a center and scale."
+        )
+
+    return {
+        "plate": plate,
+        "samples": samples,
+        "method": "standardize",
+        "features": features,
+        "center": stats["center"].tolist(),
+        "scale": stats["scale"].tolist(),
+        "kept_features": kept_features,
+    }
+
+
+def save_transform(transform: Dict[str, Any], path: pathlib.Path) -> None:
+    """Save a transform as a JSON file (written to a temporary file first, so a partial file is never left behind).
+
+    Args:
+        transform (Dict[str, Any]): transform from `make_transform`
+        path (pathlib.Path): path to save the transform (e.g., `{plate}_sc_transform.json`)
+    """
+    path = pathlib.Path(path)
+    temp_path = path.with_name(f".{path.name}.tmp")
+    with open(temp_path, "w") as transform_file:
+        json.dump(transform, transform_file, indent=4)
+    os.replace(temp_path, path)
+
+
+def load_transform(path: pathlib.Path) -> Dict[str, Any]:
+    """Load a transform saved with `save_transform`.
+
+    Args:
+        path (pathlib.Path): path to the transform JSON file
+
+    Raises:
+        ValueError: if the transform is missing keys, the center or scale does not have a value for each feature, or
+        a kept feature does not have a center and scale
+
+    Returns:
+        Dict[str, Any]: transform with the keys in TRANSFORM_KEYS
+    """
+    with open(path, "r") as transform_file:
+        transform = json.load(transform_file)
+
+    missing_keys = set(TRANSFORM_KEYS) - set(transform)
+    if missing_keys:
+        raise ValueError(f"The transform {path} is missing {sorted(missing_keys)}.")
+    if (
+        not len(transform["features"])
+        == len(transform["center"])
+        == len(transform["scale"])
+    ):
+        raise ValueError(
+            f"The transform {path} does not have a center and scale for each feature."
+        )
+    missing_features = set(transform["kept_features"]) - set(transform["features"])
+    if missing_features:
+        raise ValueError(
+            f"The kept features {sorted(missing_features)} in {path} do not have a center and scale."
+        )
+
+    return transform
+
+
+def get_kept_stats(transform: Dict[str, Any]) -> pd.DataFrame:
+    """Get the center and scale of the features kept by feature selection, in the order they are kept.
+
+    Args:
+        transform (Dict[str, Any]): transform from `load_transform`
+
+    Returns:
+        pd.DataFrame: "center" and "scale" of each kept feature (index)
+    """
+    stats = pd.DataFrame(
+        {"center": transform["center"], "scale": transform["scale"]},
+        index=pd.Index(transform["features"], name="feature"),
+        dtype=np.float64,
+    )
+
+    return stats.loc[transform["kept_features"]]
+
+
+def apply_transform_parquet(
+    input_path: pathlib.Path,
+    output_path: pathlib.Path,
+    transform: Dict[str, Any],
+    batch_size: int = 10000,
+) -> int:
+    """Project the single-cell profiles in a parquet file (e.g., annotated profiles for a new plate) through a
+    transform in one pass, one batch of rows at a time. The output has the metadata columns followed by the kept
+    features standardized with the center and scale from the reference plate.
+
+    Args:
+        input_path (pathlib.Path): path to the parquet file with the single-cell profiles
+        output_path (pathlib.Path): path to save the transformed profiles
+        transform (Dict[str, Any]): transform from `load_transform`
+        batch_size (int, optional): maximum number of rows to read at a time. Defaults to 10000.
+
+    Raises:
+        ValueError: if a kept feature is not in the parquet file
+
+    Returns:
+        int: number of rows written
+    """
+    kept_stats = get_kept_stats(transform)
+    missing_features = set(kept_stats.index) - set(pq.read_schema(input_path).names)
+    if missing_features:
+        raise ValueError(
+            f"The features {sorted(missing_features)} from the transform are not in {input_path}."
+        )
+
+    return write_standardized_parquet(
+        input_path=input_path,
+        output_path=output_path,
+        features=kept_stats.index.tolist(),
+        center=kept_stats["center"].to_numpy(),
+        scale=kept_stats["scale"].to_numpy(),
+        batch_size=batch_size,
+    )
+
+
+def apply_transform_df(
+    profiles: pd.DataFrame, transform: Dict[str, Any]
+) -> pd.DataFrame:
+    """Project single-cell profiles in a data frame through a transform (see `apply_transform_parquet`).
+
+    Args:
+        profiles (pd.DataFrame): single-cell profiles (e.g., annotated profiles for a new plate)
+        transform (Dict[str, Any]): transform from `load_transform`
+
+    Raises:
+        ValueError: if a kept feature is not in the data frame
+
+    Returns:
+        pd.DataFrame: metadata columns followed by the standardized kept features
+    """
+    kept_stats = get_kept_stats(transform)
+    missing_features = set(kept_stats.index) - set(profiles.columns)
+    if missing_features:
+        raise ValueError(
+            f"The features {sorted(missing_features)} from the transform are not in the profiles."
+        )
+
+    meta_features = [
+        column for column in profiles.columns if column.startswith("Metadata_")
+    ]
+    features = kept_stats.index.tolist()
+    standardized = (
+        profiles[features].to_numpy(dtype=np.float64) - kept_stats["center"].to_numpy()
+    ) / kept_stats["scale"].to_numpy()
+
+    return pd.concat(
+        [
+            profiles[meta_features],
+            pd.DataFrame(standardized, columns=features, index=profiles.index),
+        ],
+        axis=1,
+    )